@@ -11,7 +11,7 @@ import sys
 sys.path.append('decoder_zoo/GroundingDINO')
 import groundingdino.datasets.transforms as T
 from groundingdino.models import build_model
-from groundingdino.util.misc import clean_state_dict
+from groundingdino.util.misc import clean_state_dict, nested_tensor_from_tensor_list
 from groundingdino.util.slconfig import SLConfig
 from groundingdino.util.utils import get_phrases_from_posmap
 
@@ -80,42 +80,109 @@ def predict(
         device: str = "cuda",
         remove_combined: bool = False
 ) -> Tuple[torch.Tensor, torch.Tensor, List[str]]:
-    caption = preprocess_caption(caption=caption)
-
-    model = model.to(device)
-    image = image.to(device)
-
-    with torch.no_grad():
-        outputs = model(image[None], captions=[caption])
-
-    prediction_logits = outputs["pred_logits"].cpu().sigmoid()[0]  # prediction_logits.shape = (nq, 256)
-    prediction_boxes = outputs["pred_boxes"].cpu()[0]  # prediction_boxes.shape = (nq, 4)
+    return predict_batch(
+        model,
+        image,
+        [caption],
+        box_threshold=box_threshold,
+        text_threshold=text_threshold,
+        device=device,
+        remove_combined=remove_combined,
+    )[0]
+
+
+class CaptionMap:
+    """
+    Tokenization of one (preprocessed) caption, its phrase separators and the phrase decoded for each
+    set of tokens a detection selects; built once per caption string, see caption_map.
+    """
+
+    def __init__(self, tokenizer, caption: str):
+        self.tokenizer = tokenizer
+        self.input_ids = tokenizer(caption)["input_ids"]
+        # [CLS], [SEP] and "."
+        self.sep_idx = [i for i, token_id in enumerate(self.input_ids) if token_id in [101, 102, 1012]]
+        self.phrases = {}
+
+    def span(self, max_idx: int) -> Tuple[int, int]:
+        # the separators around token max_idx, i.e. the phrase the detection is strongest on.
+        insert_idx = min(bisect.bisect_left(self.sep_idx, max_idx), len(self.sep_idx) - 1)
+        return self.sep_idx[max(insert_idx - 1, 0)], self.sep_idx[insert_idx]
+
+    def phrase(self, token_idx: List[int]) -> str:
+        key = tuple(token_idx)
+        if key not in self.phrases:
+            self.phrases[key] = self.tokenizer.decode([self.input_ids[i] for i in key if i < len(self.input_ids)]).replace('.', '')
+        return self.phrases[key]
+
+
+_caption_maps = {}
+
+
+def caption_map(tokenizer, caption: str) -> CaptionMap:
+    key = (id(tokenizer), caption)
+    if key not in _caption_maps:
+        if len(_caption_maps) >= 4096:
+            _caption_maps.clear()
+        _caption_maps[key] = CaptionMap(tokenizer, caption)
+    return _caption_maps[key]
+
+
+def _model_on(model, device):
+    # model.to() walks every parameter, skip it when the model is already there.
+    if next(model.parameters()).device != torch.device(device):
+        model = model.to(device)
+    return model
 
-    mask = prediction_logits.max(dim=1)[0] > box_threshold
-    logits = prediction_logits[mask]  # logits.shape = (n, 256)
-    boxes = prediction_boxes[mask]  # boxes.shape = (n, 4)
 
-    tokenizer = model.tokenizer
-    tokenized = tokenizer(caption)
-    
-    if remove_combined:
-        sep_idx = [i for i in range(len(tokenized['input_ids'])) if tokenized['input_ids'][i] in [101, 102, 1012]]
-        
-        phrases = []
-        for logit in logits:
-            max_idx = logit.argmax()
-            insert_idx = bisect.bisect_left(sep_idx, max_idx)
-            right_idx = sep_idx[insert_idx]
-            left_idx = sep_idx[insert_idx - 1]
-            phrases.append(get_phrases_from_posmap(logit > text_threshold, tokenized, tokenizer, left_idx, right_idx).replace('.', ''))
+def predict_batch(
+        model,
+        images,
+        captions: List[str],
+        box_threshold: float,
+        text_threshold: float,
+        device: str = "cuda",
+        remove_combined: bool = False
+) -> List[Tuple[torch.Tensor, torch.Tensor, List[str]]]:
+    """
+    `predict` for several captions in one forward pass: `images` is either one image tensor grounded
+    against every caption, or a list with one image per caption (padded to a common size). Thresholding
+    stays on the device; only the surviving detections and their token masks are copied back. Returns
+    one (boxes, logits, phrases) tuple per caption, as `predict` does.
+    """
+    captions = [preprocess_caption(caption=caption) for caption in captions]
+    model = _model_on(model, device)
+
+    if isinstance(images, torch.Tensor):
+        samples = images.to(device)[None].expand(len(captions), *images.shape)
     else:
-        phrases = [
-            get_phrases_from_posmap(logit > text_threshold, tokenized, tokenizer).replace('.', '')
-            for logit
-            in logits
-        ]
+        samples = nested_tensor_from_tensor_list([image.to(device) for image in images])
 
-    return boxes, logits.max(dim=1)[0], phrases
+    with torch.no_grad():
+        outputs = model(samples, captions=captions)
+
+    prediction_logits = outputs["pred_logits"].sigmoid()  # (len(captions), nq, 256)
+    prediction_boxes = outputs["pred_boxes"]  # (len(captions), nq, 4)
+    scores, max_idx = prediction_logits.max(dim=-1)
+    mask = scores > box_threshold
+    posmap = prediction_logits > text_threshold
+
+    results = []
+    for i, caption in enumerate(captions):
+        keep = mask[i]
+        boxes = prediction_boxes[i][keep].cpu()
+        logits = scores[i][keep].cpu()
+        token_masks = posmap[i][keep].cpu()
+        strongest = max_idx[i][keep].tolist()
+
+        spans = caption_map(model.tokenizer, caption)
+        phrases = []
+        for token_mask, strongest_idx in zip(token_masks, strongest):
+            left_idx, right_idx = spans.span(strongest_idx) if remove_combined else (0, 255)
+            token_idx = [j for j in token_mask.nonzero(as_tuple=True)[0].tolist() if left_idx < j < right_idx]
+            phrases.append(spans.phrase(token_idx))
+        results.append((boxes, logits, phrases))
+    return results
 
 
 def annotate(image_source: np.ndarray, boxes: torch.Tensor, logits: torch.Tensor, phrases: List[str]) -> np.ndarray:
@@ -7,7 +7,8 @@ from collections import defaultdict
 import shortuuid
 from torchvision.ops import box_convert
 import torch
-from models.utils import compute_iou
+from transformers.generation.decode_profiler import decode_profiler
+from models.utils import compute_iou, to_pixel_box, crop_image
 
 # use GroundingDINO in decoder_zoo
 from decoder_zoo.GroundingDINO.groundingdino.util.inference import (
@@ -15,6 +16,7 @@ from decoder_zoo.GroundingDINO.groundingdino.util.inference import (
     load_image,
     transform_loaded_image,
     predict,
+    predict_batch,
 )
 
 # use GroundingDINO from pip install
@@ -57,7 +59,8 @@ def extract_detection(
         np.clip(xyxy / np.array([w, h, w, h]), 0.0, 1.0), 3
     ).tolist()
 
-    os.makedirs(cache_dir, exist_ok=True)
+    if debugger:
+        os.makedirs(cache_dir, exist_ok=True)
 
     for entity, box, norm_box in zip(phrases, xyxy, normed_xyxy):
         # filter out too small object
@@ -70,15 +73,17 @@ def extract_detection(
         if in_dict(global_entity_dict, norm_box):
             continue
 
-        # add instance, including the cropped_pic & its original bbox
-        crop_id = shortuuid.uuid()
-        crop_img = Image.fromarray(image_source).crop(box)
-        crop_path = os.path.join(cache_dir, f"{crop_id}.png")
+        # add instance, including the crop region in the decoded image & its original bbox.
+        # the crop itself is only materialized (and saved) in debug mode.
+        crop_box = to_pixel_box(box, w, h)
         if debugger:
-            crop_img.save(crop_path)
+            crop_id = shortuuid.uuid()
+            crop_path = os.path.join(cache_dir, f"{crop_id}.png")
+            crop_image(image_source, crop_box).save(crop_path)
+            global_entity_dict[entity]["crop_path"].append(crop_path)
 
         global_entity_dict[entity]["total_count"] += 1
-        global_entity_dict[entity]["crop_path"].append(crop_path)
+        global_entity_dict[entity]["crop_box"].append(crop_box)
         global_entity_dict[entity]["bbox"].append(
             norm_box
         )  # [x1, y1, x2, y2] coordinate of left-top and right-bottom corner
@@ -87,6 +92,10 @@ def extract_detection(
 
 
 def find_most_similar_strings(nlp, source_strings, target_strings):
+    # a phrase that is one of the targets maps to itself; the rest are parsed once each.
+    unmatched = {source_str for source_str in source_strings if source_str not in target_strings}
+    if len(unmatched) == 0:
+        return list(source_strings)
     target_docs = [nlp(text) for text in target_strings]
 
     def find_most_similar(source_str):
@@ -98,7 +107,8 @@ def find_most_similar_strings(nlp, source_strings, target_strings):
         most_similar_doc = max(similarities, key=lambda item: item[1])[0]
         return most_similar_doc.text
 
-    result = [find_most_similar(source_str) for source_str in source_strings]
+    matched = {source_str: find_most_similar(source_str) for source_str in unmatched}
+    result = [matched.get(source_str, source_str) for source_str in source_strings]
 
     return result
 
@@ -115,8 +125,12 @@ class Detector:
             {
                 total_count: detected counts of that obj.
 
-                crop_path: a list of str, denoting the path to cached intermediate file, i.e., cropped out region of that obj.
+                crop_box: a list of [x1, y1, x2, y2] pixel boxes, i.e., cropped out region of that obj
+                    in the decoded image, which is kept in sample['image_source'].
                     Note: if total_count > 1, may use the whole image in the following steps.
+
+                crop_path: a list of str, denoting the path to cached intermediate file of each crop.
+                    Only filled in debug mode.
             }
     """
 
@@ -128,23 +142,107 @@ class Detector:
         self.args = args
         self.nlp = spacy.load("en_core_web_sm")
         self.debugger = debugger
+        # the same image is grounded once per noun during decoding, so keep its decoded copy.
+        self.image_cache = (None, None, None)
 
-    def detect_objects(self, sample: Dict):
-        img_path = sample["img_path"]
-        extracted_entities = sample["named_entity"]
+    def load_source(self, img_path):
         # check whether img_pah is a string
         if isinstance(img_path, str):
-            image_source, image = load_image(img_path)
+            if self.image_cache[0] != img_path:
+                self.image_cache = (img_path, *load_image(img_path))
+            _, image_source, image = self.image_cache
         elif isinstance(img_path, torch.Tensor):
             image_source = img_path
             image = transform_loaded_image(image_source)
         else:
             raise ValueError("img_path should be a string or a torch.Tensor.")
+        return image_source, image
+
+    def vocabulary_prompts(self, groups):
+        """
+        Pack `groups` (lists of synonymous phrases) into as few multi-phrase prompts as the text encoder
+        takes (max_text_len tokens, longer captions are truncated), keeping every group in one prompt.
+        """
+        tokenizer = self.model.tokenizer
+        budget = self.model.max_text_len - 2  # [CLS] and [SEP]
+        prompts, current, used = [], [], 0
+        for group in groups:
+            # each phrase is followed by a " ." separator.
+            length = len(tokenizer(" . ".join(group) + " .", add_special_tokens=False)["input_ids"])
+            if current and used + length > budget:
+                prompts.append(current)
+                current, used = [], 0
+            current.append(group)
+            used += length
+        if current:
+            prompts.append(current)
+        return prompts
+
+    def detect_vocabulary(self, img_path, groups, box_threshold, area_threshold=AREA_THRESHOLD):
+        """
+        Ground all phrases of `groups` in one prompt, "cat . kitten . dog .". Each detection is assigned
+        to the phrase its strongest token belongs to. Returns one (phrase -> boxes, group boxes) pair per
+        group: the normalized [x1, y1, x2, y2] boxes detected as each phrase, and those of the whole
+        group for a phrase that was not detected by name. Boxes are deduplicated per phrase / group.
+        """
+        image_source, image = self.load_source(img_path)
+        phrases = [phrase for group in groups for phrase in group]
+        group_of = {}
+        for i, group in enumerate(groups):
+            for phrase in group:
+                group_of.setdefault(phrase, i)
+
+        with decode_profiler.timer("detector_forward"):
+            boxes, logits, labels = predict(
+                model=self.model,
+                image=image,
+                caption=" . ".join(phrases),
+                box_threshold=box_threshold,
+                text_threshold=TEXT_TRESHOLD,
+                remove_combined=True,
+            )
+
+        labels = [label.strip() for label in labels]
+        unmatched = [label for label in labels if label and label not in group_of]
+        if len(unmatched) > 0:
+            matched = dict(zip(unmatched, find_most_similar_strings(self.nlp, unmatched, phrases)))
+        label_phrases = [
+            label if label in group_of else matched[label] if label else None for label in labels
+        ]
+
+        def extract(keep, name):
+            keep = torch.tensor(keep, dtype=torch.long)
+            entity_dict = {name: {"total_count": 0, "crop_box": [], "crop_path": [], "bbox": []}}
+            entity_dict = extract_detection(
+                entity_dict,
+                boxes[keep],
+                [name] * len(keep),
+                image_source,
+                self.cache_dir,
+                {"area_threshold": area_threshold},
+                self.debugger,
+            )
+            return entity_dict[name]["bbox"]
+
+        grounded = []
+        for i, group in enumerate(groups):
+            phrase_boxes = {}
+            for phrase in group:
+                keep = [j for j, p in enumerate(label_phrases) if p == phrase]
+                phrase_boxes[phrase] = extract(keep, phrase) if len(keep) > 0 else []
+            keep = [j for j, p in enumerate(label_phrases) if p is not None and group_of[p] == i]
+            grounded.append((phrase_boxes, extract(keep, group[0])))
+        return grounded
+
+    def detect_objects(self, sample: Dict):
+        extracted_entities = sample["named_entity"]
+        image_source, image = self.load_source(sample["img_path"])
 
         global_entity_dict = (
             {}
-        )  # key=entity type name. value = {'total_count':int, 'crop_path':list, 'bbox':list of list(4-ele).}
+        )  # key=entity type name. value = {'total_count':int, 'crop_box':list, 'crop_path':list, 'bbox':list of list(4-ele).}
         global_entity_list = []  # save all the entity type name for each sentence.
+        entity_strs = []
         for entity_str in extracted_entities:
             # border case: nothing to extract
             if "none" in entity_str.lower():
@@ -152,25 +250,29 @@ class Detector:
             entity_list = entity_str.split(".")
             for ent in entity_list:
                 global_entity_dict.setdefault(ent, {}).setdefault("total_count", 0)
+                global_entity_dict.setdefault(ent, {}).setdefault("crop_box", [])
                 global_entity_dict.setdefault(ent, {}).setdefault("crop_path", [])
                 global_entity_dict.setdefault(ent, {}).setdefault("bbox", [])
 
             global_entity_list.append(entity_list)
+            entity_strs.append(entity_str)
 
-            boxes, logits, phrases = predict(
-                model=self.model,
-                image=image,
-                caption=entity_str,
-                box_threshold=sample["box_threshold"]
-                if "box_threshold" in sample
-                else BOX_TRESHOLD,
-                text_threshold=TEXT_TRESHOLD,
-                # device='cuda:0'
-            )
-
-            # print("logits", logits)
-            # print("phrases", phrases)
+        # all entity strings of the sample are grounded in one forward pass.
+        if len(entity_strs) > 0:
+            with decode_profiler.timer("detector_forward"):
+                predictions = predict_batch(
+                    model=self.model,
+                    images=image,
+                    captions=entity_strs,
+                    box_threshold=sample["box_threshold"]
+                    if "box_threshold" in sample
+                    else BOX_TRESHOLD,
+                    text_threshold=TEXT_TRESHOLD,
+                )
+        else:
+            predictions = []
 
+        for entity_list, (boxes, logits, phrases) in zip(global_entity_list, predictions):
             phrases = find_most_similar_strings(self.nlp, phrases, entity_list)
             global_entity_dict = extract_detection(
                 global_entity_dict, boxes, phrases, image_source, self.cache_dir, sample, self.debugger
@@ -178,4 +280,5 @@ class Detector:
 
         sample["entity_info"] = global_entity_dict
         sample["entity_list"] = global_entity_list
+        sample["image_source"] = image_source  # decoded once, crops are taken from it downstream.
         return sample
@@ -1,31 +1,32 @@
 import random
+import time
 import numpy as np
 import torch
 import json
-from decoder_zoo.HALC.context_density.detector import Detector
-from transformers import Owlv2Processor, Owlv2ForObjectDetection, AutoTokenizer, AutoModelForCausalLM
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 from types import SimpleNamespace
 from PIL import Image, ImageDraw
-import spacy
 from torch.nn import functional as F
-from transformers import CLIPProcessor, CLIPModel
-from transformers import BlipProcessor, BlipModel
+from transformers.generation.decode_profiler import decode_profiler
 import random
-from transformers import CLIPConfig, CLIPTextConfig, CLIPVisionConfig
 from PIL import Image, ImageFilter
-import hpsv2
-from mplug_owl2.mm_utils import (
-    process_images,
-    tokenizer_image_token,
-    get_model_name_from_path,
-    KeywordsStoppingCriteria,
-)
+
+# The detector (GroundingDINO / OWLv2), spaCy, the scorer (CLIP / BLIP / GPT-2 / HPSv2), the token vocab
+# and the mPLUG-Owl2 helpers are only imported and loaded on first use, see the cached properties of
+# halc_assistant: a run that never verifies a word does not pay for them.
 
 exempt_word_list = ["image", "side", "background", "feature", "features", "center", 
                     "left", "right", "scene", "view", "s", "Birthday", "detail", "red",
                     "white", "cat", "horse", "bus", "group", "manner", "her", "birds", 
                     "teddy", "stack", "cell", "toaster", "mirror", "captures"]
 
+# token_classes flags
+WORD_START = 1  # the token starts a new word, i.e. completes the one before it (see check_word_complete)
+VERIFY_CANDIDATE = 2  # as a one-token word, the token would be verified (see entity_pos)
+
 add_word_list = ["sink", "microwave", "toaster", "puppy", "bottle", "table", "oven", 
                 "orange", "toothbrush", "cars"]
 
@@ -38,37 +39,23 @@ class halc_assistant:
         halc_params=None,
         max_new_tokens=64,
     ):
-        # initialize detector
+        # detector settings; the detector itself is built on first use.
         args_dict = {
             "detector_config": "decoder_zoo/GroundingDINO/groundingdino/config/GroundingDINO_SwinT_OGC.py",
             "detector_model_path": "decoder_zoo/GroundingDINO/weights/groundingdino_swint_ogc.pth",
             "cache_dir": "decoder_zoo/HALC/cache_dir",
             "device": device,
         }
-        model_args = SimpleNamespace(**args_dict)
+        self.detector_args = SimpleNamespace(**args_dict)
         self.device = device
         self.debugger = halc_params["debugger"]
-        halc_detector = halc_params["detector"]
-        if halc_detector == "dino":
-            self.detector = Detector(model_args, self.debugger)
-        elif halc_detector == "owlv2":
-            self.owlv2_processor = Owlv2Processor.from_pretrained(
-                "google/owlv2-base-patch16-ensemble"
-            )
-            self.owlv2_model = Owlv2ForObjectDetection.from_pretrained(
-                "google/owlv2-base-patch16-ensemble"
-            )
-        else:
+        if halc_params["detector"] not in ["dino", "owlv2"]:
             raise ValueError("Invalid detector!")
 
         self.vis_processor = vis_processor
         self.model = model
 
         self.box_threshold = halc_params["box_threshold"]
-        self.tagging = spacy.load("en_core_web_sm")
-        # self.tagging_sm = spacy.load("en_core_web_sm")
-        # self.tagging_md = spacy.load("en_core_web_md")
-        # self.tagging_lg = spacy.load("en_core_web_md")
         self.halc_params = halc_params
         self.k_candidate_num = halc_params["k_candidate_num"]
         # self.original_image = None
@@ -76,7 +63,29 @@ class halc_assistant:
         self.max_new_tokens = max_new_tokens
 
         self.max_handle_box = 3
-        self.skip_rate = 0.5
+        self.grounding_cache = {}
+        # pre-grounding: in-vocabulary words are grounded prompt by prompt over the whole vocabulary,
+        # once per image, and looked up afterwards; other words still run the detector on their own.
+        self.pre_ground = halc_params.get("pre_ground", False)
+        self.pre_ground_vocab = halc_params.get(
+            "pre_ground_vocab", os.path.join(os.path.dirname(__file__), "grounding_vocab.txt")
+        )
+        self.pre_grounded = {}
+        # async grounding: detection and crop embedding run on a background worker, see prefetch_grounding.
+        self.async_grounding = halc_params.get("async_grounding", False)
+        self.grounding_futures = {}
+        # beam -> key of its latest prefetch guess, see prefetch_grounding
+        self.prefetch_guesses = {}
+        self.reset_grounding_stats()
+        # a noun is skipped with probability skip_rate, drawn from a generator seeded per image with
+        # (skip_seed, image). The per-request limits (verifications, deadline) come from the DecodeBudget
+        # the HALC decoders hand over for the duration of a generate() call, see budget_spent.
+        self.skip_rate = halc_params.get("skip_rate", 0.5)
+        self.skip_seed = halc_params.get("skip_seed", 0)
+        self.decode_budget = None
+        self.reset_verification_budget()
+        # normalised entity -> pos as entity_pos returns it
+        self.entity_pos_cache = {}
 
         self.exempt_word_list = exempt_word_list
         self.add_word_list = add_word_list
@@ -85,64 +94,209 @@ class halc_assistant:
 
         if self.model_backbone == "minigpt4" or self.model_backbone == "llava-1.5":
             self.tokenizer = self.model.llama_tokenizer
-            token_vocab_dir = "decoder_zoo/HALC/context_density/llama_tokenizer.json"
+            self.token_vocab_dir = "decoder_zoo/HALC/context_density/llama_tokenizer.json"
         elif self.model_backbone == "instructblip":
             self.tokenizer = self.model.llm_tokenizer
-            token_vocab_dir = "decoder_zoo/HALC/context_density/vicuna_tokenizer.json"
+            self.token_vocab_dir = "decoder_zoo/HALC/context_density/vicuna_tokenizer.json"
         elif self.model_backbone == "mplug-owl2":
             self.tokenizer = self.model.llm_tokenizer
-            token_vocab_dir = "decoder_zoo/HALC/context_density/llama_tokenizer.json"
+            self.token_vocab_dir = "decoder_zoo/HALC/context_density/llama_tokenizer.json"
 
-        with open(token_vocab_dir, "r") as f:
-            self.token_vocab = json.load(f)
+        score_type = halc_params["score_type"]
+        if score_type not in ["CLIP", "BLIP", "Random", "Perplexity", "HPSv2"]:
+            raise ValueError("Invalid score type!")
+        self.score_type = score_type
 
-        self.token_vocab = self.token_vocab["model"]["vocab"]
+    @cached_property
+    def detector(self):
+        from decoder_zoo.HALC.context_density.detector import Detector
 
-        self.token_vocab = {value: key for key, value in self.token_vocab.items()}
+        return Detector(self.detector_args, self.debugger)
+
+    @cached_property
+    def owlv2_processor(self):
+        from transformers import Owlv2Processor
+
+        return Owlv2Processor.from_pretrained("google/owlv2-base-patch16-ensemble")
+
+    @cached_property
+    def owlv2_model(self):
+        from transformers import Owlv2ForObjectDetection
+
+        return Owlv2ForObjectDetection.from_pretrained("google/owlv2-base-patch16-ensemble")
+
+    @cached_property
+    def tagging(self):
+        import spacy
+
+        return spacy.load("en_core_web_sm")
+
+    @cached_property
+    def token_vocab(self):
+        with open(self.token_vocab_dir, "r") as f:
+            token_vocab = json.load(f)
+        token_vocab = token_vocab["model"]["vocab"]
+        return {value: key for key, value in token_vocab.items()}
+
+    @cached_property
+    def token_classes(self):
+        """
+        uint8 flags per token id (WORD_START, VERIFY_CANDIDATE), so the decode loops classify the token
+        they just generated with a lookup instead of decoding and tagging it. VERIFY_CANDIDATE is exact for
+        one-token words; tokens that do not start a word are left as candidates. Tagging every word-start
+        token takes one spaCy pass over the vocabulary, cached under cache_dir.
+        """
+        key = json.dumps([self.token_vocab_dir, self.exempt_word_list, self.add_word_list])
+        cache_path = os.path.join(
+            self.detector_args.cache_dir, "token_classes_" + hashlib.md5(key.encode()).hexdigest()[:16] + ".pt"
+        )
+        if os.path.exists(cache_path):
+            return torch.load(cache_path)
+
+        classes = torch.full((max(self.token_vocab) + 1,), VERIFY_CANDIDATE, dtype=torch.uint8)
+        words = {}
+        for token_id, piece in self.token_vocab.items():
+            if "▁" in piece or "." in piece or token_id == 2:
+                classes[token_id] = WORD_START
+                word = self.normalize_entity(self.get_last_word([token_id]))
+                words.setdefault(word, []).append(token_id)
+        for word, doc in zip(words, self.tagging.pipe(words)):
+            if self.entity_pos(word, doc) in ["NOUN", "PROPN", "ADD"]:
+                classes[words[word]] |= VERIFY_CANDIDATE
+
+        os.makedirs(self.detector_args.cache_dir, exist_ok=True)
+        torch.save(classes, cache_path)
+        return classes
+
+    @cached_property
+    def scorer(self):
+        # (score_model, score_processor, score_tokenizer) of self.score_type.
+        if self.score_type == "CLIP":
+            from transformers import CLIPProcessor, CLIPModel
+            from transformers import CLIPConfig, CLIPTextConfig, CLIPVisionConfig
 
-        score_type = halc_params["score_type"]
-        if score_type == "CLIP":
-            self.score_type = "CLIP"
             if self.max_new_tokens > 77:
                 config_text = CLIPTextConfig(max_position_embeddings=self.max_new_tokens)
                 config_vision = CLIPVisionConfig()
                 config = CLIPConfig.from_text_vision_configs(config_text, config_vision)
-                self.score_model = CLIPModel.from_pretrained(
+                score_model = CLIPModel.from_pretrained(
                     "openai/clip-vit-base-patch32",
                     config=config,
                     ignore_mismatched_sizes=True,
                 )
-                self.score_processor = CLIPProcessor.from_pretrained(
+                score_processor = CLIPProcessor.from_pretrained(
                     "openai/clip-vit-base-patch32",
                     config=config,
                     ignore_mismatched_sizes=True,
                 )
             else:
-                self.score_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-                self.score_processor = CLIPProcessor.from_pretrained(
+                score_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
+                score_processor = CLIPProcessor.from_pretrained(
                     "openai/clip-vit-base-patch32"
                 )
-        elif score_type == "BLIP":
-            self.score_type = "BLIP"
-            self.score_model = BlipModel.from_pretrained("Salesforce/blip-image-captioning-large")
-            self.score_processor = BlipProcessor.from_pretrained(
+            return score_model, score_processor, None
+        elif self.score_type == "BLIP":
+            from transformers import BlipProcessor, BlipModel
+
+            score_model = BlipModel.from_pretrained("Salesforce/blip-image-captioning-large")
+            score_processor = BlipProcessor.from_pretrained(
                 "Salesforce/blip-image-captioning-large"
             )
-        elif score_type == "Random":
-            self.score_type = "Random"
-            self.score_model = None
-            self.score_processor = None
-        elif score_type == "Perplexity":
-            self.score_type = "Perplexity"
-            self.score_processor = None
-            self.score_tokenizer = AutoTokenizer.from_pretrained("openai-community/gpt2")
-            self.score_model = AutoModelForCausalLM.from_pretrained("openai-community/gpt2", device_map="auto")
-        elif score_type == "HPSv2":
-            self.score_type = "HPSv2"
-            self.score_model = hpsv2
-            self.score_processor = None
+            return score_model, score_processor, None
+        elif self.score_type == "Perplexity":
+            from transformers import AutoTokenizer, AutoModelForCausalLM
+
+            score_tokenizer = AutoTokenizer.from_pretrained("openai-community/gpt2")
+            score_model = AutoModelForCausalLM.from_pretrained("openai-community/gpt2", device_map="auto")
+            return score_model, None, score_tokenizer
+        elif self.score_type == "HPSv2":
+            import hpsv2
+
+            return hpsv2, None, None
+        return None, None, None
+
+    @cached_property
+    def grounding_vocab(self):
+        """
+        (prompts, phrase -> (prompt index, group index)) of the pre-grounding vocabulary. `pre_ground_vocab`
+        is a file with one comma-separated group of synonyms per line (default: the COCO categories with
+        the CHAIR synonyms) or a list of groups; add_word_list is appended.
+        """
+        vocab = self.pre_ground_vocab
+        if isinstance(vocab, str):
+            with open(vocab, "r") as f:
+                vocab = [line.split(",") for line in f if line.strip()]
+        groups = []
+        for group in vocab:
+            group = [group] if isinstance(group, str) else group
+            groups.append([phrase.strip().lower() for phrase in group if phrase.strip()])
+        known = {phrase for group in groups for phrase in group}
+        groups += [[word] for word in self.add_word_list if word not in known]
+
+        if self.halc_params["detector"] == "dino":
+            prompts = self.detector.vocabulary_prompts(groups)
         else:
-            raise ValueError("Invalid score type!")
+            prompts = [groups[i : i + 16] for i in range(0, len(groups), 16)]
+        phrase_index = {}
+        for i, prompt in enumerate(prompts):
+            for j, group in enumerate(prompt):
+                for phrase in group:
+                    phrase_index.setdefault(phrase, (i, j))
+        return prompts, phrase_index
+
+    def pre_grounded_boxes(self, entity):
+        """
+        Boxes of an in-vocabulary `entity` in the current image, or None for an out-of-vocabulary one.
+        These are the boxes detected as `entity` itself ("man" does not get the boxes of "woman"); only
+        when it was not detected by name does it fall back to the boxes of its synonym group.
+        The prompt holding it is run on first use only, so an image pays for the prompts it needs.
+        """
+        prompts, phrase_index = self.grounding_vocab
+        if entity.lower() not in phrase_index:
+            return None
+        prompt_index, group_index = phrase_index[entity.lower()]
+        if prompt_index not in self.pre_grounded:
+            with decode_profiler.timer("detector_vocabulary"):
+                if self.halc_params["detector"] == "dino":
+                    self.pre_grounded[prompt_index] = self.detector.detect_vocabulary(
+                        self.detector_dict["img_path"], prompts[prompt_index], self.box_threshold
+                    )
+                else:
+                    self.pre_grounded[prompt_index] = self.owlv2_detect_vocabulary(prompts[prompt_index])
+        phrase_boxes, group_boxes = self.pre_grounded[prompt_index][group_index]
+        return phrase_boxes.get(entity.lower()) or group_boxes
+
+    def owlv2_detect_vocabulary(self, groups):
+        # OWLv2 takes every phrase as its own text query of the same forward pass.
+        phrases = [phrase for group in groups for phrase in group]
+        group_of = [i for i, group in enumerate(groups) for _ in group]
+        owlv2_inputs = self.owlv2_processor(
+            text=[phrases],
+            images=self.image_to_ground,
+            return_tensors="pt",
+        )
+        owlv2_outputs = self.owlv2_model(**owlv2_inputs)
+        results = self.owlv2_processor.post_process_object_detection(
+            outputs=owlv2_outputs, threshold=0.05
+        )
+        grounded = [({phrase: [] for phrase in group}, []) for group in groups]
+        for box, label in zip(results[0]["boxes"].cpu().numpy().tolist(), results[0]["labels"].tolist()):
+            phrase_boxes, group_boxes = grounded[group_of[label]]
+            phrase_boxes[phrases[label]].append(box)
+            group_boxes.append(box)
+        return grounded
+
+    @property
+    def score_model(self):
+        return self.scorer[0]
+
+    @property
+    def score_processor(self):
+        return self.scorer[1]
+
+    @property
+    def score_tokenizer(self):
+        return self.scorer[2]
 
 
     def calculate_perplexity(self, text):
@@ -153,35 +307,58 @@ class halc_assistant:
         loss, logits = outputs[:2]
         return torch.exp(loss).item()
 
-    def update_input(self, img_path, input_prompt):
+    def update_input(self, img_path, input_prompt, raw_image=None):
         # print("img_path", img_path)
+        self.drain_grounding()
         self.detector_dict = {"img_path": img_path}
-        self.image_to_ground = Image.open(img_path)
+        # decode once per image; every grounded word crops from this copy.
+        # raw_image lets a prefetching loader hand over its already decoded copy.
+        if raw_image is None:
+            raw_image = Image.open(img_path).convert("RGB")
+        self.image_to_ground = raw_image
         self.prompt = input_prompt
         self.original_image = img_path
+        # (entity, context_window) -> (embeds_list, status, context_bbox_index), see context_density_embedding
+        self.grounding_cache = {}
+        self.pre_grounded = {}
+        self.reset_verification_budget(img_path)
 
     def reset_info(self):
+        self.drain_grounding()
         self.detector_dict = None
         self.image_to_ground = None
         self.prompt = None
         self.original_image = None
         self.grounded_check = False
+        self.grounding_cache = {}
+        self.pre_grounded = {}
+        self.reset_verification_budget()
+
+    def reset_verification_budget(self, img_path=None):
+        # str seeds are hashed deterministically, so the draws only depend on the seed and the image.
+        self.skip_rng = random.Random("{}:{}".format(self.skip_seed, img_path))
+
+    def budget_spent(self):
+        return self.decode_budget is not None and self.decode_budget.exhausted()
 
     def check_word_complete(self, input_id):
         if isinstance(input_id, torch.Tensor):
             input_id = input_id.cpu().numpy().tolist()
-            
-        # print("input_id", input_id)
-        # if input_id[0][0] == -1:
-        #     return True
-        final_tokens = self.token_vocab[input_id[0][0]]
-        # print("final_tokens", final_tokens)
-        if "▁" in final_tokens or "." in final_tokens or input_id[0][0] == 2:
-            last_word_flag = True
-        else:
-            last_word_flag = False
 
-        return last_word_flag
+        return bool(self.token_classes[input_id[0][0]] & WORD_START)
+
+    def is_verify_candidate(self, input_ids):
+        """
+        Gate of the decode loops, before the word made of `input_ids` is decoded and tagged: False if it
+        will not be verified, i.e. it is a one-token word outside VERIFY_CANDIDATE or the budget is spent.
+        Longer words are left to context_density_embedding.
+        """
+        if self.budget_spent() or (
+            len(input_ids) == 1 and not self.token_classes[input_ids[0]] & VERIFY_CANDIDATE
+        ):
+            self.grounding_stats["gated"] += 1
+            return False
+        return True
 
     def get_last_word(self, input_ids):
         output_text = self.tokenizer.decode(input_ids, skip_special_tokens=True)
@@ -263,58 +440,24 @@ class halc_assistant:
 
         return jsd
 
-    def context_density_embedding(self, entity):
+    def context_density_embedding(self, entity, context_window=None):
         # context_window specifies the number of context windows
 
-        context_window = self.halc_params["context_window"]
+        if context_window is None:
+            context_window = self.halc_params["context_window"]
         expand_ratio = self.halc_params["expand_ratio"]
 
-        entity = entity.strip(".").strip(",").strip("'").strip("]").strip("[").strip(")")
-        if len(entity) > 0:
-            if entity[-1] == "s":
-                entity = entity[:-1]
-
-        doc = self.tagging(entity)
-        # doc_sm = self.tagging_sm(entity)
-        # doc_md = self.tagging_md(entity)
-        # doc_lg = self.tagging_lg(entity)
-        detect_info = {}
-
-        # print("entity", entity)
-        if len(doc) < 1:
-            detect_info["pos"] = "PUNC"
-            # detect_info["pos_sm"] = "PUNC"
-            # detect_info["pos_md"] = "PUNC"
-            # detect_info["pos_lg"] = "PUNC"
-        else:
-            detect_info["pos"] = doc[0].pos_
+        entity = self.normalize_entity(entity)
 
-            # detect_info["pos_sm"] = doc_sm[0].pos_
-            # detect_info["pos_md"] = doc_md[0].pos_
-            # detect_info["pos_lg"] = doc_lg[0].pos_
-            
-        # add a random filter to halc verification
+        detect_info = {"pos": self.entity_pos(entity)}
 
-        
-        if "." in entity or "," in entity:
+        # random filter to halc verification; ADD words are always verified.
+        if detect_info["pos"] in ["NOUN", "PROPN"] and self.skip_rng.random() < self.skip_rate:
             detect_info["pos"] = "SKIP"
-        if entity in self.exempt_word_list:
-            detect_info["pos"] = "SKIP"
-        if random.random() < self.skip_rate:
-            detect_info["pos"] = "SKIP"
-        #     detect_info["pos_sm"] = "SKIP"
-        #     detect_info["pos_md"] = "SKIP"
-        #     detect_info["pos_lg"] = "SKIP"
-
-        if entity in self.add_word_list:
-            detect_info["pos"] = "ADD"
-            # detect_info["pos_sm"] = "ADD"
-        #     detect_info["pos_md"] = "ADD"
-        #     detect_info["pos_lg"] = "ADD"
-
-
-        # print("ENTITY: ", entity)
-        # print("pos", detect_info["pos"])
+            self.grounding_stats["skipped"] += 1
+        if detect_info["pos"] in ["NOUN", "PROPN", "ADD"] and self.budget_spent():
+            detect_info["pos"] = "BUDGET"
+            self.grounding_stats["over_budget"] += 1
 
         valid_list = ["NOUN", "PROPN", "ADD"] #, "ADJ"]
 
@@ -322,167 +465,346 @@ class halc_assistant:
 
         # if detect_info["pos_sm"] in valid_list or detect_info["pos_md"] in valid_list or detect_info["pos_lg"] in valid_list:
         if detect_info["pos"] in valid_list:
-            detect_info["status"] = "activated"
-            self.detector_dict["named_entity"] = [entity]
-            self.detector_dict["box_threshold"] = self.box_threshold
+            self.grounding_stats["verified"] += 1
+            decode_profiler.count("halc_verifications")
+            # detection, crops and their embeddings only depend on the entity (image and prompt are fixed
+            # between update_input calls), so beams and later steps grounding it again reuse them.
+            embeds_list, detect_info["status"], context_bbox_index = self.grounding_result(
+                entity, context_window, expand_ratio
+            )
+            if detect_info["status"] != "invalid":
+                self.grounded_check = True
+                if context_bbox_index is not None:
+                    self.target_bbox_index = context_bbox_index
+        else:
+            detect_info["status"] = "invalid"
+            embeds_list = None
+
+        return embeds_list, detect_info
 
-            if self.halc_params["detector"] == "dino":
+    def entity_pos(self, entity, doc=None):
+        """
+        Part of speech of a normalised entity as the verification filter sees it: SKIP for punctuation and
+        exempt words, ADD for add_word_list, else spaCy's tag of its first token (PUNC if none). `doc` is
+        a precomputed spaCy doc of the entity, see token_classes.
+        """
+        if entity in self.entity_pos_cache:
+            return self.entity_pos_cache[entity]
+        if entity in self.add_word_list:
+            pos = "ADD"
+        elif "." in entity or "," in entity or entity in self.exempt_word_list:
+            pos = "SKIP"
+        else:
+            if doc is None:
+                with decode_profiler.timer("pos_tagging"):
+                    doc = self.tagging(entity)
+            pos = doc[0].pos_ if len(doc) > 0 else "PUNC"
+        self.entity_pos_cache[entity] = pos
+        return pos
+
+    def normalize_entity(self, entity):
+        entity = entity.strip(".").strip(",").strip("'").strip("]").strip("[").strip(")")
+        if len(entity) > 0:
+            if entity[-1] == "s":
+                entity = entity[:-1]
+        return entity
+
+    def grounding_result(self, entity, context_window, expand_ratio):
+        """
+        (embeds_list, status, context_bbox_index) of `entity`, from the cache, from a prefetch submitted
+        earlier (waiting for it if still running) or grounded now. In async mode all grounding runs on the
+        single worker, so it never races with a prefetch.
+        """
+        key = (entity, context_window)
+        if key in self.grounding_cache:
+            self.grounding_stats["cache_hits"] += 1
+            return self.grounding_cache[key]
+
+        # a verification is charged once per entity of the caption: beams and later steps checking the
+        # same entity reuse the cached result for free.
+        if self.decode_budget is not None:
+            self.decode_budget.charge("verifications")
+        start = time.perf_counter()
+        future = self.grounding_futures.pop(key, None)
+        if future is not None and not future.cancelled():
+            self.grounding_stats["prefetch_hits"] += 1
+            if not future.done():
+                self.grounding_stats["prefetch_waits"] += 1
+            result = future.result()
+        elif self.async_grounding:
+            result = self.grounding_executor.submit(
+                self.ground_on_worker, entity, context_window, expand_ratio
+            ).result()
+        else:
+            result = self.ground_entity(entity, context_window, expand_ratio)
+        # decode-loop time spent blocked on grounding; with prefetching it only covers what did not overlap.
+        self.grounding_stats["blocking_time"] += time.perf_counter() - start
+        self.grounding_stats["grounded"] += 1
+
+        if self.grounding_stream is not None and result[0] is not None:
+            # the crops were embedded on the worker's stream; keep their memory alive for this one.
+            for embeds in result[0]:
+                embeds.record_stream(torch.cuda.current_stream())
+        self.grounding_cache[key] = result
+        return result
+
+    def prefetch_grounding(self, entity, context_window=None, beam=0):
+        """
+        Async mode: start grounding the word being decoded on the background worker, speculating that it
+        ends with the token just generated. If it does, context_density_embedding finds the detector,
+        crops and crop embeddings ready (or in flight) instead of running them while the LLM waits; if
+        the word goes on, the request is dropped. The seeded skip draw stays in context_density_embedding,
+        so the decoded text is the same as in sync mode.
+        Guesses are kept per `beam`: a new guess only drops the previous guess of the same beam, so the
+        beams of halc_dola_beam_search do not cancel each other's. A guess that ran but was never used is
+        counted as "prefetch_wasted" (worker time taken from the LLM), see drain_grounding.
+        """
+        if context_window is None:
+            context_window = self.halc_params["context_window"]
+        entity = self.normalize_entity(entity)
+        key = (entity, context_window)
+
+        # the beam's word went on: drop its previous guess if it has not started yet and no other beam
+        # still guesses the same word.
+        previous = self.prefetch_guesses.get(beam)
+        self.prefetch_guesses[beam] = key
+        if previous is not None and previous != key and previous not in self.prefetch_guesses.values():
+            pending = self.grounding_futures.get(previous)
+            if pending is not None and pending.cancel():
+                del self.grounding_futures[previous]
+                self.grounding_stats["prefetch_cancelled"] += 1
+
+        if key in self.grounding_cache or key in self.grounding_futures:
+            return
+        if self.budget_spent() or self.entity_pos(entity) not in ["NOUN", "PROPN", "ADD"]:
+            return
+        self.grounding_futures[key] = self.grounding_executor.submit(
+            self.ground_on_worker, entity, context_window, self.halc_params["expand_ratio"]
+        )
+        self.grounding_stats["prefetch_submitted"] += 1
+
+    @cached_property
+    def grounding_executor(self):
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix="halc-grounding")
+
+    @cached_property
+    def grounding_stream(self):
+        # the worker's kernels go to their own stream so they can overlap the LLM forward.
+        if self.async_grounding and torch.cuda.is_available():
+            return torch.cuda.Stream(device=self.device)
+        return None
+
+    def ground_on_worker(self, entity, context_window, expand_ratio):
+        start = time.perf_counter()
+        if self.grounding_stream is None:
+            result = self.ground_entity(entity, context_window, expand_ratio)
+        else:
+            with torch.cuda.stream(self.grounding_stream):
+                result = self.ground_entity(entity, context_window, expand_ratio)
+            self.grounding_stream.synchronize()
+        self.grounding_stats["worker_time"] += time.perf_counter() - start
+        return result
+
+    def drain_grounding(self):
+        # a prefetch still running reads the current image: let it finish before the input changes. The
+        # prefetches left here were never used: those that ran (or are running) are wasted.
+        for future in self.grounding_futures.values():
+            if not future.cancel():
+                self.grounding_stats["prefetch_wasted"] += 1
+                future.exception()
+            else:
+                self.grounding_stats["prefetch_cancelled"] += 1
+        self.grounding_futures = {}
+        self.prefetch_guesses = {}
+
+    def reset_grounding_stats(self):
+        self.grounding_stats = {
+            "grounded": 0,
+            "cache_hits": 0,
+            "blocking_time": 0.0,
+            "worker_time": 0.0,
+            "prefetch_submitted": 0,
+            "prefetch_hits": 0,
+            "prefetch_waits": 0,
+            "prefetch_cancelled": 0,
+            "prefetch_wasted": 0,
+            "verified": 0,
+            "skipped": 0,
+            "over_budget": 0,
+            "gated": 0,
+        }
+
+    def ground_entity(self, entity, context_window, expand_ratio):
+        """
+        Detect `entity`, crop the expanded context windows around it and embed all crops in one batch.
+        Returns (embeds_list, status, index of the window closest to the detected box).
+        """
+        status = "activated"
+        context_bbox_index = None
+        self.detector_dict["named_entity"] = [entity]
+        self.detector_dict["box_threshold"] = self.box_threshold
+
+        original_bbox = self.pre_grounded_boxes(entity) if self.pre_ground else None
+        if original_bbox is not None:
+            if self.debugger == 2:
+                print("Pre-grounded: ", entity, original_bbox)
+
+        elif self.halc_params["detector"] == "dino":
+            with decode_profiler.timer("detector"):
                 sample = self.detector.detect_objects(self.detector_dict)
 
-                if self.debugger == 2:
-                    print("Detection: ", sample)
-                # Assuming the first detected bounding box is the one related to the entity
-                try:
-                    original_bbox = sample["entity_info"][entity]["bbox"]
-                except:
-                    original_bbox = []
-
-                # print("original_bbox", original_bbox)
-
-            elif self.halc_params["detector"] == "owlv2":
-                # print("entity", entity)
-                img_path = self.detector_dict["img_path"]
-                # image_to_ground = Image.open(img_path)
-                entity_to_ground = [self.detector_dict["named_entity"]]
-                # entity_to_ground = [["a man hold a clock"]]
-                # print("texts", entity_to_ground)
-                # print("self.detector_dict", self.detector_dict)
+            if self.debugger == 2:
+                print("Detection: ", sample)
+            # Assuming the first detected bounding box is the one related to the entity
+            try:
+                original_bbox = sample["entity_info"][entity]["bbox"]
+            except:
+                original_bbox = []
+
+            # print("original_bbox", original_bbox)
+
+        elif self.halc_params["detector"] == "owlv2":
+            # print("entity", entity)
+            img_path = self.detector_dict["img_path"]
+            # image_to_ground = Image.open(img_path)
+            entity_to_ground = [self.detector_dict["named_entity"]]
+            # entity_to_ground = [["a man hold a clock"]]
+            # print("texts", entity_to_ground)
+            # print("self.detector_dict", self.detector_dict)
+            with decode_profiler.timer("detector"):
                 owlv2_inputs = self.owlv2_processor(
                     text=entity_to_ground,
                     images=self.image_to_ground,
                     return_tensors="pt",
                 )
                 owlv2_outputs = self.owlv2_model(**owlv2_inputs)
-                # Target image sizes (height, width) to rescale box predictions [batch_size, 2]
-                # target_sizes = torch.Tensor([self.image_to_ground.size[::-1]])
-                # Convert outputs (bounding boxes and class logits) to Pascal VOC Format (xmin, ymin, xmax, ymax)
-                # results = self.owlv2_processor.post_process_object_detection(outputs=owlv2_outputs, target_sizes=target_sizes, threshold=0.1)
+            # Target image sizes (height, width) to rescale box predictions [batch_size, 2]
+            # target_sizes = torch.Tensor([self.image_to_ground.size[::-1]])
+            # Convert outputs (bounding boxes and class logits) to Pascal VOC Format (xmin, ymin, xmax, ymax)
+            # results = self.owlv2_processor.post_process_object_detection(outputs=owlv2_outputs, target_sizes=target_sizes, threshold=0.1)
 
-                results = self.owlv2_processor.post_process_object_detection(
-                    outputs=owlv2_outputs, threshold=0.05
-                )
+            results = self.owlv2_processor.post_process_object_detection(
+                outputs=owlv2_outputs, threshold=0.05
+            )
 
-                # print("results: ", results)
-                original_bbox = results[0]["boxes"].cpu().numpy().tolist()
+            # print("results: ", results)
+            original_bbox = results[0]["boxes"].cpu().numpy().tolist()
 
-            if len(original_bbox) > self.max_handle_box:
-                detect_info["status"] = "invalid"
-                embeds_list = None
-                return embeds_list, detect_info
+        if len(original_bbox) > self.max_handle_box:
+            return None, "invalid", None
 
-            if len(original_bbox) == 0:
-                # target_bbox = [0.3, 0.3, 0.6, 0.6]
-                target_bbox = [0.2, 0.2, 0.8, 0.8]
-                detect_info["status"] = "not-detected"
-                # detect_info["status"] = "invalid"
-                # embeds_list = None
-                # return embeds_list, detect_info
-            else:
-                area_list = [
-                    (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) for bbox in original_bbox
-                ]
+        if len(original_bbox) == 0:
+            # target_bbox = [0.3, 0.3, 0.6, 0.6]
+            target_bbox = [0.2, 0.2, 0.8, 0.8]
+            status = "not-detected"
+            # detect_info["status"] = "invalid"
+            # embeds_list = None
+            # return embeds_list, detect_info
+        else:
+            area_list = [
+                (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) for bbox in original_bbox
+            ]
 
-                # get the index of the smallest bbox
-                target_bbox_index = area_list.index(min(area_list))
+            # get the index of the smallest bbox
+            target_bbox_index = area_list.index(min(area_list))
 
-                # target_bbox_index = area_list.index(max(area_list))
+            # target_bbox_index = area_list.index(max(area_list))
 
-                # target_bbox_index = sorted(
-                #     range(len(area_list)), key=lambda k: area_list[k]
-                # )[len(area_list) // 2]
+            # target_bbox_index = sorted(
+            #     range(len(area_list)), key=lambda k: area_list[k]
+            # )[len(area_list) // 2]
 
-                target_bbox = original_bbox[target_bbox_index]
+            target_bbox = original_bbox[target_bbox_index]
 
-            # target_bbox = original_bbox[0]
+        # target_bbox = original_bbox[0]
 
-            # Calculate expanded bounding boxes for the given context window
-            if context_window == 1:  # only the original one
-               
-                expanded_bboxes = [target_bbox]
+        # Calculate expanded bounding boxes for the given context window
+        if context_window == 1:  # only the original one
+           
+            expanded_bboxes = [target_bbox]
+        else:
+            # check on the target box's size
+            target_bbox_size = self.compute_bbox_size(target_bbox)
+            # smallest size should be 0.2
+
+            if expand_ratio > 0.8:
+                expanded_bboxes = [
+                    self.expand_bbox(target_bbox, -0.8),
+                    target_bbox,
+                ]
             else:
-                # check on the target box's size
-                target_bbox_size = self.compute_bbox_size(target_bbox)
-                # smallest size should be 0.2
-
-                if expand_ratio > 0.8:
-                    expanded_bboxes = [
-                        self.expand_bbox(target_bbox, -0.8),
-                        target_bbox,
-                    ]
-                else:
-                    expanded_bboxes = [
-                        self.expand_bbox(target_bbox, -expand_ratio),
-                        target_bbox,
-                    ]
-                all_box_sizes = [
-                    self.compute_bbox_size(expanded_bboxes[0]),
-                    self.compute_bbox_size(expanded_bboxes[1]),
+                expanded_bboxes = [
+                    self.expand_bbox(target_bbox, -expand_ratio),
+                    target_bbox,
                 ]
+            all_box_sizes = [
+                self.compute_bbox_size(expanded_bboxes[0]),
+                self.compute_bbox_size(expanded_bboxes[1]),
+            ]
 
-                for _ in range(1, context_window - 1):
-                    # Each expansion is double the size of the previous level
-                    expanded_bboxes.append(
-                        self.expand_bbox(expanded_bboxes[-1], expand_ratio)
-                    )
-                    all_box_sizes.append(
-                        self.compute_bbox_size(expanded_bboxes[-1])
-                    )
-
-                # index of the original target box
-                self.target_bbox_index = min(
-                    range(len(all_box_sizes)),
-                    key=lambda i: abs(all_box_sizes[i] - target_bbox_size),
+            for _ in range(1, context_window - 1):
+                # Each expansion is double the size of the previous level
+                expanded_bboxes.append(
+                    self.expand_bbox(expanded_bboxes[-1], expand_ratio)
+                )
+                all_box_sizes.append(
+                    self.compute_bbox_size(expanded_bboxes[-1])
                 )
 
+            # index of the original target box
+            context_bbox_index = min(
+                range(len(all_box_sizes)),
+                key=lambda i: abs(all_box_sizes[i] - target_bbox_size),
+            )
 
-            self.grounded_check = True
 
-            original_image = self.image_to_ground.convert("RGB")
+        original_image = self.image_to_ground
 
-            # Crop images to the expanded bounding boxes
-            cropped_images = []
-            for bbox in expanded_bboxes:
-                # print("bbox", bbox)
-                # Calculate the absolute coordinates of the bounding box
-                im_width, im_height = original_image.size
-                left = bbox[0] * im_width
-                top = bbox[1] * im_height
-                right = bbox[2] * im_width
-                bottom = bbox[3] * im_height
-
-                # Crop the image to the bounding box
-                cropped_image = original_image.crop((left, top, right, bottom))
-                cropped_images.append(cropped_image)
-
-            # cropped_images[1].save(f"/home/czr/HaLC/decoder_zoo/HALC/cache_image/cropped_{entity}.png")
-            # print(f"/home/czr/HaLC/decoder_zoo/HALC/cache_image/cropped_{entity}.png")
-            # Save the cropped images
-            # saved_paths = []
-            # for i, cropped_img in enumerate(cropped_images, start=1):
-            #     save_path = f"/home/czr/HaLC/decoder_zoo/HALC/cache_dir/cropped_level_{i}.png"
-            #     cropped_img.save(save_path)
-            #     saved_paths.append(save_path)
+        # Crop images to the expanded bounding boxes
+        cropped_images = []
+        for bbox in expanded_bboxes:
+            # print("bbox", bbox)
+            # Calculate the absolute coordinates of the bounding box
+            im_width, im_height = original_image.size
+            left = bbox[0] * im_width
+            top = bbox[1] * im_height
+            right = bbox[2] * im_width
+            bottom = bbox[3] * im_height
+
+            # Crop the image to the bounding box
+            cropped_image = original_image.crop((left, top, right, bottom))
+            cropped_images.append(cropped_image)
+
+        # cropped_images[1].save(f"/home/czr/HaLC/decoder_zoo/HALC/cache_image/cropped_{entity}.png")
+        # print(f"/home/czr/HaLC/decoder_zoo/HALC/cache_image/cropped_{entity}.png")
+        # Save the cropped images
+        # saved_paths = []
+        # for i, cropped_img in enumerate(cropped_images, start=1):
+        #     save_path = f"/home/czr/HaLC/decoder_zoo/HALC/cache_dir/cropped_level_{i}.png"
+        #     cropped_img.save(save_path)
+        #     saved_paths.append(save_path)
 
-            # input()
-            # get decoding for each context window
+        # input()
+        # get decoding for each context window
 
-            embeds_list = []
-            for i, cropped_img in enumerate(cropped_images):
-                embs = self.get_model_embeds(cropped_img)
-                embeds_list.append(embs)
-        else:
-            detect_info["status"] = "invalid"
-            embeds_list = None
+        with decode_profiler.timer("crop_encode"):
+            embeds_list = self.get_model_embeds_batch(cropped_images)
 
-        return embeds_list, detect_info
+        return embeds_list, status, context_bbox_index
 
     def get_model_embeds(self, image):
+        return self.get_model_embeds_batch([image])[0]
 
+    def get_model_embeds_batch(self, images):
+        """
+        Embed all crops of an entity with one batched vision forward (and one batched prompt wrap for
+        MiniGPT-4); returns one [1, ...] tensor per image, as get_model_embeds does.
+        """
         if self.model_backbone == "minigpt4":
             max_new_tokens = self.max_new_tokens
             max_length = 512
 
-            image = self.vis_processor(image).unsqueeze(0).to(self.device)
+            image = torch.stack([self.vis_processor(image) for image in images]).to(self.device)
             image_emb, _ = self.model.encode_img(image, 38)
 
             # prompt = self.prompt[0]
@@ -503,24 +825,24 @@ class halc_assistant:
 
         elif self.model_backbone == "llava-1.5":
             # image_emb = self.model.prepare_inputs_labels_for_multimodal(input_ids, attention_mask, past_key_values, labels, image)
-            embs = self.vis_processor(image).unsqueeze(0).to(self.device)
+            embs = torch.stack([self.vis_processor(image) for image in images]).to(self.device)
         elif self.model_backbone == "mplug-owl2":
             # image_emb = self.model.prepare_inputs_labels_for_multimodal(input_ids, attention_mask, past_key_values, labels, image)
-            max_edge = max(
-                image.size
-            )  # We recommand you to resize to squared image for BEST performance.
-            image = image.resize((max_edge, max_edge))
-            image_tensor = process_images([image], self.model.image_processor)
+            from mplug_owl2.mm_utils import process_images
+
+            # We recommand you to resize to squared image for BEST performance.
+            images = [image.resize((max(image.size), max(image.size))) for image in images]
+            image_tensor = process_images(images, self.model.image_processor)
             embs = image_tensor.to(self.device, dtype=torch.float16)
 
         elif self.model_backbone == "instructblip":
-            image = self.vis_processor(image).unsqueeze(0).to(self.device)
+            image = torch.stack([self.vis_processor(image) for image in images]).to(self.device)
             image_emb, _ = self.model.encode_img(image, 38)
             embs = self.model.image_to_embs(image_emb, image)
         else:
             raise NotImplementedError
 
-        return embs
+        return list(embs.split(1))
 
     def context_density_distortion_embedding(self, entity):
 
@@ -964,7 +1286,8 @@ class halc_assistant:
         layer_idx1, layer_idx2 = np.unravel_index(
             max_jsd_flat_index.cpu().numpy(), jsd_matrix.shape
         )
-        print("base_layer, final_layer: ", layer_idx1, layer_idx2)
+        if self.debugger == 2:
+            print("base_layer, final_layer: ", layer_idx1, layer_idx2)
 
         # # Update final_logits and base_logits
         # final_logits = context_logits_list[layer_idx1]
@@ -1184,15 +1507,16 @@ class halc_assistant:
 
             if self.score_type == "CLIP" or self.score_type == "BLIP":
                 # print("candidate_texts", candidate_texts)
-                clip_inputs = self.score_processor(
-                    text=candidate_texts,
-                    images=original_image,
-                    return_tensors="pt",
-                    padding=True,
-                    truncation=True,
-                )
+                with decode_profiler.timer("scorer"):
+                    clip_inputs = self.score_processor(
+                        text=candidate_texts,
+                        images=original_image,
+                        return_tensors="pt",
+                        padding=True,
+                        truncation=True,
+                    )
 
-                clip_outputs = self.score_model(**clip_inputs)
+                    clip_outputs = self.score_model(**clip_inputs)
                 logits_per_image = (
                     clip_outputs.logits_per_image
                 )  # image-text similarity score
@@ -1210,7 +1534,8 @@ class halc_assistant:
 
             elif self.score_type == "HPSv2":
                 imgs_path = self.original_image
-                scores = hpsv2.score(imgs_path, candidate_texts, hps_version="v2.1")
+                with decode_profiler.timer("scorer"):
+                    scores = self.score_model.score(imgs_path, candidate_texts, hps_version="v2.1")
                 scores = np.array(scores).tolist()
 
             elif self.score_type == "Random":
@@ -1220,7 +1545,8 @@ class halc_assistant:
                 ppl_score_list = []
                 for candidate_text in candidate_texts:
                     candidate_text = candidate_text.strip()
-                    ppl_score = self.calculate_perplexity(candidate_text)
+                    with decode_profiler.timer("scorer"):
+                        ppl_score = self.calculate_perplexity(candidate_text)
                     ppl_score_list.append(ppl_score)
 
                 scores = ppl_score_list
@@ -0,0 +1,148 @@
+'''
+Compare the sequential `Corrector.batch_correct` with the pipelined executor on a fixed local fixture set.
+The GPT calls are stubbed with canned responses and a fixed network latency, so the benchmark runs offline.
+With --stub-models, the detector / BLIP-2 / QA2C stages are also replaced by stand-ins of fixed cost.
+
+    python benchmark_pipeline.py --stub-models --num-samples 24
+'''
+import argparse
+import json
+import re
+import time
+from types import SimpleNamespace
+
+import openai
+
+import vis_corrector
+from vis_corrector import Corrector
+from config import woodpecker_args_dict
+
+FIXTURES = [
+    ('examples/case1.jpg', 'The image shows a man riding a horse next to a dog. The man is wearing a red hat.'),
+    ('examples/case2.jpg', 'There are two cats sitting on a bed. A laptop is placed on the table.'),
+    ('examples/case3.jpg', 'A car is parked next to a bus on the street. A person stands near the car.'),
+]
+VOCAB = ['man', 'horse', 'dog', 'hat', 'cat', 'bed', 'laptop', 'table', 'car', 'bus', 'street', 'person']
+
+
+def stub_chat_completion(latency):
+    def create(model, messages, **kwargs):
+        time.sleep(latency)
+        system, content = messages[0]['content'], messages[1]['content']
+        if 'rewrite a passage' in system:
+            text = content.rsplit('Passage:\n', 1)[-1].split('\n\nRewritten passage:')[0]
+        elif 'extract information' in system:
+            sent = content.rsplit('Sentence:\n', 1)[-1].split('\n\nOutput:')[0]
+            text = '.'.join(w for w in VOCAB if re.search(rf'\b{w}s?\b', sent)) or 'None'
+        elif 'ask questions' in system:
+            entity = content.rsplit('Entities:\n', 1)[-1].split('\n\nQuestions:')[0]
+            text = '\n'.join(f'What color is the {ent}?&{ent}' for ent in entity.split('.'))
+        else:
+            text = content.rsplit('Passage:\n', 1)[-1].split('\n\nRefined passage:')[0]
+        return {'choices': [{'message': {'content': text}}]}
+    return create
+
+
+class StubDetector:
+    def __init__(self, args):
+        self.latency = args.gpu_latency
+
+    def detect_objects(self, sample):
+        time.sleep(self.latency)
+        entity_info, entity_list = {}, []
+        for entity_str in sample['named_entity']:
+            if 'none' in entity_str.lower():
+                continue
+            ents = entity_str.split('.')
+            for ent in ents:
+                entity_info[ent] = {'total_count': 1, 'crop_box': [[0, 0, 8, 8]], 'crop_path': [], 'bbox': [[0.0, 0.0, 0.5, 0.5]]}
+            entity_list.append(ents)
+        sample['entity_info'] = entity_info
+        sample['entity_list'] = entity_list
+        return sample
+
+
+class StubAnswerer:
+    def __init__(self, args):
+        self.latency = args.gpu_latency
+
+    def batch_generate_answers(self, samples):
+        # one batched forward costs about the same as a single one.
+        time.sleep(self.latency)
+        for sample in samples:
+            sample['generated_answers'] = [
+                {ent: [[(qs, 'red')]] for qs, ent in gen_qs} for gen_qs in sample['generated_questions']
+            ]
+        return samples
+
+    def generate_answers(self, sample):
+        return self.batch_generate_answers([sample])[0]
+
+
+class StubClaimGenerator:
+    def __init__(self, args):
+        self.latency = args.gpu_latency
+
+    def batch_generate_claim(self, samples):
+        time.sleep(self.latency)
+        for sample in samples:
+            specific = {}
+            for answer_dict in sample['generated_answers']:
+                for ent, answer_list in answer_dict.items():
+                    specific[ent] = [[f'The {ent} is {ans}.' for _, ans in answer_list[0]]]
+            sample['claim'] = {'specific': specific, 'counting': 'Counting: \n'}
+        return samples
+
+    def generate_claim(self, sample):
+        return self.batch_generate_claim([sample])[0]
+
+
+def timed(fn, samples):
+    start = time.perf_counter()
+    outputs = fn(samples)
+    return outputs, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the pipelined Woodpecker corrector against the sequential one.")
+    parser.add_argument('--num-samples', type=int, default=24, help="number of samples, cycling over the fixtures.")
+    parser.add_argument('--llm-latency', type=float, default=0.3, help="simulated seconds per GPT call.")
+    parser.add_argument('--gpu-latency', type=float, default=0.2, help="simulated seconds per stubbed model call.")
+    parser.add_argument('--stub-models', action='store_true', help="replace the detector, BLIP-2 and QA2C stages by stand-ins.")
+    parser.add_argument('--output', type=str, default=None, help="optional path to dump the metrics as json.")
+    args = parser.parse_args()
+
+    openai.ChatCompletion.create = stub_chat_completion(args.llm_latency)
+    if args.stub_models:
+        vis_corrector.Detector = StubDetector
+        vis_corrector.Answerer = StubAnswerer
+        vis_corrector.ClaimGenerator = StubClaimGenerator
+
+    model_args = SimpleNamespace(**woodpecker_args_dict, gpu_latency=args.gpu_latency)
+    corrector = Corrector(model_args)
+    corrector.load_models()
+
+    def make_samples():
+        return [
+            {'img_path': FIXTURES[i % len(FIXTURES)][0], 'input_desc': FIXTURES[i % len(FIXTURES)][1],
+             'query': 'Please describe this image in detail.'}
+            for i in range(args.num_samples)
+        ]
+
+    sequential, sequential_time = timed(corrector.batch_correct, make_samples())
+    pipelined, pipelined_time = timed(lambda samples: corrector.batch_correct(samples, pipelined=True), make_samples())
+    assert [s['output'] for s in sequential] == [s['output'] for s in pipelined], "pipelined outputs differ"
+
+    report = {
+        'num_samples': args.num_samples,
+        'sequential_time': sequential_time,
+        'pipelined_time': pipelined_time,
+        'sequential_throughput': args.num_samples / sequential_time,
+        'pipelined_throughput': args.num_samples / pipelined_time,
+        'speedup': sequential_time / pipelined_time,
+        'stages': corrector.pipeline.summary(),
+    }
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
@@ -7,8 +7,13 @@ woodpecker_args_dict = {
     "api_key": api_key,
     "api_base": api_base,
     "val_model_path": "Salesforce/blip2-flan-t5-xxl",
+    "val_device": "cuda",
+    "val_batch_size": 16,
     "qa2c_model_path": "khhuang/zerofec-qa2claim-t5-base",
+    "qa2c_device": "cuda",
+    "qa2c_batch_size": 32,
     "detector_config": "decoder_zoo/GroundingDINO/groundingdino/config/GroundingDINO_SwinT_OGC.py",
     "detector_model_path": "decoder_zoo/GroundingDINO/weights/groundingdino_swint_ogc.pth",
     "cache_dir": "decoder_zoo/HaLC/cache_dir",
+    "debug": False,  # save detected crops to cache_dir
 }
@@ -11,6 +11,7 @@ if __name__ == '__main__':
     parser.add_argument('--text', type=str, help="text from MLLM to be corrected")
     parser.add_argument('--cache-dir', type=str, help="dir for caching intermediate image",
                         default='./cache_dir')
+    parser.add_argument('--debug', action='store_true', help="save the detected crops to the cache dir")
     
     parser.add_argument('--detector-config', type=str, help="Path to the detector config, \
                         in the form of 'path/to/GroundingDINO_SwinT_OGC.py' ")
@@ -29,6 +30,7 @@ if __name__ == '__main__':
         'detector_config':args.detector_config,
         'detector_model_path':args.detector_model,
         'cache_dir': args.cache_dir,
+        'debug': args.debug,
 }
 
     model_args = SimpleNamespace(**args_dict)
@@ -3,49 +3,82 @@ import os
 import torch
 from PIL import Image
 from transformers import Blip2Processor, Blip2ForConditionalGeneration
-from typing import Dict
+from typing import Dict, List
+import numpy as np
+from models.utils import crop_image
 
+VQA_BATCH_SIZE = 16  # max (image, question) pairs per generate call.
 
-def get_answer(processor, model, img, qs):
-    inputs = processor(img, qs, return_tensors="pt").to("cuda", torch.float16)
+
+def get_answer(processor, model, img, qs, device="cuda"):
+    dtype = torch.float16 if "cuda" in str(device) else torch.float32
+    inputs = processor(img, qs, return_tensors="pt").to(device, dtype)
 
     generated_ids = model.generate(**inputs)
     generated_text = processor.decode(generated_ids[0], skip_special_tokens=True)
     return generated_text.strip()
 
-def get_all_answers(processor, model, entity_list, qs, ent_info, input_img_path, cur_answers):
+def get_all_answers(entity_list, qs, ent_info, image_source, cur_answers, jobs):
     # This should return a dict. Since a question may correspond to multiple instances of a same kind of object.
+    # Instead of answering right away, every (image, question) pair is queued in `jobs` as
+    # (decoded image, crop box or None, question, answer slot) and answered later in batches;
+    # the slot is a list that receives the (qs, answer) tuple once it is available.
     # case 1: involve multiple entities or 'where' type question: use the whole img.
     if len(entity_list)>1 or 'where' in qs.lower() or any([ent not in ent_info for ent in entity_list]):
-        img = Image.open(input_img_path).convert('RGB')
-        answer = get_answer(processor, model, img, qs) 
         cur_answers.setdefault('overall', [])   # use a special category 'overall' to denote answers that involve multiple objects.
-        cur_answers['overall'].append((qs, answer))
+        jobs.append((image_source, None, qs, cur_answers['overall']))
     else:
         entity = entity_list[0]
         # case 2: single entity : single/multiple instances.
-        for idx, img_path in enumerate(ent_info[entity]['crop_path']):
-            img = Image.open(img_path).convert('RGB')
-            answer = get_answer(processor, model, img, qs)
+        for idx, crop_box in enumerate(ent_info[entity]['crop_box']):
             cur_answers.setdefault(entity, [])
             if idx + 1 > len(cur_answers[entity]):
                 cur_answers[entity].append([])
-            cur_answers[entity][idx].append((qs, answer))
+            jobs.append((image_source, crop_box, qs, cur_answers[entity][idx]))
     return cur_answers
 
+def encode_images(model, pixel_values):
+    # run the frozen vision tower, Q-Former and projection once per distinct image.
+    image_embeds = model.vision_model(pixel_values, return_dict=True).last_hidden_state
+    image_attention_mask = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=image_embeds.device)
+
+    query_tokens = model.query_tokens.expand(image_embeds.shape[0], -1, -1)
+    query_output = model.qformer(
+        query_embeds=query_tokens,
+        encoder_hidden_states=image_embeds,
+        encoder_attention_mask=image_attention_mask,
+        return_dict=True,
+    ).last_hidden_state
+    return model.language_projection(query_output)
+
+def generate_from_features(model, language_model_inputs, input_ids, attention_mask, **generate_kwargs):
+    # same as Blip2ForConditionalGeneration.generate, starting from cached projected query features.
+    language_attention_mask = torch.ones(
+        language_model_inputs.size()[:-1], dtype=torch.long, device=language_model_inputs.device
+    )
+    attention_mask = torch.cat([language_attention_mask, attention_mask.to(language_attention_mask.device)], dim=1)
+    inputs_embeds = model.get_input_embeddings()(input_ids)
+    inputs_embeds = torch.cat([language_model_inputs, inputs_embeds.to(language_model_inputs.device)], dim=1)
+    return model.language_model.generate(
+        inputs_embeds=inputs_embeds,
+        attention_mask=attention_mask,
+        **generate_kwargs,
+    )
+
 class Answerer:
     '''
-        Input: 
+        Input:
             'generated_questions': a list of 2-ele list, each [qs(str), involved entities(str)]
             'entity_info': A dict recording the global object information.
             key: obj name. (obj1 | obj2 | obj3)
             value:
                 {
                     total_count: detected counts of that obj.
-                    
-                    crop_path: a list of str, denoting the path to cached intermediate file, i.e., cropped out region of that obj.
+
+                    crop_box: a list of [x1, y1, x2, y2] pixel boxes, i.e., cropped out region of that obj
+                        in the decoded image 'image_source'.
                         Note: if total_count > 1, may use the whole image in the following steps.
-                        
+
                     bbox: each [x1, y1, x2, y2], normalized coordinates of left-top and right-bottom corners of bounding boxes.
                 }
         Output:
@@ -57,27 +90,45 @@ class Answerer:
                                                     ...
                                              ]
                                 }
+        All (image, question) pairs of a sample (or of several samples, see `batch_generate_answers`)
+        are answered in padded batches; each distinct image / crop is encoded by the vision tower once.
     '''
-    
+
     def __init__(self, args):
-        
+
         val_model_path = args.val_model_path
         self.args = args
+        self.device = getattr(args, 'val_device', 'cuda')
+        self.batch_size = getattr(args, 'val_batch_size', VQA_BATCH_SIZE)
         self.processor = Blip2Processor.from_pretrained(val_model_path)
-        device_map = {
-            "query_tokens": 0,  # a number. used to set to 0.
-            "vision_model":0,
-            "language_model": 0,
-            "language_projection": 0,
-            "qformer": 0,
-        }
-        self.model = Blip2ForConditionalGeneration.from_pretrained(val_model_path, load_in_8bit=True, device_map=device_map, torch_dtype=torch.float16)
-    
+        if 'cuda' in str(self.device):
+            self.dtype = torch.float16
+            device_index = torch.device(self.device).index or 0
+            device_map = {
+                "query_tokens": device_index,  # a number. used to set to 0.
+                "vision_model": device_index,
+                "language_model": device_index,
+                "language_projection": device_index,
+                "qformer": device_index,
+            }
+            self.model = Blip2ForConditionalGeneration.from_pretrained(val_model_path, load_in_8bit=True, device_map=device_map, torch_dtype=torch.float16)
+        else:
+            self.dtype = torch.float32
+            self.model = Blip2ForConditionalGeneration.from_pretrained(val_model_path, torch_dtype=torch.float32).to(self.device)
+        if self.model.config.use_decoder_only_language_model:
+            # decoder-only LMs continue generation right after the prompt, so pad on the left.
+            self.processor.tokenizer.padding_side = 'left'
+        self.model.eval()
 
-    def generate_answers(self, sample: Dict):
+    def plan_answers(self, sample: Dict, jobs: List):
         generated_qs = sample['generated_questions']
         global_entity_dict = sample['entity_info']
-        
+        # the decoded image is handed over by the detector; only decode it here as a fallback.
+        # it is not needed after this stage, so drop it to keep the sample JSON-serializable.
+        image_source = sample.pop('image_source', None)
+        if image_source is None:
+            image_source = np.asarray(Image.open(sample['img_path']).convert('RGB'))
+
         all_answers = []
         for gen_qs in generated_qs:
             # border case: no question asked.
@@ -89,10 +140,53 @@ class Answerer:
                 qs, entity = cur_qs # qs is a str. entity is also a str. may contain multiple entity connected by periods.
                 entity_list = entity.split('.')
                 entity_list = [e.strip() for e in entity_list if e.strip()]
-                
-                cur_answers = get_all_answers(self.processor, self.model, entity_list, qs, global_entity_dict, sample['img_path'], cur_answers)
+
+                cur_answers = get_all_answers(entity_list, qs, global_entity_dict, image_source, cur_answers, jobs)
             all_answers.append(cur_answers)
-                
-        sample['generated_answers'] = all_answers
+        return all_answers
+
+    @torch.no_grad()
+    def answer_jobs(self, jobs: List):
+        if len(jobs) == 0:
+            return
+        # encode every distinct image / crop by the vision tower once.
+        job_keys = [(id(image_source), None if crop_box is None else tuple(crop_box)) for image_source, crop_box, _, _ in jobs]
+        img_keys = {}
+        for img_key, (image_source, crop_box, _, _) in zip(job_keys, jobs):
+            img_keys.setdefault(img_key, (image_source, crop_box))
+        key_to_idx = {img_key: i for i, img_key in enumerate(img_keys)}
+        regions = list(img_keys.values())
+        features = []
+        for start in range(0, len(regions), self.batch_size):
+            imgs = [
+                Image.fromarray(image_source) if crop_box is None else crop_image(image_source, crop_box)
+                for image_source, crop_box in regions[start:start + self.batch_size]
+            ]
+            pixel_values = self.processor(images=imgs, return_tensors="pt").pixel_values.to(self.device, self.dtype)
+            features.append(encode_images(self.model, pixel_values))
+        features = torch.cat(features, dim=0)
+
+        for start in range(0, len(jobs), self.batch_size):
+            batch = jobs[start:start + self.batch_size]
+            text_inputs = self.processor.tokenizer([qs for _, _, qs, _ in batch], padding='longest', return_tensors="pt").to(self.device)
+            index = torch.tensor([key_to_idx[img_key] for img_key in job_keys[start:start + self.batch_size]], device=features.device)
+            generated_ids = generate_from_features(
+                self.model, features.index_select(0, index), text_inputs.input_ids, text_inputs.attention_mask
+            )
+            generated_text = self.processor.batch_decode(generated_ids, skip_special_tokens=True)
+            for (_, _, qs, slot), answer in zip(batch, generated_text):
+                slot.append((qs, answer.strip()))
+
+    def generate_answers(self, sample: Dict):
+        jobs = []
+        sample['generated_answers'] = self.plan_answers(sample, jobs)
+        self.answer_jobs(jobs)
         return sample
-    
\ No newline at end of file
+
+    def batch_generate_answers(self, samples: List[Dict]):
+        # answer the questions of several samples together to fill up the batches.
+        jobs = []
+        for sample in samples:
+            sample['generated_answers'] = self.plan_answers(sample, jobs)
+        self.answer_jobs(jobs)
+        return samples
@@ -1,8 +1,11 @@
 import os
 #os.environ["CUDA_VISIBLE_DEVICES"]="6"
-from typing import Dict
+from typing import Dict, List
+import torch
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 
+QA2C_BATCH_SIZE = 32  # max (question, answer) pairs per generate call.
+
 def format_inputs(question: str, answer: str):
     return f"{answer} \\n {question}"
 
@@ -14,6 +17,18 @@ def get_claim(tokenizer, model, question, answer):
     ans = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
     return ans
 
+@torch.no_grad()
+def get_claims(tokenizer, model, qa_pairs, batch_size=QA2C_BATCH_SIZE):
+    # batched version of get_claim: one claim per (question, answer) pair, in order.
+    claims = []
+    for start in range(0, len(qa_pairs), batch_size):
+        input_text = [format_inputs(qs, ans) for qs, ans in qa_pairs[start:start + batch_size]]
+        inputs = tokenizer(input_text, return_tensors="pt", padding='longest', truncation=True, max_length=512).to(model.device)
+
+        generated_ids = model.generate(**inputs, max_length=64, num_beams=4, early_stopping=True)
+        claims += tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+    return claims
+
 class ClaimGenerator:
     '''
         Input:
@@ -41,19 +56,24 @@ class ClaimGenerator:
                                 'overall': 1-d list. 
                                 'counting': 
                             }
+        All (question, answer) pairs of a sample (or of several samples, see `batch_generate_claim`)
+        are turned into claims by padded batched generation, then scattered back into the structure above.
     '''
     
     def __init__(self, args):
         self.args = args
         qa2c_model_path = args.qa2c_model_path
-        self.model = AutoModelForSeq2SeqLM.from_pretrained(qa2c_model_path).to('cuda')
+        self.device = getattr(args, 'qa2c_device', 'cuda:0')
+        self.batch_size = getattr(args, 'qa2c_batch_size', QA2C_BATCH_SIZE)
+        self.model = AutoModelForSeq2SeqLM.from_pretrained(qa2c_model_path).to(self.device)
+        self.model.eval()
         self.tokenizer = AutoTokenizer.from_pretrained(qa2c_model_path)
 
-    def generate_claim(self, sample: Dict):
+    def plan_claim(self, sample: Dict, jobs: List):
         # claim from two parts. counting info and Q&A
         all_claim = {}
         
-        # first part, Q&A
+        # first part, Q&A. each pair is queued as (qs, ans, claim slot) and generated later in batches.
         generated_answers = sample['generated_answers']
         for answer_dict in generated_answers:
             for entity, answer_list in answer_dict.items():
@@ -61,8 +81,7 @@ class ClaimGenerator:
                     all_claim.setdefault('overall', [])
                     for qa_tuple in answer_list:
                         qs, ans = qa_tuple
-                        clm = get_claim(self.tokenizer, self.model, qs, ans)
-                        all_claim['overall'] += clm
+                        jobs.append((qs, ans, all_claim['overall']))
                 else:
                     all_claim.setdefault('specific', {}).setdefault(entity, [])
                     for idx, entity_answer_list in enumerate(answer_list):
@@ -70,8 +89,7 @@ class ClaimGenerator:
                             all_claim['specific'][entity].append([])
                         for qa_tuple in entity_answer_list:
                             qs, ans = qa_tuple
-                            clm = get_claim(self.tokenizer, self.model, qs, ans)
-                            all_claim['specific'][entity][idx] += clm
+                            jobs.append((qs, ans, all_claim['specific'][entity][idx]))
                            
         # second part, counting info
         counting_claim = "Counting: \n"
@@ -90,4 +108,22 @@ class ClaimGenerator:
                 
         all_claim['counting'] = counting_claim
         sample['claim'] = all_claim     
-        return sample
\ No newline at end of file
+        return sample
+
+    def claim_jobs(self, jobs: List):
+        claims = get_claims(self.tokenizer, self.model, [(qs, ans) for qs, ans, _ in jobs], self.batch_size)
+        for (_, _, slot), clm in zip(jobs, claims):
+            slot.append(clm)
+
+    def generate_claim(self, sample: Dict):
+        jobs = []
+        sample = self.plan_claim(sample, jobs)
+        self.claim_jobs(jobs)
+        return sample
+
+    def batch_generate_claim(self, samples: List[Dict]):
+        # generate the claims of several samples together to fill up the batches.
+        jobs = []
+        samples = [self.plan_claim(sample, jobs) for sample in samples]
+        self.claim_jobs(jobs)
+        return samples
\ No newline at end of file
@@ -8,6 +8,7 @@ Modified by: Maxlinn
 3. remove machine-translation based metrics BLEU-n, CIDEr, ROGUE
 4. add new metric Recall, which represents the node words(i.e. lemmas of objects) coverage overall.
 5. add pickle cache mechanism to make it fast for repetitive evaluations.
+6. read the MSCOCO annotations through the memory-mapped index of coco_index.py instead of the raw json files.
 '''
 
 
@@ -23,6 +24,8 @@ import tqdm
 import pickle
 from collections import defaultdict
 
+from coco_index import load_coco_index
+
 
 # copied from: https://github.com/LisaAnne/Hallucination/blob/master/data/synonyms.txt
 synonyms_txt = '''
@@ -186,7 +189,10 @@ class CHAIR(object):
         self.double_word_dict['toilet seat'] = 'toilet'
         self.double_word_dict['wine glas'] = 'wine glass'
         
+        self.coco_index = load_coco_index(coco_path, splits=("train", "val"))
         self.get_annotations()
+        # the index is memory-mapped; do not pickle it with the evaluator.
+        del self.coco_index
 
     def _load_generated_captions_into_evaluator(self, cap_file, image_id_key, caption_key):
 
@@ -260,40 +266,25 @@ class CHAIR(object):
         Add objects taken from MSCOCO segmentation masks
         '''
 
-        coco_segments = combine_coco_instances(self.coco_path )
-        segment_annotations = coco_segments['annotations']
-
-        #make dict linking object name to ids
-        id_to_name = {} #dict with id to synsets 
-        for cat in coco_segments['categories']:
-            id_to_name[cat['id']] = cat['name']
+        coco_index = self.coco_index
+        print("Getting annotations for %d segmentation masks" %len(coco_index.cat_ids))
 
-        for i, annotation in enumerate(segment_annotations):
-            sys.stdout.write("\rGetting annotations for %d/%d segmentation masks" 
-                              %(i, len(segment_annotations)))
-            imid = annotation['image_id']
-            
-            node_word = self.inverse_synonym_dict[id_to_name[annotation['category_id']]]
-            self.imid_to_objects[imid].append(node_word)
-        print("\n")
+        for imid in coco_index.image_ids.tolist():
+            node_words = [self.inverse_synonym_dict[name] for name in coco_index.category_names(imid)]
+            self.imid_to_objects[imid].extend(node_words)
 
     def get_annotations_from_captions(self):
         '''
         Add objects taken from MSCOCO ground truth captions 
         '''
 
-        coco_caps = combine_coco_captions(self.coco_path)
-        caption_annotations = coco_caps['annotations']
+        coco_index = self.coco_index
 
-        for i, annotation in enumerate(caption_annotations):
-            sys.stdout.write('\rGetting annotations for %d/%d ground truth captions' 
-                              %(i, len(coco_caps['annotations'])))
-            imid = annotation['image_id']
-            
-            _, node_words, _, _ = self.caption_to_words(annotation['caption'])
-            # note here is update, so call get_annotations_from_segments first
-            self.imid_to_objects[imid].extend(node_words)
-        print("\n")
+        for imid in tqdm.tqdm(coco_index.image_ids.tolist(), desc='Getting annotations from ground truth captions'):
+            for caption in coco_index.captions(imid):
+                _, node_words, _, _ = self.caption_to_words(caption)
+                # note here is update, so call get_annotations_from_segments first
+                self.imid_to_objects[imid].extend(node_words)
 
 
     def get_annotations(self):
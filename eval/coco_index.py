@@ -0,0 +1,203 @@
+"""
+Compact, memory-mapped index of the MSCOCO 2014 annotation files.
+
+Parsing `instances_*2014.json` / `captions_*2014.json` and rebuilding the per-image dicts takes tens of
+seconds and several GB on every run. The index is built once per set of source files and memory-mapped
+afterwards. It covers image id -> file name, the category id of every instance annotation, and the
+ground-truth captions. Layout of an index directory:
+
+    meta.json              version, source files (size / mtime), splits, categories
+    image_ids.npy          image ids, in the order of the source "images" lists
+    sorted_ids.npy         image ids sorted, with sorted_pos.npy their position, for lookups
+    file_offsets.npy       file name of image i is file_names.bin[file_offsets[i]:file_offsets[i + 1]]
+    cat_offsets.npy        category ids of image i are cat_ids[cat_offsets[i]:cat_offsets[i + 1]]
+    cap_offsets.npy        captions of image i are captions cap_offsets[i] .. cap_offsets[i + 1] - 1,
+    text_offsets.npy       caption j being captions.bin[text_offsets[j]:text_offsets[j + 1]]
+
+    index = load_coco_index("/path/to/coco/annotations", splits=("val",))
+    index.file_name(391895), index.category_names(391895), index.captions(391895)
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+INDEX_VERSION = 1
+DEFAULT_CACHE_DIR = os.environ.get("COCO_INDEX_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "coco_index"))
+
+ARRAYS = ["image_ids", "sorted_ids", "sorted_pos", "file_offsets", "cat_offsets", "cat_ids", "cap_offsets", "text_offsets"]
+BLOBS = ["file_names", "captions"]
+
+
+def source_files(annotation_path, splits):
+    files = []
+    for split in splits:
+        for kind in ["instances", "captions"]:
+            path = os.path.join(annotation_path, "%s_%s2014.json" % (kind, split))
+            if not os.path.exists(path):
+                raise FileNotFoundError("Please download MSCOCO %s annotations for the %s set: %s" % (kind, split, path))
+            files.append(path)
+    return files
+
+
+def source_signature(files):
+    # the index is rebuilt whenever a source file is replaced.
+    return [{"path": os.path.abspath(f), "size": os.path.getsize(f), "mtime": int(os.path.getmtime(f))} for f in files]
+
+
+def pack_strings(strings):
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def build_coco_index(annotation_path, root, splits=("val",)):
+    files = source_files(annotation_path, splits)
+
+    image_ids, file_names, categories = [], [], {}
+    image_cats, image_caps = {}, {}
+    for split in splits:
+        # captions first: their "images" order is the one pycocotools' COCO.getImgIds() returns.
+        for kind in ["captions", "instances"]:
+            with open(os.path.join(annotation_path, "%s_%s2014.json" % (kind, split)), "r") as f:
+                data = json.load(f)
+            for image in data["images"]:
+                if image["id"] not in image_cats:
+                    image_ids.append(image["id"])
+                    file_names.append(image["file_name"])
+                    image_cats[image["id"]] = []
+                    image_caps[image["id"]] = []
+            if kind == "instances":
+                for category in data["categories"]:
+                    categories[int(category["id"])] = category["name"]
+                for annotation in data["annotations"]:
+                    image_cats[annotation["image_id"]].append(annotation["category_id"])
+            else:
+                for annotation in data["annotations"]:
+                    image_caps[annotation["image_id"]].append(annotation["caption"])
+            del data
+
+    arrays = {"image_ids": np.asarray(image_ids, dtype=np.int64)}
+    arrays["sorted_pos"] = np.argsort(arrays["image_ids"], kind="stable")
+    arrays["sorted_ids"] = arrays["image_ids"][arrays["sorted_pos"]]
+    blobs = {}
+    blobs["file_names"], arrays["file_offsets"] = pack_strings(file_names)
+
+    cat_counts = [len(image_cats[i]) for i in image_ids]
+    arrays["cat_offsets"] = np.zeros(len(image_ids) + 1, dtype=np.int64)
+    np.cumsum(cat_counts, out=arrays["cat_offsets"][1:])
+    arrays["cat_ids"] = np.asarray([c for i in image_ids for c in image_cats[i]], dtype=np.int32)
+
+    cap_counts = [len(image_caps[i]) for i in image_ids]
+    arrays["cap_offsets"] = np.zeros(len(image_ids) + 1, dtype=np.int64)
+    np.cumsum(cap_counts, out=arrays["cap_offsets"][1:])
+    blobs["captions"], arrays["text_offsets"] = pack_strings([c for i in image_ids for c in image_caps[i]])
+
+    # write next to the final location, then swap it in, so a concurrent reader never sees half an index.
+    tmp_root = root + ".tmp%d" % os.getpid()
+    os.makedirs(tmp_root, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_root, name + ".npy"), array)
+    for name, blob in blobs.items():
+        blob.tofile(os.path.join(tmp_root, name + ".bin"))
+    meta = {
+        "version": INDEX_VERSION,
+        "splits": list(splits),
+        "sources": source_signature(files),
+        "num_images": len(image_ids),
+        "categories": {str(k): v for k, v in sorted(categories.items())},
+    }
+    with open(os.path.join(tmp_root, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    if os.path.exists(root):
+        shutil.rmtree(root, ignore_errors=True)
+    os.replace(tmp_root, root)
+    return COCOIndex(root)
+
+
+class COCOIndex:
+    """Read side; all arrays are memory-mapped, so opening an index costs next to nothing."""
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != INDEX_VERSION:
+            raise ValueError(
+                "COCO index {} has version {}, expected {}.".format(root, self.meta["version"], INDEX_VERSION)
+            )
+        self.categories = {int(k): v for k, v in self.meta["categories"].items()}
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(root, name + ".npy"), mmap_mode="r"))
+        for name in BLOBS:
+            path = os.path.join(root, name + ".bin")
+            # np.memmap refuses empty files.
+            blob = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else np.zeros(0, dtype=np.uint8)
+            setattr(self, name + "_blob", blob)
+
+    def __len__(self):
+        return self.meta["num_images"]
+
+    def __contains__(self, image_id):
+        pos = np.searchsorted(self.sorted_ids, image_id)
+        return pos < len(self.sorted_ids) and self.sorted_ids[pos] == image_id
+
+    def position(self, image_id):
+        pos = np.searchsorted(self.sorted_ids, image_id)
+        if pos >= len(self.sorted_ids) or self.sorted_ids[pos] != image_id:
+            raise KeyError(image_id)
+        return int(self.sorted_pos[pos])
+
+    def _string(self, blob, offsets, i):
+        return bytes(blob[offsets[i]:offsets[i + 1]]).decode("utf-8")
+
+    def file_name(self, image_id):
+        return self._string(self.file_names_blob, self.file_offsets, self.position(image_id))
+
+    def category_ids(self, image_id):
+        # one entry per instance annotation, duplicates included.
+        i = self.position(image_id)
+        return self.cat_ids[self.cat_offsets[i]:self.cat_offsets[i + 1]].tolist()
+
+    def category_names(self, image_id):
+        return [self.categories[c] for c in self.category_ids(image_id)]
+
+    def objects(self, image_id):
+        # the segment-derived object set of an image.
+        return set(self.category_names(image_id))
+
+    def captions(self, image_id):
+        i = self.position(image_id)
+        return [
+            self._string(self.captions_blob, self.text_offsets, j)
+            for j in range(self.cap_offsets[i], self.cap_offsets[i + 1])
+        ]
+
+    def segment_results(self):
+        # same records as pope_coco/coco_ground_truth_segmentation.json.
+        return [
+            {"image_id": int(image_id), "image": self.file_name(image_id), "objects": sorted(self.objects(image_id))}
+            for image_id in self.image_ids
+        ]
+
+
+def load_coco_index(annotation_path, splits=("val",), cache_dir=None):
+    """
+    Open the index of the `splits` annotation files under `annotation_path`, (re)building it under
+    `cache_dir` (default: $COCO_INDEX_CACHE or ~/.cache/coco_index) when missing or stale.
+    """
+    files = source_files(annotation_path, splits)
+    signature = source_signature(files)
+    key = hashlib.sha1(json.dumps([INDEX_VERSION, signature]).encode()).hexdigest()[:16]
+    root = os.path.join(cache_dir or DEFAULT_CACHE_DIR, "coco_{}_{}".format("_".join(splits), key))
+    if os.path.exists(os.path.join(root, "meta.json")):
+        index = COCOIndex(root)
+        if index.meta["sources"] == signature:
+            return index
+    print("Building COCO annotation index at {} ...".format(root))
+    os.makedirs(os.path.dirname(root), exist_ok=True)
+    return build_coco_index(annotation_path, root, splits=splits)
@@ -84,29 +84,66 @@ def get_model_name_from_path(model_path):
 
 
 class KeywordsStoppingCriteria(StoppingCriteria):
+    """
+    Batched keyword stopping. Every token sequence a keyword can be generated as is right-aligned into
+    one padded (num_sequences, max_len) tensor, moved to the device once, and all rows are checked
+    against all sequences with one sliding-window comparison over the generated tail.
+    `finished(output_ids)` returns the per-row finished mask (sticky, on device, no host sync);
+    `__call__` keeps the single-bool protocol of `generate` and is True once every row is finished.
+    """
+
     def __init__(self, keywords, tokenizer, input_ids):
         self.keywords = keywords
         self.keyword_ids = []
-        self.max_keyword_len = 0
         for keyword in keywords:
-            cur_keyword_ids = tokenizer(keyword).input_ids
-            if len(cur_keyword_ids) > 1 and cur_keyword_ids[0] == tokenizer.bos_token_id:
-                cur_keyword_ids = cur_keyword_ids[1:]
-            if len(cur_keyword_ids) > self.max_keyword_len:
-                self.max_keyword_len = len(cur_keyword_ids)
-            self.keyword_ids.append(torch.tensor(cur_keyword_ids))
+            for cur_keyword_ids in self.keyword_variants(keyword, tokenizer):
+                if cur_keyword_ids and cur_keyword_ids not in self.keyword_ids:
+                    self.keyword_ids.append(cur_keyword_ids)
+        self.max_keyword_len = max([len(ids) for ids in self.keyword_ids], default=0)
+        self.stop_ids = torch.full((len(self.keyword_ids), self.max_keyword_len), -1, dtype=torch.long)
+        self.stop_mask = torch.zeros((len(self.keyword_ids), self.max_keyword_len), dtype=torch.bool)
+        for i, ids in enumerate(self.keyword_ids):
+            self.stop_ids[i, self.max_keyword_len - len(ids):] = torch.tensor(ids)
+            self.stop_mask[i, self.max_keyword_len - len(ids):] = True
+        self.stop_lens = self.stop_mask.sum(-1)
         self.tokenizer = tokenizer
         self.start_len = input_ids.shape[1]
+        self.done = None
+
+    @staticmethod
+    def keyword_variants(keyword, tokenizer):
+        # the ids of the keyword on its own, and after other text (sentencepiece marks word starts),
+        # which replaces decoding the tail at every step.
+        variants = []
+        cur_keyword_ids = tokenizer(keyword).input_ids
+        if len(cur_keyword_ids) > 1 and cur_keyword_ids[0] == tokenizer.bos_token_id:
+            cur_keyword_ids = cur_keyword_ids[1:]
+        variants.append(cur_keyword_ids)
+        prefix_ids = tokenizer("a").input_ids
+        in_context_ids = tokenizer("a" + keyword).input_ids
+        if in_context_ids[:len(prefix_ids)] == prefix_ids and len(in_context_ids) > len(prefix_ids):
+            variants.append(in_context_ids[len(prefix_ids):])
+        return variants
+
+    def finished(self, output_ids: torch.LongTensor) -> torch.BoolTensor:
+        batch_size, length = output_ids.shape
+        if self.done is None or self.done.shape[0] != batch_size or self.done.device != output_ids.device:
+            self.done = torch.zeros(batch_size, dtype=torch.bool, device=output_ids.device)
+        if self.stop_ids.device != output_ids.device:
+            self.stop_ids = self.stop_ids.to(output_ids.device)
+            self.stop_mask = self.stop_mask.to(output_ids.device)
+            self.stop_lens = self.stop_lens.to(output_ids.device)
+        generated = length - self.start_len
+        if self.max_keyword_len == 0 or generated <= 0:
+            return self.done
+        tail = output_ids[:, -self.max_keyword_len:]
+        if tail.shape[1] < self.max_keyword_len:
+            tail = torch.cat([tail.new_full((batch_size, self.max_keyword_len - tail.shape[1]), -2), tail], dim=1)
+        # (batch, num_sequences): a sequence matches where all its (unpadded) positions agree.
+        match = ((tail[:, None, :] == self.stop_ids[None]) | ~self.stop_mask[None]).all(-1)
+        match &= (self.stop_lens <= generated)[None]
+        self.done |= match.any(-1)
+        return self.done
 
     def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        assert output_ids.shape[0] == 1, "Only support batch size 1 (yet)"  # TODO
-        offset = min(output_ids.shape[1] - self.start_len, self.max_keyword_len)
-        self.keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
-        for keyword_id in self.keyword_ids:
-            if (output_ids[0, -keyword_id.shape[0]:] == keyword_id).all():
-                return True
-        outputs = self.tokenizer.batch_decode(output_ids[:, -offset:], skip_special_tokens=True)[0]
-        for keyword in self.keywords:
-            if keyword in outputs:
-                return True
-        return False
\ No newline at end of file
+        return bool(self.finished(output_ids).all())
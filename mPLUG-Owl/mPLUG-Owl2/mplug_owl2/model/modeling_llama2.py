@@ -16,32 +16,73 @@ from transformers.utils import logging
 from .modeling_attn_mask_utils import _prepare_4d_causal_attention_mask
 from .configuration_mplug_owl2 import LlamaConfig
 
+def modality_runs(indicators):
+    # (start, end, modality) runs of equal modality of a 1-d cpu tensor.
+    change = (indicators[1:] != indicators[:-1]).nonzero(as_tuple=True)[0] + 1
+    bounds = [0] + change.tolist() + [len(indicators)]
+    return [(start, end, int(indicators[start])) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+class MultiwayRouting:
+    """
+    Modality routing of a batch, computed once per forward and shared by every MultiwayNetwork.
+        single: the modality of every token when the batch holds only one, else None.
+        segments: [(rows, [(start, end, modality), ...]), ...] runs of equal modality along the sequence;
+            rows is slice(None) when all rows share the same layout, else one entry per row.
+    """
+
+    def __init__(self, single=None, segments=None):
+        self.single = single
+        self.segments = segments
+
+    @classmethod
+    def from_indicators(cls, modality_indicators):
+        if isinstance(modality_indicators, cls):
+            return modality_indicators
+        if modality_indicators is None:
+            return cls(single=0)
+        # a single host sync per forward, instead of a nonzero per module and modality.
+        indicators = modality_indicators.view(-1, modality_indicators.shape[-1]).cpu()
+        first = int(indicators[0, 0])
+        if bool((indicators == first).all()):
+            return cls(single=first)
+        if bool((indicators == indicators[:1]).all()):
+            return cls(segments=[(slice(None), modality_runs(indicators[0]))])
+        return cls(segments=[(slice(b, b + 1), modality_runs(row)) for b, row in enumerate(indicators)])
+
+
 class MultiwayNetwork(nn.Module):
 
     def __init__(self, module_provider, num_multiway=2):
         super(MultiwayNetwork, self).__init__()
 
         self.multiway = torch.nn.ModuleList([module_provider() for _ in range(num_multiway)])
-    
+
+    def run_subway(self, idx, hidden_states):
+        output = self.multiway[idx](hidden_states)
+        if isinstance(output, tuple):
+            output = output[0]
+        return output
+
     def forward(self, hidden_states, multiway_indices):
 
         if len(self.multiway) == 1:
             return self.multiway[0](hidden_states)
 
-        output_hidden_states = torch.empty_like(hidden_states)
-        
-        for idx, subway in enumerate(self.multiway):
-            local_indices = multiway_indices.eq(idx).nonzero(as_tuple=True)
-            hidden = hidden_states[local_indices].unsqueeze(1).contiguous()
-            if hidden.numel():
-                output = subway(hidden)
-                if isinstance(output, tuple):
-                    output = output[0]
-                output = output.squeeze(1)
-                output_hidden_states[local_indices] = output
-        
-        return output_hidden_states.contiguous()
-    
+        routing = MultiwayRouting.from_indicators(multiway_indices)
+        if routing.single is not None:
+            # e.g. every decode step, where all new tokens are text: no gather / scatter copies.
+            return self.run_subway(routing.single, hidden_states)
+
+        # the subways are token-wise, so contiguous runs are fed as slices and concatenated back.
+        output_hidden_states = []
+        for rows, runs in routing.segments:
+            output_hidden_states.append(torch.cat(
+                [self.run_subway(idx, hidden_states[rows, start:end]) for start, end, idx in runs], dim=1
+            ))
+        if len(output_hidden_states) == 1:
+            return output_hidden_states[0]
+        return torch.cat(output_hidden_states, dim=0)
 
 
 def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
@@ -338,6 +379,8 @@ def model_forward(
     )
 
     hidden_states = inputs_embeds
+    # route the modalities once for all the multiway modules of all layers.
+    modality_indicators = MultiwayRouting.from_indicators(modality_indicators)
 
     if self.gradient_checkpointing and self.training:
         if use_cache:
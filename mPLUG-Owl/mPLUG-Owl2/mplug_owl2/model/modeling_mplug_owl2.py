@@ -24,7 +24,7 @@ from transformers.modeling_outputs import CausalLMOutputWithPast
 
 from .configuration_mplug_owl2 import MPLUGOwl2Config, MplugOwlVisionConfig, MplugOwlVisualAbstractorConfig
 from .visual_encoder import MplugOwlVisionModel, MplugOwlVisualAbstractorModel
-from .modeling_llama2 import replace_llama_modality_adaptive
+from .modeling_llama2 import MultiwayRouting, replace_llama_modality_adaptive
 from mplug_owl2.constants import IMAGE_TOKEN_INDEX, IGNORE_INDEX
 from icecream import ic
 
@@ -70,7 +70,8 @@ class MPLUGOwl2MetaForCausalLM(ABC):
         if images is None or input_ids.shape[1] == 1:
             if past_key_values is not None and images is not None and input_ids.shape[1] == 1:
                 attention_mask = torch.ones((attention_mask.shape[0], past_key_values[-1][-1].shape[-2] + 1), dtype=attention_mask.dtype, device=attention_mask.device)
-            multiway_indices = torch.zeros_like(input_ids).long().to(self.device)
+            # text only (e.g. every decode step): route all tokens to the text branch without indicators.
+            multiway_indices = MultiwayRouting(single=0)
             return input_ids, multiway_indices, attention_mask, past_key_values, None, labels
         
         if type(images) is list or images.ndim == 5:
@@ -99,16 +99,54 @@ class Conversation:
 
 
 class StoppingCriteriaSub(StoppingCriteria):
+    """
+    The stop sequences are right-aligned into one padded (num_stops, max_len) tensor, moved to the device
+    once, and every row is checked against every stop sequence with a single comparison of the tail.
+    `finished(input_ids)` returns the per-row finished mask (sticky within a generation, on device, so
+    rows can be retired without a host sync); `__call__` is True once every row has hit a stop sequence.
+    Both can be called on the same step (the decoders read the mask, then the criteria): a call with the
+    same length is idempotent. The mask is reset by `reset()` (generate() calls it, the list is reused
+    across generations), or whenever the input is neither as long as on the last call nor one token
+    longer, or changes batch size or device, i.e. a new generation.
+    """
+
     def __init__(self, stops=[], encounters=1):
         super().__init__()
         self.stops = stops
-
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
-        for stop in self.stops:
-            if torch.all(input_ids[:, -len(stop) :] == stop).item():
-                return True
-
-        return False
+        stops = [torch.as_tensor(stop).flatten().tolist() for stop in stops]
+        self.max_stop_len = max([len(stop) for stop in stops], default=0)
+        self.stop_ids = torch.full((len(stops), self.max_stop_len), -1, dtype=torch.long)
+        self.stop_mask = torch.zeros((len(stops), self.max_stop_len), dtype=torch.bool)
+        for i, stop in enumerate(stops):
+            self.stop_ids[i, self.max_stop_len - len(stop):] = torch.tensor(stop, dtype=torch.long)
+            self.stop_mask[i, self.max_stop_len - len(stop):] = True
+        self.reset()
+
+    def reset(self):
+        self.done = None
+        self.seen_len = 0
+
+    def finished(self, input_ids: torch.LongTensor) -> torch.BoolTensor:
+        batch_size, length = input_ids.shape
+        if self.done is None or length not in (self.seen_len, self.seen_len + 1) \
+                or self.done.shape[0] != batch_size or self.done.device != input_ids.device:
+            # a new generation.
+            self.done = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+        self.seen_len = length
+        if self.stop_ids.device != input_ids.device:
+            self.stop_ids = self.stop_ids.to(input_ids.device)
+            self.stop_mask = self.stop_mask.to(input_ids.device)
+        if self.max_stop_len == 0:
+            return self.done
+        tail = input_ids[:, -self.max_stop_len:]
+        if tail.shape[1] < self.max_stop_len:
+            tail = torch.cat([tail.new_full((batch_size, self.max_stop_len - tail.shape[1]), -2), tail], dim=1)
+        match = ((tail[:, None, :] == self.stop_ids[None]) | ~self.stop_mask[None]).all(-1)  # (batch, num_stops)
+        self.done |= match.any(-1)
+        return self.done
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
+        return bool(self.finished(input_ids).all())
 
 
 CONV_VISION_Vicuna0 = Conversation(
@@ -252,6 +290,10 @@ class Chat:
         candidate_premature_layers = lm_early_exit_layers[:-1]
         premature_layer_dist = {l: 0 for l in candidate_premature_layers}
 
+        for criteria in self.stopping_criteria:
+            if hasattr(criteria, "reset"):
+                criteria.reset()
+
         generation_kwargs = dict(
             inputs_embeds=embs,
             max_new_tokens=max_new_tokens,
@@ -9,14 +9,18 @@ from minigpt4.datasets.builders.base_dataset_builder import load_dataset_config
 from minigpt4.datasets.builders.image_text_pair_builder import (
     CCSBUBuilder,
     LaionBuilder,
-    CCSBUAlignBuilder
+    CCSBUAlignBuilder,
+    CCSBUAlignFeatureBuilder,
+    LaionFeatureBuilder,
 )
 from minigpt4.common.registry import registry
 
 __all__ = [
     "CCSBUBuilder",
     "LaionBuilder",
-    "CCSBUAlignBuilder"
+    "CCSBUAlignBuilder",
+    "CCSBUAlignFeatureBuilder",
+    "LaionFeatureBuilder",
 ]
 
 
@@ -6,6 +6,7 @@ from minigpt4.common.registry import registry
 from minigpt4.datasets.builders.base_dataset_builder import BaseDatasetBuilder
 from minigpt4.datasets.datasets.laion_dataset import LaionDataset
 from minigpt4.datasets.datasets.cc_sbu_dataset import CCSBUDataset, CCSBUAlignDataset
+from minigpt4.datasets.datasets.feature_dataset import FeatureCaptionDataset
 
 
 @registry.register_builder("cc_sbu")
@@ -103,3 +104,38 @@ class CCSBUAlignBuilder(BaseDatasetBuilder):
         )
 
         return datasets
+
+
+class FeatureStoreBuilder(BaseDatasetBuilder):
+    """
+    Builds a dataset from a feature store written by run_scripts/extract_vision_features.py.
+    Images are not read, so no vision / text processor is needed.
+    """
+    train_dataset_cls = FeatureCaptionDataset
+
+    def build_datasets(self):
+        logging.info("Building datasets...")
+        build_info = self.config.build_info
+        feature_storage = build_info.feature_storage
+
+        if not os.path.exists(feature_storage):
+            warnings.warn("feature storage path {} does not exist.".format(feature_storage))
+
+        datasets = dict()
+        datasets['train'] = self.train_dataset_cls(feature_root=feature_storage)
+
+        return datasets
+
+
+@registry.register_builder("cc_sbu_align_feature")
+class CCSBUAlignFeatureBuilder(FeatureStoreBuilder):
+    DATASET_CONFIG_DICT = {
+        "default": "configs/datasets/cc_sbu/align_feature.yaml",
+    }
+
+
+@registry.register_builder("laion_feature")
+class LaionFeatureBuilder(FeatureStoreBuilder):
+    DATASET_CONFIG_DICT = {
+        "default": "configs/datasets/laion/feature.yaml",
+    }
@@ -0,0 +1,29 @@
+import random
+
+from minigpt4.datasets.datasets.base_dataset import BaseDataset
+from minigpt4.datasets.feature_store import FeatureStore
+
+
+class FeatureCaptionDataset(BaseDataset):
+    """
+    Serves precomputed frozen vision features (see minigpt4.datasets.feature_store) instead of images.
+    Each access draws one of the stored augmentation views, which stands in for the random train
+    transform applied to the image every epoch. Captions are served as stored by the extraction job.
+    """
+
+    def __init__(self, feature_root, random_view=True):
+        super().__init__()
+        self.store = FeatureStore(feature_root)
+        self.random_view = random_view
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, index):
+        view = random.randrange(self.store.num_views) if self.random_view else 0
+
+        return {
+            "image_feature": self.store.get(index, view),
+            "answer": self.store.captions[index],
+            "image_id": index,
+        }
@@ -0,0 +1,153 @@
+"""
+Sharded, memory-mapped store of frozen vision features (Q-Former outputs before `llama_proj`).
+
+When the ViT and the Q-Former are frozen, their output only depends on the image and on the
+augmentation drawn by the vision processor. The store keeps one copy of the features per
+augmentation view (or a single eval-transform view), so fine-tuning only runs `llama_proj` and
+the LLM. Layout of a store directory:
+
+    meta.json                   version, feature shape / dtype, number of views, shard size,
+                                sample keys and captions (one entry per row)
+    view{v:03d}_{k:05d}.npy     rows [k * shard_size, (k + 1) * shard_size) of view v
+"""
+
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+STORE_VERSION = 1
+SHARD_SIZE = 4096
+
+
+def shard_path(root, view, shard):
+    return os.path.join(root, "view{:03d}_{:05d}.npy".format(view, shard))
+
+
+class FeatureStoreWriter:
+    """
+    Rows are appended in dataset order. Every view must visit the samples in the same order,
+    which is checked against the keys written by view 0.
+    """
+
+    def __init__(self, root, feature_shape, num_views=1, dtype="float16", shard_size=SHARD_SIZE):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.feature_shape = list(feature_shape)
+        self.num_views = num_views
+        self.dtype = dtype
+        self.shard_size = shard_size
+        self.keys = []
+        self.captions = []
+        self.rows = [0] * num_views
+        self.shards = {}
+
+    def _shard(self, view, shard):
+        if (view, shard) not in self.shards:
+            self.shards[(view, shard)] = np.lib.format.open_memmap(
+                shard_path(self.root, view, shard), mode="w+", dtype=self.dtype, shape=(self.shard_size, *self.feature_shape)
+            )
+        return self.shards[(view, shard)]
+
+    def write(self, view, features, keys, captions):
+        features = features.detach().to("cpu", torch.float32).numpy().astype(self.dtype)
+        for feature, key, caption in zip(features, keys, captions):
+            row = self.rows[view]
+            if view == 0:
+                self.keys.append(key)
+                self.captions.append(caption)
+            elif row >= len(self.keys) or self.keys[row] != key:
+                raise ValueError("View {} visits the samples in a different order than view 0.".format(view))
+            self._shard(view, row // self.shard_size)[row % self.shard_size] = feature
+            self.rows[view] += 1
+
+    def close(self):
+        for memmap in self.shards.values():
+            memmap.flush()
+        self.shards = {}
+        meta = {
+            "version": STORE_VERSION,
+            "num_items": len(self.keys),
+            "num_views": self.num_views,
+            "feature_shape": self.feature_shape,
+            "dtype": self.dtype,
+            "shard_size": self.shard_size,
+            "keys": self.keys,
+            "captions": self.captions,
+        }
+        with open(os.path.join(self.root, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+
+class FeatureStore:
+    """Read side. Shards are memory-mapped lazily, so each dataloader worker only maps what it reads."""
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta["version"] != STORE_VERSION:
+            raise ValueError(
+                "Feature store {} has version {}, expected {}.".format(root, meta["version"], STORE_VERSION)
+            )
+        self.num_items = meta["num_items"]
+        self.num_views = meta["num_views"]
+        self.feature_shape = meta["feature_shape"]
+        self.shard_size = meta["shard_size"]
+        self.keys = meta["keys"]
+        self.captions = meta["captions"]
+        self.shards = {}
+
+    def __len__(self):
+        return self.num_items
+
+    def get(self, index, view=0):
+        shard = index // self.shard_size
+        if (view, shard) not in self.shards:
+            self.shards[(view, shard)] = np.load(shard_path(self.root, view, shard), mmap_mode="r")
+        return torch.from_numpy(np.array(self.shards[(view, shard)][index % self.shard_size], dtype=np.float32))
+
+    def __getstate__(self):
+        # do not ship open memmaps to dataloader workers.
+        state = self.__dict__.copy()
+        state["shards"] = {}
+        return state
+
+
+@torch.no_grad()
+def extract_features(model, dataset, root, num_views=1, seed=42, batch_size=64, num_workers=4, shard_size=SHARD_SIZE):
+    """
+    Run the frozen vision tower + Q-Former of `model` (see `MiniGPT4.encode_img_features`) over
+    `dataset`, whose samples are {"key", "image", "answer"}, and write the result to `root`.
+    View v is produced with the dataloader seeded by `seed + v`, so a random train transform yields
+    a reproducible augmentation per view. Use num_views=1 with the eval transform for no augmentation.
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    writer = None
+    for view in range(num_views):
+        generator = torch.Generator()
+        generator.manual_seed(seed + view)
+        torch.manual_seed(seed + view)
+        loader = DataLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
+            pin_memory=True,
+            generator=generator,
+        )
+        for samples in tqdm(loader, desc="view {}".format(view)):
+            features = model.encode_img_features(samples["image"].to(device, non_blocking=True))
+            if writer is None:
+                writer = FeatureStoreWriter(root, features.shape[1:], num_views=num_views, shard_size=shard_size)
+            keys = [str(key) for key in (samples["key"].tolist() if torch.is_tensor(samples["key"]) else samples["key"])]
+            writer.write(view, features, keys, samples["answer"])
+    if writer is None:
+        # the writer is created on the first batch, so an empty dataset leaves nothing to close or read
+        raise ValueError("Dataset is empty, no features were written to {}.".format(root))
+    writer.close()
+    return FeatureStore(root)
@@ -210,7 +210,8 @@ class Blip2VicunaInstruct(Blip2Base):
 
         with self.maybe_autocast():
             inputs_embeds = self.llm_model.get_input_embeddings()(llm_tokens.input_ids)
-            inputs_embeds = torch.cat([inputs_llm, inputs_embeds], dim=1)
+            # one prompt for every image of the batch (e.g. HALC's crops)
+            inputs_embeds = torch.cat([inputs_llm, inputs_embeds.expand(inputs_llm.shape[0], -1, -1)], dim=1)
 
         return inputs_embeds
 
@@ -335,6 +336,9 @@ class Blip2VicunaInstruct(Blip2Base):
         output_attentions=False,
         premature_layer=None,
         candidate_premature_layers=None,
+        jsd_top_k=None,
+        decode_budget=None,
+        decode_engine=False,
         mature_layer=None,
         beam_search=False,
         dola_decoding = False,
@@ -499,6 +503,9 @@ class Blip2VicunaInstruct(Blip2Base):
                 output_attentions=output_attentions,
                 premature_layer=premature_layer,
                 candidate_premature_layers=candidate_premature_layers,
+                jsd_top_k=jsd_top_k,
+                decode_budget=decode_budget,
+                decode_engine=decode_engine,
                 mature_layer=mature_layer,
                 beam_search=beam_search,
                 dola_decoding=dola_decoding,
@@ -72,6 +72,9 @@ class Attention(nn.Module):
             head_dim = attn_head_dim
         all_head_dim = head_dim * self.num_heads
         self.scale = qk_scale or head_dim ** -0.5
+        # scaled_dot_product_attention divides by sqrt(head_dim) itself (torch 2.0 has no `scale` argument)
+        self.sdpa_q_scale = self.scale * math.sqrt(head_dim)
+        self.use_sdpa = hasattr(F, "scaled_dot_product_attention")
 
         self.qkv = nn.Linear(dim, all_head_dim * 3, bias=False)
         if qkv_bias:
@@ -125,24 +128,38 @@ class Attention(nn.Module):
         qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-
+        # relative position biases, as one additive mask
+        bias = None
         if self.relative_position_bias_table is not None:
             relative_position_bias = \
                 self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
                     self.window_size[0] * self.window_size[1] + 1,
                     self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
             relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-            attn = attn + relative_position_bias.unsqueeze(0)
+            bias = relative_position_bias.unsqueeze(0)
 
         if rel_pos_bias is not None:
-            attn = attn + rel_pos_bias
-        
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+            bias = rel_pos_bias if bias is None else bias + rel_pos_bias
+
+        if self.use_sdpa:
+            if self.sdpa_q_scale != 1.0:
+                q = q * self.sdpa_q_scale
+            if bias is not None:
+                bias = bias.to(q.dtype).expand(B, -1, -1, -1)
+            x = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=bias, dropout_p=self.attn_drop.p if self.training else 0.0
+            )
+        else:
+            q = q * self.scale
+            attn = (q @ k.transpose(-2, -1))
+            if bias is not None:
+                attn = attn + bias
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
+
+        x = x.transpose(1, 2).reshape(B, N, -1)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -342,6 +359,13 @@ class VisionTransformer(nn.Module):
         return x, None
     
     def early_exit_forward_features(self, x, early_exit_layer_idx):
+        """
+        Run the blocks only up to the deepest requested exit. `early_exit_layer_idx` is a block index
+        or a list of them; the features after each requested block are returned in the requested order,
+        together with the output of the last block that was run (not the full tower).
+        """
+        exit_layers = list(early_exit_layer_idx) if isinstance(early_exit_layer_idx, (list, tuple)) else [early_exit_layer_idx]
+        last_layer = max(exit_layers)
 
         x = self.patch_embed(x)
         batch_size, seq_len, _ = x.size()
@@ -353,23 +377,18 @@ class VisionTransformer(nn.Module):
         x = self.pos_drop(x)
 
         rel_pos_bias = self.rel_pos_bias() if self.rel_pos_bias is not None else None
-        early_exit_features = []
-        # for blk_idx, blk in enumerate(self.blocks):
-        #     if self.use_checkpoint:
-        #         x = checkpoint.checkpoint(blk, x, rel_pos_bias)
-        #     else:
-        #         x = blk(x, rel_pos_bias)
-        #     if blk_idx in self.early_exit_layers:
-        #         early_exit_features.append(x)
-        for blk_idx, blk in enumerate(self.blocks):
+        exit_features = {}
+        # the tail blocks after the deepest exit would only be discarded, skip them.
+        for blk_idx, blk in enumerate(self.blocks[: last_layer + 1]):
             if self.use_checkpoint:
                 x = checkpoint.checkpoint(blk, x, rel_pos_bias)
             else:
                 x = blk(x, rel_pos_bias)
 
-            if blk_idx == early_exit_layer_idx:
-                early_exit_features.append(x)
-                
+            if blk_idx in exit_layers:
+                exit_features[blk_idx] = x
+
+        early_exit_features = [exit_features[idx] for idx in exit_layers if idx in exit_features]
         return x, early_exit_features
 
 
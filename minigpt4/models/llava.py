@@ -149,6 +149,9 @@ class LLaVa(BaseModel):
         output_attentions=False,
         premature_layer=None,
         candidate_premature_layers=None,
+        jsd_top_k=None,
+        decode_budget=None,
+        decode_engine=False,
         mature_layer=None,
         beam_search=False,
         dola_decoding = False,
@@ -240,6 +243,9 @@ class LLaVa(BaseModel):
                 output_attentions=output_attentions,
                 premature_layer=premature_layer,
                 candidate_premature_layers=candidate_premature_layers,
+                jsd_top_k=jsd_top_k,
+                decode_budget=decode_budget,
+                decode_engine=decode_engine,
                 mature_layer=mature_layer,
                 beam_search=beam_search,
                 dola_decoding=dola_decoding,
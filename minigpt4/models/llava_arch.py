@@ -246,7 +246,7 @@ class LlavaMetaForCausalLM(ABC):
         vision_tower = self.get_vision_tower()
         if vision_tower is None or images is None or input_ids.shape[1] == 1:
             if past_key_values is not None and vision_tower is not None and images is not None and input_ids.shape[1] == 1:
-                attention_mask = torch.ones((attention_mask.shape[0], past_key_values[-1][-1].shape[-2] + 1), dtype=attention_mask.dtype, device=attention_mask.device)
+                attention_mask = self.extend_multimodal_attention_mask(attention_mask, past_key_values[-1][-1].shape[-2] + 1)
             return input_ids, attention_mask, past_key_values, None, labels
 
         if type(images) is list or images.ndim == 5:
@@ -258,6 +258,101 @@ class LlavaMetaForCausalLM(ABC):
         else:
             image_features = self.encode_images(images)
 
+        if getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False):
+            # adapter tuning detaches part of the text embeddings, which the per-sample splice handles
+            return self.splice_multimodal_per_sample(input_ids, attention_mask, past_key_values, labels, image_features)
+        return self.splice_multimodal(input_ids, attention_mask, past_key_values, labels, image_features)
+
+    def splice_multimodal(self, input_ids, attention_mask, past_key_values, labels, image_features):
+        """
+        Replace every IMAGE_TOKEN_INDEX of `input_ids` by the features of its image, for the whole batch
+        at once: the output position of every token is computed up front, all text tokens are embedded
+        in one call and text and image features are scattered into one preallocated tensor. Padding
+        tokens (attention_mask == 0) are dropped wherever they are and the rows re-padded on the left,
+        as batched generation needs. Training batches (with labels) are re-padded on the side
+        config.tokenizer_padding_side asks for, or else on the side the input was padded on.
+        As in the per-sample splice, images are consumed in order, and a row without an image token
+        still consumes (and ignores) one.
+        """
+        batch_size, seq_len = input_ids.shape
+        device = input_ids.device
+        is_image = input_ids == IMAGE_TOKEN_INDEX
+        if attention_mask is None:
+            keep = torch.ones_like(is_image)
+        else:
+            keep = attention_mask.bool() | is_image
+        # generation always needs left padding, whatever the config saved at training time says
+        padding_side = 'left'
+        if labels is not None:
+            padding_side = getattr(self.config, 'tokenizer_padding_side', None)
+            if padding_side is None:
+                right_padded = attention_mask is None or bool((attention_mask[:, -1] == 0).any())
+                padding_side = 'right' if right_padded else 'left'
+        left_padding = padding_side == 'left'
+
+        if isinstance(image_features, torch.Tensor):
+            num_images, num_patches = image_features.shape[:2]
+            image_lengths = torch.full((num_images,), num_patches, dtype=torch.long, device=device)
+            flat_features = image_features.reshape(num_images * num_patches, -1)
+        else:
+            image_lengths = torch.tensor([x.shape[0] for x in image_features], dtype=torch.long, device=device)
+            flat_features = torch.cat(list(image_features), dim=0)
+        image_offsets = torch.cumsum(image_lengths, 0) - image_lengths
+
+        # index of the image behind every image token
+        images_per_row = is_image.sum(1)
+        first_image = torch.cumsum(images_per_row.clamp(min=1), 0) - images_per_row.clamp(min=1)
+        image_idx = first_image[:, None] + torch.cumsum(is_image.long(), 1) - 1
+
+        # output width and start position of every input token
+        widths = keep.long()
+        widths[is_image] = image_lengths[image_idx[is_image]]
+        new_lengths = widths.sum(1)
+        max_len = int(new_lengths.max())
+        starts = torch.cumsum(widths, 1) - widths
+        if left_padding:
+            starts = starts + (max_len - new_lengths)[:, None]
+
+        rows = torch.arange(batch_size, device=device)[:, None].expand(batch_size, seq_len)
+        is_text = keep & ~is_image
+        text_embeds = self.get_model().embed_tokens(input_ids[is_text])
+        new_input_embeds = torch.zeros((batch_size, max_len, text_embeds.shape[-1]), dtype=text_embeds.dtype, device=device)
+        new_input_embeds[rows[is_text], starts[is_text]] = text_embeds
+
+        placed = image_idx[is_image]
+        placed_lengths = image_lengths[placed]
+        within = torch.arange(int(placed_lengths.sum()), device=device) - torch.repeat_interleave(
+            torch.cumsum(placed_lengths, 0) - placed_lengths, placed_lengths
+        )
+        feature_rows = torch.repeat_interleave(image_offsets[placed], placed_lengths) + within
+        new_input_embeds[
+            torch.repeat_interleave(rows[is_image], placed_lengths),
+            torch.repeat_interleave(starts[is_image], placed_lengths) + within,
+        ] = flat_features[feature_rows].to(device=device, dtype=new_input_embeds.dtype)
+
+        new_labels = None
+        if labels is not None:
+            new_labels = torch.full((batch_size, max_len), IGNORE_INDEX, dtype=labels.dtype, device=labels.device)
+            new_labels[rows[is_text], starts[is_text]] = labels[is_text]
+
+        if attention_mask is not None or bool((new_lengths != max_len).any()):
+            positions = torch.arange(max_len, device=device)[None]
+            first = (max_len - new_lengths)[:, None] if left_padding else torch.zeros_like(new_lengths)[:, None]
+            new_attention_mask = (positions >= first) & (positions < first + new_lengths[:, None])
+            attention_mask = new_attention_mask.to(attention_mask.dtype if attention_mask is not None else torch.long)
+
+        return None, attention_mask, past_key_values, new_input_embeds, new_labels
+
+    def extend_multimodal_attention_mask(self, attention_mask, target_length):
+        # the cache holds the spliced prompt. generate() carries the prefill's spliced mask in its
+        # model_kwargs (see LlavaLlamaForCausalLM._update_model_kwargs_for_generation), so the mask of a
+        # decoding step already covers the cache and the new token; a mask of the unspliced prompt
+        # (a caller's own loop) attends every position.
+        if attention_mask.shape[1] == target_length:
+            return attention_mask
+        return torch.ones((attention_mask.shape[0], target_length), dtype=attention_mask.dtype, device=attention_mask.device)
+
+    def splice_multimodal_per_sample(self, input_ids, attention_mask, past_key_values, labels, image_features):
         new_input_embeds = []
         new_labels = [] if labels is not None else None
         cur_image_idx = 0
@@ -75,11 +75,19 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
         )
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
         input_ids, attention_mask, past_key_values, inputs_embeds, labels = self.prepare_inputs_labels_for_multimodal(input_ids, attention_mask, past_key_values, labels, images)
+        # mask of the spliced prompt of a prefill, handed back to generate(), see _update_model_kwargs_for_generation
+        prompt_attention_mask = attention_mask if images is not None and inputs_embeds is not None else None
+
+        if position_ids is None and attention_mask is not None and attention_mask.shape[0] > 1:
+            # batched (left-)padded inputs: positions count from the first attended token of each row
+            position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+            position_ids = position_ids[:, -(input_ids if input_ids is not None else inputs_embeds).shape[1]:]
 
         # decoder outputs consists of (dec_features, layer_state, dec_hidden, dec_attn)
         outputs = self.model(
             input_ids=input_ids,
             attention_mask=attention_mask,
+            position_ids=position_ids,
             past_key_values=past_key_values,
             inputs_embeds=inputs_embeds,
             use_cache=use_cache,
@@ -114,6 +122,7 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
                 hidden_states=outputs.hidden_states,
                 attentions=outputs.attentions,
             )
+            final_outputs.prompt_attention_mask = prompt_attention_mask
             return logits_dict, final_outputs
         else:
             hidden_states = outputs[0]
@@ -136,13 +145,24 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
                 output = (logits,) + outputs[1:]
                 return (loss,) + output if loss is not None else output
 
-            return CausalLMOutputWithPast(
+            final_outputs = CausalLMOutputWithPast(
                 loss=loss,
                 logits=logits,
                 past_key_values=outputs.past_key_values,
                 hidden_states=outputs.hidden_states,
                 attentions=outputs.attentions,
             )
+            final_outputs.prompt_attention_mask = prompt_attention_mask
+            return final_outputs
+
+    def _update_model_kwargs_for_generation(self, outputs, model_kwargs, **kwargs):
+        # after a prefill, the cache holds the spliced prompt: carry its mask instead of the one of the
+        # input ids, so each decoding loop (and each VCD / HALC branch, with its own kwargs) extends the
+        # mask of its own prompt.
+        prompt_attention_mask = getattr(outputs, "prompt_attention_mask", None)
+        if prompt_attention_mask is not None:
+            model_kwargs["attention_mask"] = prompt_attention_mask
+        return super()._update_model_kwargs_for_generation(outputs, model_kwargs, **kwargs)
 
     def prepare_inputs_for_generation(
         self, input_ids, past_key_values=None, attention_mask=None, inputs_embeds=None, **kwargs
@@ -168,6 +168,14 @@ class MiniGPT4(Blip2Base):
         self.visual_encoder.float()
 
     def encode_img(self, image, early_exit_layer_idx=None):
+        image_features = self.encode_img_features(image, early_exit_layer_idx)
+        return self.project_img_features(image_features)
+
+    def encode_img_features(self, image, early_exit_layer_idx=None):
+        """
+        Frozen part of `encode_img`: vision tower (+ Q-Former), up to but excluding `llama_proj`.
+        Its output can be precomputed offline, see minigpt4.datasets.feature_store.
+        """
         device = image.device
         if self.low_resource:
             self.vit_to_cpu()
@@ -197,14 +205,17 @@ class MiniGPT4(Blip2Base):
                     return_dict=True,
                 )
 
-                inputs_llama = self.llama_proj(query_output.last_hidden_state)
+                image_features = query_output.last_hidden_state
             else:
                 image_embeds = image_embeds[:, 1:, :]
                 bs, pn, hs = image_embeds.shape
-                image_embeds = image_embeds.view(bs, int(pn / 4), int(hs * 4))
+                image_features = image_embeds.view(bs, int(pn / 4), int(hs * 4))
+        return image_features
 
-                inputs_llama = self.llama_proj(image_embeds)
-            atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(image.device)
+    def project_img_features(self, image_features):
+        with self.maybe_autocast():
+            inputs_llama = self.llama_proj(image_features)
+            atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(image_features.device)
         return inputs_llama, atts_llama
 
     def get_context_emb(self, prompt, img_list):
@@ -217,7 +228,8 @@ class MiniGPT4(Blip2Base):
             # only add bos to the first seg
             for i, seg in enumerate(prompt_segs)
         ]
-        seg_embs = [self.embed_tokens(seg_t) for seg_t in seg_tokens]
+        # the prompt is shared by every image of a batch in img_list (e.g. HALC's crops)
+        seg_embs = [self.embed_tokens(seg_t).expand(img_list[0].shape[0], -1, -1) for seg_t in seg_tokens]
 
         mixed_embs = [emb for pair in zip(seg_embs[:-1], img_list) for emb in pair] + [seg_embs[-1]]
         mixed_embs = torch.cat(mixed_embs, dim=1)
@@ -283,8 +295,12 @@ class MiniGPT4(Blip2Base):
         return cat_embs, cat_atts, input_lens
 
     def forward(self, samples):
-        image = samples["image"]
-        img_embeds, atts_img = self.encode_img(image)
+        if "image_feature" in samples:
+            # frozen vision features served from a feature store, only llama_proj runs here.
+            img_embeds, atts_img = self.project_img_features(samples["image_feature"])
+        else:
+            img_embeds, atts_img = self.encode_img(samples["image"])
+        device = img_embeds.device
 
         if self.prompt_list:
             instruction = random.choice(self.prompt_list)
@@ -303,7 +319,7 @@ class MiniGPT4(Blip2Base):
             truncation=True,
             max_length=self.max_txt_len,
             add_special_tokens=False
-        ).to(image.device)
+        ).to(device)
 
         batch_size = img_embeds.shape[0]
         bos = torch.ones([batch_size, 1],
@@ -323,7 +339,7 @@ class MiniGPT4(Blip2Base):
         )
         targets = (
             torch.ones([inputs_embeds.shape[0], inputs_embeds.shape[1]],
-                       dtype=torch.long).to(image.device).fill_(-100)
+                       dtype=torch.long).to(device).fill_(-100)
         )
 
         for i, target in enumerate(part_targets):
@@ -357,6 +373,9 @@ class MiniGPT4(Blip2Base):
         output_attentions=False,
         premature_layer=None,
         candidate_premature_layers=None,
+        jsd_top_k=None,
+        decode_budget=None,
+        decode_engine=False,
         mature_layer=None,
         beam_search=False,
         dola_decoding = False,
@@ -423,6 +442,9 @@ class MiniGPT4(Blip2Base):
                 output_attentions=output_attentions,
                 premature_layer=premature_layer,
                 candidate_premature_layers=candidate_premature_layers,
+                jsd_top_k=jsd_top_k,
+                decode_budget=decode_budget,
+                decode_engine=decode_engine,
                 mature_layer=mature_layer,
                 beam_search=beam_search,
                 dola_decoding=dola_decoding,
@@ -140,6 +140,104 @@ class LlamaMLP(nn.Module):
         return self.down_proj(self.act_fn(self.gate_proj(x)) * self.up_proj(x))
 
 
+class StaticKVCache:
+    """
+    Pre-allocated key / value cache of `max_length` positions for every decoder layer.
+
+    The dynamic cache of `LlamaAttention` concatenates the new keys / values to the whole history at
+    every step, so each generated token copies all previous ones in every layer. Here every layer owns
+    two buffers of shape `(batch, num_heads, max_length, head_dim)`. New states are written in place at
+    `[length, length + q_len)`, and attention reads the view `[:length + q_len]`. Pass an (empty)
+    instance as `past_key_values`; the model hands the same object back as its cache.
+
+    `reorder` (beam search) and `fork` only touch the filled prefix. `truncate` rolls back in O(1).
+    """
+
+    def __init__(self, num_layers, batch_size, num_heads, head_dim, max_length, dtype=torch.float16, device=None):
+        shape = (batch_size, num_heads, max_length, head_dim)
+        self.key_cache = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.value_cache = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.max_length = max_length
+        self.length = 0
+
+    @classmethod
+    def from_config(cls, config: LlamaConfig, batch_size, max_length, dtype=torch.float16, device=None):
+        head_dim = config.hidden_size // config.num_attention_heads
+        return cls(
+            config.num_hidden_layers, batch_size, config.num_attention_heads, head_dim, max_length, dtype, device
+        )
+
+    @classmethod
+    def from_legacy_cache(cls, past_key_values, max_length):
+        batch_size, num_heads, length, head_dim = past_key_values[0][0].shape
+        key = past_key_values[0][0]
+        cache = cls(len(past_key_values), batch_size, num_heads, head_dim, max_length, key.dtype, key.device)
+        for layer_idx, (key_states, value_states) in enumerate(past_key_values):
+            cache.key_cache[layer_idx][:, :, :length] = key_states
+            cache.value_cache[layer_idx][:, :, :length] = value_states
+        cache.length = length
+        return cache
+
+    def __bool__(self):
+        # an empty cache behaves like `past_key_values=None` in `prepare_inputs_for_generation`.
+        return self.length > 0
+
+    def __len__(self):
+        return len(self.key_cache)
+
+    def __getitem__(self, layer_idx):
+        # legacy `(key, value)` views of the filled prefix, e.g. for `past_key_values[0][0].shape[2]`.
+        return (
+            self.key_cache[layer_idx][:, :, : self.length],
+            self.value_cache[layer_idx][:, :, : self.length],
+        )
+
+    @property
+    def batch_size(self):
+        return self.key_cache[0].shape[0]
+
+    def update(self, layer_idx, key_states, value_states):
+        """Write the states of the current forward after the filled prefix; return the layer's full views."""
+        end = self.length + key_states.shape[-2]
+        if end > self.max_length:
+            raise ValueError(f"StaticKVCache holds {self.max_length} positions, but {end} are needed.")
+        self.key_cache[layer_idx][:, :, self.length : end] = key_states
+        self.value_cache[layer_idx][:, :, self.length : end] = value_states
+        return self.key_cache[layer_idx][:, :, :end], self.value_cache[layer_idx][:, :, :end]
+
+    def advance(self, num_tokens):
+        # called once per forward, after every layer wrote its states.
+        self.length += num_tokens
+
+    def truncate(self, length):
+        """Roll back to the first `length` positions; the stale tail is overwritten by the next write."""
+        if length > self.length:
+            raise ValueError(f"Cannot truncate a cache of length {self.length} to {length}.")
+        self.length = length
+
+    def reorder(self, beam_idx):
+        """In-place `index_select` over the batch of the filled prefix, for beam search."""
+        for cache in self.key_cache + self.value_cache:
+            cache[:, :, : self.length] = cache[:, :, : self.length].index_select(0, beam_idx.to(cache.device))
+        return self
+
+    def fork(self, batch_idx=None):
+        """A new cache with the same capacity holding a copy of the filled prefix (of rows `batch_idx`)."""
+        key = self.key_cache[0]
+        batch_size = self.batch_size if batch_idx is None else len(batch_idx)
+        cache = StaticKVCache(
+            len(self.key_cache), batch_size, key.shape[1], key.shape[3], self.max_length, key.dtype, key.device
+        )
+        for src, dst in zip(self.key_cache + self.value_cache, cache.key_cache + cache.value_cache):
+            prefix = src[:, :, : self.length]
+            dst[:, :, : self.length] = prefix if batch_idx is None else prefix.index_select(0, batch_idx.to(src.device))
+        cache.length = self.length
+        return cache
+
+    def to_legacy_cache(self):
+        return tuple(self[layer_idx] for layer_idx in range(len(self)))
+
+
 class LlamaAttention(nn.Module):
     """Multi-headed attention from 'Attention Is All You Need' paper"""
 
@@ -161,6 +259,8 @@ class LlamaAttention(nn.Module):
         self.v_proj = nn.Linear(self.hidden_size, self.num_heads * self.head_dim, bias=False)
         self.o_proj = nn.Linear(self.num_heads * self.head_dim, self.hidden_size, bias=False)
         self.rotary_emb = LlamaRotaryEmbedding(self.head_dim, max_position_embeddings=self.max_position_embeddings)
+        # fused attention (torch >= 2.0) unless the attention weights are requested, e.g. by OPERA
+        self.use_sdpa = hasattr(nn.functional, "scaled_dot_product_attention")
 
     def _shape(self, tensor: torch.Tensor, seq_len: int, bsz: int):
         return tensor.view(bsz, seq_len, self.num_heads, self.head_dim).transpose(1, 2).contiguous()
@@ -182,37 +282,55 @@ class LlamaAttention(nn.Module):
         value_states = self.v_proj(hidden_states).view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
 
         kv_seq_len = key_states.shape[-2]
-        if past_key_value is not None:
+        if isinstance(past_key_value, StaticKVCache):
+            kv_seq_len += past_key_value.length
+        elif past_key_value is not None:
             kv_seq_len += past_key_value[0].shape[-2]
         cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
         # [bsz, nh, t, hd]
 
-        if past_key_value is not None:
+        if isinstance(past_key_value, StaticKVCache):
+            # write k, v in place; the cache object itself is the layer's present
+            key_states, value_states = past_key_value.update(layer_idx, key_states, value_states)
+        elif past_key_value is not None:
             # reuse k, v, self_attention
             key_states = torch.cat([past_key_value[0], key_states], dim=2)
             value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        past_key_value = (key_states, value_states) if use_cache else None
-
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+        if not isinstance(past_key_value, StaticKVCache):
+            past_key_value = (key_states, value_states) if use_cache else None
 
-        if attn_weights.size() != (bsz, self.num_heads, q_len, kv_seq_len):
+        if attention_mask is not None and attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
             raise ValueError(
-                f"Attention weights should be of size {(bsz * self.num_heads, q_len, kv_seq_len)}, but is"
-                f" {attn_weights.size()}"
+                f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
             )
 
-        if attention_mask is not None:
-            if attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
+        if self.use_sdpa and not output_attentions:
+            if attention_mask is not None:
+                # clamp the summed causal + padding mask like the eager path, so fully masked rows stay finite
+                attention_mask = torch.max(
+                    attention_mask, torch.tensor(torch.finfo(query_states.dtype).min, device=attention_mask.device)
+                )
+            attn_weights = None
+            attn_output = nn.functional.scaled_dot_product_attention(
+                query_states, key_states, value_states, attn_mask=attention_mask
+            )
+        else:
+            attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+
+            if attn_weights.size() != (bsz, self.num_heads, q_len, kv_seq_len):
                 raise ValueError(
-                    f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
+                    f"Attention weights should be of size {(bsz * self.num_heads, q_len, kv_seq_len)}, but is"
+                    f" {attn_weights.size()}"
                 )
-            attn_weights = attn_weights + attention_mask
-            attn_weights = torch.max(attn_weights, torch.tensor(torch.finfo(attn_weights.dtype).min))
 
-        attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
-        attn_output = torch.matmul(attn_weights, value_states)
+            if attention_mask is not None:
+                attn_weights = attn_weights + attention_mask
+                attn_weights = torch.max(attn_weights, torch.tensor(torch.finfo(attn_weights.dtype).min))
+
+            attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+            attn_output = torch.matmul(attn_weights, value_states)
 
         if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
             raise ValueError(
@@ -504,8 +622,12 @@ layer_idx
 
         seq_length_with_past = seq_length
         past_key_values_length = 0
+        static_cache = past_key_values if isinstance(past_key_values, StaticKVCache) else None
 
-        if past_key_values is not None:
+        if static_cache is not None:
+            past_key_values_length = static_cache.length
+            seq_length_with_past = seq_length_with_past + past_key_values_length
+        elif past_key_values is not None:
             past_key_values_length = past_key_values[0][0].shape[2]
             seq_length_with_past = seq_length_with_past + past_key_values_length
 
@@ -545,7 +667,11 @@ layer_idx
             if output_hidden_states:
                 all_hidden_states += (hidden_states,)
 
-            past_key_value = past_key_values[idx] if past_key_values is not None else None
+            if static_cache is not None:
+                # every layer writes into its slot of the shared cache, see `StaticKVCache.update`
+                past_key_value = static_cache
+            else:
+                past_key_value = past_key_values[idx] if past_key_values is not None else None
 
             if self.gradient_checkpointing and self.training:
 
@@ -576,12 +702,16 @@ layer_idx
 
             hidden_states = layer_outputs[0]
 
-            if use_cache:
+            if use_cache and static_cache is None:
                 next_decoder_cache += (layer_outputs[2 if output_attentions else 1],)
 
             if output_attentions:
                 all_self_attns += (layer_outputs[1],)
 
+        if static_cache is not None:
+            static_cache.advance(seq_length)
+            next_decoder_cache = static_cache if use_cache else None
+
         hidden_states = self.norm(hidden_states)
 
         # add hidden states from the last decoder layer
@@ -733,7 +863,8 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
                 query_embeds = None
 
         # if `inputs_embeds` are passed, we only want to use them in the 1st generation step
-        if inputs_embeds is not None and past_key_values is None:
+        # (an empty `StaticKVCache` is falsy, so it counts as the 1st step too)
+        if inputs_embeds is not None and not past_key_values:
             model_inputs = {"inputs_embeds": inputs_embeds}
         else:
             model_inputs = {"input_ids": input_ids}
@@ -749,10 +880,275 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
         )
         return model_inputs
 
+    def allocate_static_cache(self, batch_size, max_length, dtype=None, device=None):
+        """An empty `StaticKVCache` for this model, to be passed as `past_key_values` to `generate`."""
+        return StaticKVCache.from_config(
+            self.config,
+            batch_size,
+            max_length,
+            dtype=dtype if dtype is not None else self.dtype,
+            device=device if device is not None else self.device,
+        )
+
     @staticmethod
     def _reorder_cache(past_key_values, beam_idx):
+        if isinstance(past_key_values, StaticKVCache):
+            return past_key_values.reorder(beam_idx)
         reordered_past = ()
         for layer_past in past_key_values:
             reordered_past += (tuple(past_state.index_select(0, beam_idx) for past_state in layer_past),)
         return reordered_past
 
+
+
+class StaticDecodeStep:
+    """
+    Fixed-shape single-token decode step of a `LlamaForCausalLM` over a `StaticKVCache`, for
+    `transformers.generation.decode_engine` (`decode_step=`).
+
+    The eager forward of a decode step launches a few hundred small kernels and re-creates its masks,
+    position ids and cache views at every step; at batch 1 on a 7B model the launches dominate. Here
+    every tensor a step reads or writes lives in a pre-allocated buffer: the token, the position of the
+    next token per row, its cache slot, a `(batch, max_length)` key mask, and the cache itself.
+    Attention always runs over the whole cache with the key mask, so every step has the same shapes
+    and can be compiled (`capture="compile"`, also on CPU) or replayed as a CUDA graph
+    (`capture="graph"`).
+
+    One step covers:
+        - the plain forward: the last position's logits;
+        - `early_exit_layers` (DoLa): the hidden states of these layers projected by `lm_head` in one
+          matmul, as the `early_exit_layers` forward of transformers' llama returns them;
+        - `contrast_alpha` (VCD): the cache holds twice the batch, the rows `[batch:]` prefilled with
+          `set_contrast_inputs` (e.g. the distorted image prompt); both branches run in one forward and
+          the step returns their contrast under the adaptive plausibility cutoff `contrast_beta`.
+          Unlike evolve_vcd_sampling, the contrast branch keeps its own cache after the prompt.
+
+    The prompt, multi-token inputs (e.g. a verification / rollback window) and steps after an
+    external `truncate` of the cache fall back to the eager forward, which re-syncs the buffers.
+    """
+
+    def __init__(
+        self,
+        model,
+        cache: StaticKVCache,
+        early_exit_layers: Optional[List[int]] = None,
+        contrast_alpha: Optional[float] = None,
+        contrast_beta: float = 0.1,
+        capture: str = "compile",
+    ):
+        if capture not in ("eager", "compile", "graph"):
+            raise ValueError(f"`capture` must be 'eager', 'compile' or 'graph', got {capture}.")
+        if early_exit_layers is not None and contrast_alpha is not None:
+            raise ValueError("A decode step either exits early (DoLa) or contrasts two branches (VCD), not both.")
+        if contrast_alpha is not None and cache.batch_size % 2:
+            raise ValueError("A contrastive decode step needs a cache of twice the batch size.")
+        self.model = model
+        self.cache = cache
+        self.early_exit_layers = early_exit_layers
+        self.contrast_alpha = contrast_alpha
+        self.log_contrast_beta = math.log(contrast_beta)
+        self.capture = capture
+
+        device = cache.key_cache[0].device
+        rows = cache.batch_size
+        self.input_ids = torch.zeros(rows, 1, dtype=torch.long, device=device)
+        self.position_ids = torch.zeros(rows, 1, dtype=torch.long, device=device)
+        self.cache_position = torch.zeros(1, dtype=torch.long, device=device)
+        self.key_mask = torch.zeros(rows, cache.max_length, dtype=torch.bool, device=device)
+        # every layer has the same rotary table
+        rotary_emb = model.model.layers[0].self_attn.rotary_emb
+        cos, sin = rotary_emb(cache.key_cache[0], seq_len=cache.max_length)
+        self.cos, self.sin = cos[0, 0], sin[0, 0]
+
+        self.length = 0
+        self.contrast_inputs = None
+        self.compiled_step = None
+        self.graph = None
+        self.graph_output = None
+
+    @property
+    def batch_size(self):
+        return self.cache.batch_size // 2 if self.contrast_alpha is not None else self.cache.batch_size
+
+    def reset(self):
+        """Empty the cache for a new prompt; a compiled step / captured graph is kept."""
+        self.cache.truncate(0)
+        self.length = 0
+
+    def set_contrast_inputs(self, inputs_embeds, attention_mask=None):
+        """Prompt of the contrast rows, consumed by the prefill; same length as the main prompt."""
+        self.contrast_inputs = (inputs_embeds, attention_mask)
+
+    def __call__(self, model_inputs):
+        """`(dict_outputs, outputs)` like `DecodeEngine.forward`; `dict_outputs` is None without early exit."""
+        input_ids = model_inputs.get("input_ids")
+        if (
+            self.cache.length == 0
+            or self.cache.length != self.length
+            or model_inputs.get("inputs_embeds") is not None
+            or input_ids.shape[1] != 1
+        ):
+            return self.eager(model_inputs)
+        if self.length >= self.cache.max_length:
+            raise ValueError(f"StaticKVCache holds {self.cache.max_length} positions, but {self.length + 1} are needed.")
+
+        self.input_ids.copy_(self.expand(input_ids))
+        if self.capture == "graph":
+            output = self.replay()
+        elif self.capture == "compile":
+            if self.compiled_step is None:
+                self.compiled_step = torch.compile(self.step, dynamic=False)
+            output = self.compiled_step()
+        else:
+            output = self.step()
+        self.cache.advance(1)
+        self.length += 1
+        return self.wrap(output)
+
+    def expand(self, tensor):
+        return torch.cat([tensor, tensor], dim=0) if self.contrast_alpha is not None else tensor
+
+    def step(self):
+        model = self.model.model
+        dtype = self.cos.dtype
+        position = self.cache_position
+        self.key_mask.index_fill_(1, position, True)
+        attention_mask = torch.zeros(self.key_mask.shape, dtype=dtype, device=self.key_mask.device)
+        attention_mask = attention_mask.masked_fill(~self.key_mask, torch.finfo(dtype).min)[:, None, None, :]
+        cos = self.cos.index_select(0, self.position_ids.view(-1))[:, None, None, :]
+        sin = self.sin.index_select(0, self.position_ids.view(-1))[:, None, None, :]
+
+        hidden_states = model.embed_tokens(self.input_ids)
+        all_hidden_states = []
+        for layer_idx, layer in enumerate(model.layers):
+            all_hidden_states.append(hidden_states)
+            residual = hidden_states
+            hidden_states = residual + self.attention(
+                layer.self_attn, layer.input_layernorm(hidden_states), layer_idx, attention_mask, cos, sin
+            )
+            residual = hidden_states
+            hidden_states = residual + layer.mlp(layer.post_attention_layernorm(hidden_states))
+        hidden_states = model.norm(hidden_states)
+        all_hidden_states.append(hidden_states)
+
+        self.cache_position.add_(1)
+        self.position_ids.add_(1)
+        return self.project(all_hidden_states)
+
+    def attention(self, attn, hidden_states, layer_idx, attention_mask, cos, sin):
+        bsz = hidden_states.shape[0]
+        query_states = attn.q_proj(hidden_states).view(bsz, 1, attn.num_heads, attn.head_dim).transpose(1, 2)
+        key_states = attn.k_proj(hidden_states).view(bsz, 1, attn.num_heads, attn.head_dim).transpose(1, 2)
+        value_states = attn.v_proj(hidden_states).view(bsz, 1, attn.num_heads, attn.head_dim).transpose(1, 2)
+        query_states = (query_states * cos) + (rotate_half(query_states) * sin)
+        key_states = (key_states * cos) + (rotate_half(key_states) * sin)
+
+        key_cache = self.cache.key_cache[layer_idx]
+        value_cache = self.cache.value_cache[layer_idx]
+        key_cache.index_copy_(2, self.cache_position, key_states)
+        value_cache.index_copy_(2, self.cache_position, value_states)
+        attn_output = nn.functional.scaled_dot_product_attention(
+            query_states, key_cache, value_cache, attn_mask=attention_mask
+        )
+        return attn.o_proj(attn_output.transpose(1, 2).reshape(bsz, 1, attn.hidden_size))
+
+    def project(self, all_hidden_states):
+        # all_hidden_states[i]: (rows, q_len, hidden), indexed like `output_hidden_states`
+        lm_head = self.model.lm_head
+        if self.early_exit_layers is not None:
+            stacked = torch.stack([all_hidden_states[layer][:, -1] for layer in self.early_exit_layers], dim=0)
+            return lm_head(stacked)  # (num_layers, batch, vocab)
+        return self.contrast(lm_head(all_hidden_states[-1][:, -1]))
+
+    def contrast(self, logits):
+        if self.contrast_alpha is None:
+            return logits
+        logits, logits_cd = logits.chunk(2, dim=0)
+        cutoff = self.log_contrast_beta + logits.max(dim=-1, keepdim=True).values
+        diffs = (1 + self.contrast_alpha) * logits - self.contrast_alpha * logits_cd
+        return diffs.masked_fill(logits < cutoff, -float("inf"))
+
+    def replay(self):
+        if self.graph is None:
+            # the first step runs for real on a side stream (warm-up), then is captured for the next ones
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                output = self.step()
+            torch.cuda.current_stream().wait_stream(stream)
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph):
+                self.graph_output = self.step()
+            return output
+        self.graph.replay()
+        # the graph's output is overwritten by the next replay
+        return self.graph_output.clone()
+
+    def wrap(self, output):
+        if self.early_exit_layers is not None:
+            dict_outputs = {layer: logits[:, None] for layer, logits in zip(self.early_exit_layers, output)}
+            logits = dict_outputs[self.early_exit_layers[-1]]
+        else:
+            dict_outputs = None
+            logits = output[:, None]
+        return dict_outputs, CausalLMOutputWithPast(logits=logits, past_key_values=self.cache)
+
+    @torch.no_grad()
+    def eager(self, model_inputs):
+        """Variable-shape forward with the static cache; re-syncs the step buffers afterwards."""
+        cache = self.cache
+        if cache.length != self.length:
+            # the cache was truncated (rollback): drop the keys past its end
+            self.key_mask[:, cache.length :] = False
+            self.position_ids.copy_(self.key_mask.sum(dim=-1, keepdim=True))
+            self.length = cache.length
+
+        if cache.length == 0:
+            inputs_embeds = model_inputs.get("inputs_embeds")
+            if inputs_embeds is None:
+                inputs_embeds = self.model.get_input_embeddings()(model_inputs["input_ids"])
+            q_len = inputs_embeds.shape[1]
+            attention_mask = model_inputs.get("attention_mask")
+            if attention_mask is None:
+                attention_mask = torch.ones(inputs_embeds.shape[:2], dtype=torch.long, device=inputs_embeds.device)
+            if self.contrast_alpha is not None:
+                if self.contrast_inputs is None:
+                    raise ValueError("Call `set_contrast_inputs` before the prefill of a contrastive decode step.")
+                inputs_embeds_cd, attention_mask_cd = self.contrast_inputs
+                if inputs_embeds_cd.shape[1] != q_len:
+                    raise ValueError(
+                        f"The contrast prompt has {inputs_embeds_cd.shape[1]} positions, the main one {q_len}."
+                    )
+                if attention_mask_cd is None:
+                    attention_mask_cd = torch.ones_like(attention_mask)
+                inputs_embeds = torch.cat([inputs_embeds, inputs_embeds_cd.to(inputs_embeds.dtype)], dim=0)
+                attention_mask = torch.cat([attention_mask, attention_mask_cd.to(attention_mask.device)], dim=0)
+                self.contrast_inputs = None
+            self.key_mask.zero_()
+            self.key_mask[:, :q_len] = attention_mask.bool()
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+            forward_inputs = {"inputs_embeds": inputs_embeds}
+        else:
+            input_ids = self.expand(model_inputs["input_ids"])
+            q_len = input_ids.shape[1]
+            self.key_mask[:, cache.length : cache.length + q_len] = True
+            position_ids = self.position_ids + torch.arange(q_len, device=input_ids.device)
+            forward_inputs = {"input_ids": input_ids}
+
+        outputs = self.model(
+            **forward_inputs,
+            attention_mask=self.key_mask[:, : cache.length + q_len],
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+            output_hidden_states=self.early_exit_layers is not None,
+            return_dict=True,
+        )
+        self.length = cache.length
+        self.cache_position.fill_(cache.length)
+        self.position_ids.copy_(position_ids[:, -1:] + 1)
+
+        if self.early_exit_layers is not None:
+            return self.wrap(self.project(outputs.hidden_states))
+        return self.wrap(self.contrast(outputs.logits[:, -1]))
@@ -18,11 +18,7 @@ from transformers import TextStreamer
 import sys
 
 sys.path.append("mPLUG-Owl/mPLUG-Owl2")
-from mplug_owl2.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN
-from mplug_owl2.conversation import conv_templates, SeparatorStyle
-from mplug_owl2.model.builder import load_pretrained_model
-from mplug_owl2.mm_utils import process_images, tokenizer_image_token, get_model_name_from_path, KeywordsStoppingCriteria
-from mplug_owl2.model.modeling_llama2 import replace_llama_modality_adaptive
+# mplug_owl2 is imported inside MPLUGOWL2, so registering the model zoo does not pull it in.
 
 NUM_IMAGE_TOKENS = 64
 
@@ -63,6 +59,9 @@ class MPLUGOWL2(BaseModel):
         super().__init__()
 
         # AutoModelForCausalLM.register(MPLUGOwl2Config, MPLUGOwl2LlamaForCausalLM)
+        from mplug_owl2.model.builder import load_pretrained_model
+        from mplug_owl2.mm_utils import get_model_name_from_path
+        from mplug_owl2.model.modeling_llama2 import replace_llama_modality_adaptive
 
         replace_llama_modality_adaptive()
 
@@ -95,6 +94,9 @@ class MPLUGOWL2(BaseModel):
         output_attentions=False,
         premature_layer=None,
         candidate_premature_layers=None,
+        jsd_top_k=None,
+        decode_budget=None,
+        decode_engine=False,
         mature_layer=None,
         beam_search=False,
         dola_decoding = False,
@@ -156,6 +158,9 @@ class MPLUGOWL2(BaseModel):
         # inp = DEFAULT_IMAGE_TOKEN + query
         # conv.append_message(conv.roles[0], inp)
         # conv.append_message(conv.roles[1], None)
+        from mplug_owl2.constants import IMAGE_TOKEN_INDEX
+        from mplug_owl2.mm_utils import tokenizer_image_token, KeywordsStoppingCriteria
+
         prompt = samples["prompt"] 
 
         input_ids = tokenizer_image_token(prompt, self.llm_tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).to(self.model.device)
@@ -241,6 +246,9 @@ class MPLUGOWL2(BaseModel):
                 output_attentions=output_attentions,
                 premature_layer=premature_layer,
                 candidate_premature_layers=candidate_premature_layers,
+                jsd_top_k=jsd_top_k,
+                decode_budget=decode_budget,
+                decode_engine=decode_engine,
                 mature_layer=mature_layer,
                 beam_search=beam_search,
                 dola_decoding=dola_decoding,
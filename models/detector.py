@@ -7,13 +7,14 @@ from collections import defaultdict
 import shortuuid
 from torchvision.ops import box_convert
 import torch
-from models.utils import compute_iou
+from models.utils import compute_iou, to_pixel_box, crop_image
 
 # use GroundingDINO in decoder_zoo
 from decoder_zoo.GroundingDINO.groundingdino.util.inference import (
     load_model,
     load_image,
     predict,
+    predict_batch,
 )
 
 # use GroundingDINO from pip install
@@ -40,7 +41,7 @@ def in_dict(ent_dict, norm_box):
 
 
 def extract_detection(
-    global_entity_dict, boxes, phrases, image_source, cache_dir, sample
+    global_entity_dict, boxes, phrases, image_source, cache_dir, sample, debug=False
 ):
     h, w, _ = image_source.shape
     boxes = boxes * torch.Tensor([w, h, w, h])
@@ -49,7 +50,8 @@ def extract_detection(
         np.clip(xyxy / np.array([w, h, w, h]), 0.0, 1.0), 3
     ).tolist()
 
-    os.makedirs(cache_dir, exist_ok=True)
+    if debug:
+        os.makedirs(cache_dir, exist_ok=True)
 
     for entity, box, norm_box in zip(phrases, xyxy, normed_xyxy):
         # filter out too small object
@@ -62,14 +64,17 @@ def extract_detection(
         if in_dict(global_entity_dict, norm_box):
             continue
 
-        # add instance, including the cropped_pic & its original bbox
-        crop_id = shortuuid.uuid()
-        crop_img = Image.fromarray(image_source).crop(box)
-        crop_path = os.path.join(cache_dir, f"{crop_id}.png")
-        crop_img.save(crop_path)
+        # add instance, including the crop region in the decoded image & its original bbox.
+        # the crop itself is only materialized (and saved) in debug mode.
+        crop_box = to_pixel_box(box, w, h)
+        if debug:
+            crop_id = shortuuid.uuid()
+            crop_path = os.path.join(cache_dir, f"{crop_id}.png")
+            crop_image(image_source, crop_box).save(crop_path)
+            global_entity_dict[entity]["crop_path"].append(crop_path)
 
         global_entity_dict[entity]["total_count"] += 1
-        global_entity_dict[entity]["crop_path"].append(crop_path)
+        global_entity_dict[entity]["crop_box"].append(crop_box)
         global_entity_dict[entity]["bbox"].append(
             norm_box
         )  # [x1, y1, x2, y2] coordinate of left-top and right-bottom corner
@@ -78,6 +83,10 @@ def extract_detection(
 
 
 def find_most_similar_strings(nlp, source_strings, target_strings):
+    # a phrase that is one of the targets maps to itself; the rest are parsed once each.
+    unmatched = {source_str for source_str in source_strings if source_str not in target_strings}
+    if len(unmatched) == 0:
+        return list(source_strings)
     target_docs = [nlp(text) for text in target_strings]
 
     def find_most_similar(source_str):
@@ -89,7 +98,8 @@ def find_most_similar_strings(nlp, source_strings, target_strings):
         most_similar_doc = max(similarities, key=lambda item: item[1])[0]
         return most_similar_doc.text
 
-    result = [find_most_similar(source_str) for source_str in source_strings]
+    matched = {source_str: find_most_similar(source_str) for source_str in unmatched}
+    result = [matched.get(source_str, source_str) for source_str in source_strings]
 
     return result
 
@@ -106,8 +116,12 @@ class Detector:
             {
                 total_count: detected counts of that obj.
 
-                crop_path: a list of str, denoting the path to cached intermediate file, i.e., cropped out region of that obj.
+                crop_box: a list of [x1, y1, x2, y2] pixel boxes, i.e., cropped out region of that obj
+                    in the decoded image, which is kept in sample['image_source'].
                     Note: if total_count > 1, may use the whole image in the following steps.
+
+                crop_path: a list of str, denoting the path to cached intermediate file of each crop.
+                    Only filled in debug mode.
             }
     """
 
@@ -116,6 +130,7 @@ class Detector:
             args.detector_config, args.detector_model_path, device="cuda:0"
         )
         self.cache_dir = args.cache_dir
+        self.debug = getattr(args, "debug", False)
         self.args = args
         self.nlp = spacy.load("en_core_web_sm")
 
@@ -126,8 +141,9 @@ class Detector:
 
         global_entity_dict = (
             {}
-        )  # key=entity type name. value = {'total_count':int, 'crop_path':list, 'bbox':list of list(4-ele).}
+        )  # key=entity type name. value = {'total_count':int, 'crop_box':list, 'crop_path':list, 'bbox':list of list(4-ele).}
         global_entity_list = []  # save all the entity type name for each sentence.
+        entity_strs = []
         for entity_str in extracted_entities:
             # border case: nothing to extract
             if "none" in entity_str.lower():
@@ -135,26 +151,35 @@ class Detector:
             entity_list = entity_str.split(".")
             for ent in entity_list:
                 global_entity_dict.setdefault(ent, {}).setdefault("total_count", 0)
+                global_entity_dict.setdefault(ent, {}).setdefault("crop_box", [])
                 global_entity_dict.setdefault(ent, {}).setdefault("crop_path", [])
                 global_entity_dict.setdefault(ent, {}).setdefault("bbox", [])
 
             global_entity_list.append(entity_list)
+            entity_strs.append(entity_str)
 
-            boxes, logits, phrases = predict(
+        # all entity strings of the sample are grounded in one forward pass.
+        if len(entity_strs) > 0:
+            predictions = predict_batch(
                 model=self.model,
-                image=image,
-                caption=entity_str,
+                images=image,
+                captions=entity_strs,
                 box_threshold=sample["box_threshold"]
                 if "box_threshold" in sample
                 else BOX_TRESHOLD,
                 text_threshold=TEXT_TRESHOLD,
                 device="cuda:0",
             )
+        else:
+            predictions = []
+
+        for entity_list, (boxes, logits, phrases) in zip(global_entity_list, predictions):
             phrases = find_most_similar_strings(self.nlp, phrases, entity_list)
             global_entity_dict = extract_detection(
-                global_entity_dict, boxes, phrases, image_source, self.cache_dir, sample
+                global_entity_dict, boxes, phrases, image_source, self.cache_dir, sample, self.debug
             )
 
         sample["entity_info"] = global_entity_dict
         sample["entity_list"] = global_entity_list
+        sample["image_source"] = image_source  # decoded once, crops are taken from it downstream.
         return sample
@@ -0,0 +1,172 @@
+import queue
+import threading
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+
+QUEUE_SIZE = 8  # max samples waiting in front of each stage. a full queue blocks the upstream stage.
+BATCH_TIMEOUT = 0.05  # seconds a batched stage waits for more samples before running a partial batch.
+
+_STOP = object()
+
+
+class StageMetrics:
+    '''
+        Per-stage counters. Latency is measured from the moment a sample is put in the stage queue
+        to the moment the stage finishes it, so it includes the queueing delay (reported separately as wait).
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.batches = 0
+        self.busy_time = 0.0
+        self.latency = []
+        self.wait = []
+        self.first_start = None
+        self.last_end = None
+
+    def record(self, start: float, end: float, enqueue_times: List[float]):
+        with self.lock:
+            self.processed += len(enqueue_times)
+            self.batches += 1
+            self.busy_time += end - start
+            self.latency += [end - t for t in enqueue_times]
+            self.wait += [start - t for t in enqueue_times]
+            self.first_start = start if self.first_start is None else min(self.first_start, start)
+            self.last_end = end if self.last_end is None else max(self.last_end, end)
+
+    def summary(self) -> Dict:
+        with self.lock:
+            span = (self.last_end - self.first_start) if self.processed else 0.0
+            return {
+                'processed': self.processed,
+                'batches': self.batches,
+                'avg_batch_size': self.processed / self.batches if self.batches else 0.0,
+                'busy_time': self.busy_time,
+                'throughput': self.processed / span if span > 0 else 0.0,  # samples / s while the stage was active.
+                'latency_mean': float(np.mean(self.latency)) if self.latency else 0.0,
+                'latency_p95': float(np.percentile(self.latency, 95)) if self.latency else 0.0,
+                'wait_mean': float(np.mean(self.wait)) if self.wait else 0.0,
+            }
+
+
+class Stage:
+    '''
+        One step of the pipeline.
+            fn: called with one sample (batched=False) or a list of samples (batched=True), returns the same.
+            batch_size: max samples handed to a batched fn at once.
+            num_workers: number of threads running this stage, e.g. >1 for network-bound LLM calls.
+            queue_size: capacity of the input queue, i.e. the backpressure bound.
+    '''
+
+    def __init__(self, name: str, fn: Callable, batch_size: int = 1, num_workers: int = 1,
+                 batched: bool = False, queue_size: int = QUEUE_SIZE):
+        self.name = name
+        self.fn = fn
+        self.batch_size = batch_size if batched else 1
+        self.num_workers = num_workers
+        self.batched = batched
+        self.queue_size = queue_size
+
+
+class PipelineExecutor:
+    '''
+        Streams samples through a list of stages. Every stage runs in its own worker thread(s) and
+        pulls from its own bounded queue, so a GPU stage can work on sample i while an LLM stage waits
+        on the network for sample i+1. Results come back in input order.
+    '''
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+        self.metrics = {stage.name: StageMetrics(stage.name) for stage in stages}
+
+    def _collect(self, stage: Stage, in_queue: queue.Queue):
+        # block for the first item, then fill the batch with whatever arrives shortly after.
+        items = [in_queue.get()]
+        if items[0] is _STOP:
+            return items
+        deadline = time.perf_counter() + BATCH_TIMEOUT
+        while len(items) < stage.batch_size:
+            try:
+                item = in_queue.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            items.append(item)
+            if item is _STOP:
+                break
+        return items
+
+    def _worker(self, stage: Stage, in_queue: queue.Queue, out_queue: queue.Queue, errors: List):
+        metrics = self.metrics[stage.name]
+        while True:
+            items = self._collect(stage, in_queue)
+            stop = items[-1] is _STOP
+            items = [item for item in items if item is not _STOP]
+            # samples that failed upstream are passed on untouched.
+            for idx, sample, _ in items:
+                if sample is None:
+                    out_queue.put((idx, None, time.perf_counter()))
+            items = [item for item in items if item[1] is not None]
+            if items:
+                idx_list = [idx for idx, _, _ in items]
+                samples = [sample for _, sample, _ in items]
+                start = time.perf_counter()
+                try:
+                    if stage.batched:
+                        samples = stage.fn(samples)
+                    else:
+                        samples = [stage.fn(sample) for sample in samples]
+                except Exception as e:
+                    errors.append((stage.name, idx_list, e))
+                    samples = [None] * len(idx_list)
+                end = time.perf_counter()
+                metrics.record(start, end, [enqueued for _, _, enqueued in items])
+                for idx, sample in zip(idx_list, samples):
+                    out_queue.put((idx, sample, time.perf_counter()))
+            if stop:
+                # pass the stop token on to the sibling workers of this stage.
+                in_queue.put(_STOP)
+                return
+
+    def run(self, samples: List[Dict]) -> List[Dict]:
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        queues.append(queue.Queue())  # results, unbounded so the last stage never blocks.
+        errors = []
+        threads = []
+        for stage, in_queue, out_queue in zip(self.stages, queues[:-1], queues[1:]):
+            stage_threads = [
+                threading.Thread(target=self._worker, args=(stage, in_queue, out_queue, errors), daemon=True)
+                for _ in range(stage.num_workers)
+            ]
+            for t in stage_threads:
+                t.start()
+            threads.append(stage_threads)
+
+        def feed():
+            for idx, sample in enumerate(samples):
+                queues[0].put((idx, sample, time.perf_counter()))
+            queues[0].put(_STOP)
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+        results = [None] * len(samples)
+        for _ in range(len(samples)):
+            idx, sample, _ = queues[-1].get()
+            results[idx] = sample
+        # shut the stages down in order once everything went through.
+        feeder.join()
+        for stage_threads, out_queue in zip(threads, queues[1:]):
+            for t in stage_threads:
+                t.join()
+            out_queue.put(_STOP)
+        if errors:
+            stage_name, idx_list, e = errors[0]
+            raise RuntimeError(f"stage '{stage_name}' failed on samples {idx_list}") from e
+        return results
+
+    def summary(self) -> Dict:
+        return {name: metrics.summary() for name, metrics in self.metrics.items()}
@@ -25,6 +25,16 @@ def compute_iou(box1, box2):
 
     return iou
 
+def to_pixel_box(box, w, h):
+    # same rounding as PIL.Image.crop, clipped to the image so it can be used for slicing.
+    x1, y1, x2, y2 = [int(round(float(c))) for c in box]
+    return [min(max(x1, 0), w), min(max(y1, 0), h), min(max(x2, 0), w), min(max(y2, 0), h)]
+
+def crop_image(image_source: np.ndarray, crop_box: List[int]) -> Image.Image:
+    # crop from the already-decoded HxWx3 image; slicing is a view, no file round-trip.
+    x1, y1, x2, y2 = crop_box
+    return Image.fromarray(np.ascontiguousarray(image_source[y1:y2, x1:x2]))
+
 def extract_boxes(text):
     pattern = r'\[\s*([0-1](?:\.\d+)?),\s*([0-1](?:\.\d+)?),\s*([0-1](?:\.\d+)?),\s*([0-1](?:\.\d+)?)\s*\]'
     matches = re.findall(pattern, text)
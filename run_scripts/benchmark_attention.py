@@ -0,0 +1,112 @@
+"""
+Parity and speed of the fused (scaled_dot_product_attention) and eager attention paths of the EVA-ViT
+`Attention` and the custom `LlamaAttention`, on CPU by default; and of greedy generation with a small
+randomly initialised `LlamaForCausalLM` as the run scripts call it: with output_attentions=False (every
+decoder but OPERA, SDPA) against output_attentions=True (OPERA, eager).
+
+    python run_scripts/benchmark_attention.py
+    python run_scripts/benchmark_attention.py --image-size 364 --prefill-length 600 --device cuda
+"""
+import argparse
+import json
+import sys
+
+sys.path.append("./")
+
+import torch
+from transformers.models.llama.configuration_llama import LlamaConfig
+
+from minigpt4.models.eva_vit import Attention
+from minigpt4.models.modeling_llama import LlamaAttention, LlamaForCausalLM, _make_causal_mask
+
+from benchmark_utils import add_output_argument, dump_report, timed
+
+
+def compare(module, run, device, repeats):
+    module.use_sdpa = False
+    eager, eager_time = timed(run, device, repeats, warmup=True)
+    module.use_sdpa = True
+    fused, fused_time = timed(run, device, repeats, warmup=True)
+    return {
+        "max_abs_diff": (eager.float() - fused.float()).abs().max().item(),
+        "eager_ms": eager_time * 1000,
+        "sdpa_ms": fused_time * 1000,
+        "speedup": eager_time / fused_time,
+    }
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser(description="Compare the SDPA and eager attention paths.")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--image-size", type=int, default=364, help="ViT-g/14: 364 -> 677 tokens.")
+    parser.add_argument("--prefill-length", type=int, default=300)
+    parser.add_argument("--llama-hidden-size", type=int, default=4096)
+    parser.add_argument("--llama-heads", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--generate-layers", type=int, default=4, help="layers of the generation model.")
+    parser.add_argument("--new-tokens", type=int, default=32)
+    add_output_argument(parser)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    report = {}
+
+    # EVA ViT-g attention with its relative position bias
+    grid = args.image_size // 14
+    vit_attn = Attention(1408, num_heads=16, qkv_bias=True, window_size=(grid, grid)).to(device, dtype).eval()
+    torch.nn.init.normal_(vit_attn.relative_position_bias_table, std=0.02)
+    torch.nn.init.normal_(vit_attn.q_bias, std=0.02)
+    x = torch.randn(args.batch_size, grid * grid + 1, 1408, device=device, dtype=dtype)
+    report["eva_vit"] = dict(tokens=grid * grid + 1, **compare(vit_attn, lambda: vit_attn(x), device, args.repeats))
+
+    # LLaMA prefill with a causal mask
+    config = LlamaConfig(hidden_size=args.llama_hidden_size, num_attention_heads=args.llama_heads)
+    llama_attn = LlamaAttention(config).to(device, dtype).eval()
+    length = args.prefill_length
+    hidden_states = torch.randn(args.batch_size, length, args.llama_hidden_size, device=device, dtype=dtype)
+    position_ids = torch.arange(length, device=device)[None].expand(args.batch_size, -1)
+    mask = _make_causal_mask((args.batch_size, length), dtype, device=device)
+    run = lambda: llama_attn(hidden_states, attention_mask=mask, position_ids=position_ids)[0]
+    report["llama_prefill"] = dict(tokens=length, **compare(llama_attn, run, device, args.repeats))
+
+    # OPERA needs the weights: output_attentions must still take the eager path
+    llama_attn.use_sdpa = True
+    _, weights, _ = llama_attn(hidden_states, attention_mask=mask, position_ids=position_ids, output_attentions=True)
+    report["llama_output_attentions_eager"] = weights is not None
+
+    # greedy generation: the run scripts only ask for the attention weights when decoding with OPERA
+    config = LlamaConfig(
+        hidden_size=args.llama_hidden_size,
+        intermediate_size=args.llama_hidden_size * 2,
+        num_attention_heads=args.llama_heads,
+        num_hidden_layers=args.generate_layers,
+        vocab_size=1000,
+    )
+    lm = LlamaForCausalLM(config).to(device, dtype).eval()
+    prompt = torch.randint(3, config.vocab_size, (args.batch_size, length), device=device)
+    generate = lambda output_attentions: lm.generate(
+        input_ids=prompt,
+        max_new_tokens=args.new_tokens,
+        do_sample=False,
+        output_attentions=output_attentions,
+        pad_token_id=0,
+    )
+    eager, eager_time = timed(lambda: generate(True), device, warmup=True)
+    fused, fused_time = timed(lambda: generate(False), device, warmup=True)
+    report["llama_generate"] = {
+        "same_tokens": bool(torch.equal(eager, fused)),
+        "eager_ms": eager_time * 1000,
+        "sdpa_ms": fused_time * 1000,
+        "speedup": eager_time / fused_time,
+    }
+
+    print(json.dumps(report, indent=4))
+    dump_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Decode throughput of the decode engine (transformers/generation/decode_engine.py) with and without a
+captured single-token step (`StaticDecodeStep` of minigpt4/models/modeling_llama.py), for greedy,
+DoLa (early-exit projections) and VCD (two-branch contrast), on a randomly initialised LLaMA.
+
+"eager" runs the fixed-shape step uncompiled; "compile" runs it through torch.compile (CPU or GPU);
+"graph" replays it as a CUDA graph. Greedy also reports the model's regular forward ("dynamic").
+
+    python run_scripts/benchmark_decode_step.py                      # CPU, torch.compile
+    python run_scripts/benchmark_decode_step.py --device cuda --capture graph --num-layers 32 --hidden-size 4096
+"""
+import argparse
+import json
+import sys
+
+sys.path.append("./")
+
+import torch
+from transformers.generation.decode_engine import dola_greedy_decode, greedy_decode, vcd_sampling
+from transformers.generation.stopping_criteria import MaxLengthCriteria, StoppingCriteriaList
+from transformers.models.llama.configuration_llama import LlamaConfig
+
+from minigpt4.models.modeling_llama import LlamaForCausalLM, StaticDecodeStep
+
+from benchmark_utils import add_output_argument, dump_report, timed
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the captured decode step against the eager one.")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--capture", type=str, default=None, help="compile / graph; graph on cuda by default.")
+    parser.add_argument("--num-layers", type=int, default=8)
+    parser.add_argument("--hidden-size", type=int, default=512)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--vocab-size", type=int, default=32000)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--prompt-length", type=int, default=64)
+    parser.add_argument("--new-tokens", type=int, default=128)
+    add_output_argument(parser)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    capture = args.capture or ("graph" if device.type == "cuda" else "compile")
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 11 // 4,
+        num_hidden_layers=args.num_layers,
+        num_attention_heads=args.num_heads,
+        max_position_embeddings=args.prompt_length + args.new_tokens,
+    )
+    model = LlamaForCausalLM(config).to(device, dtype).eval()
+    # fixed-length runs
+    model.generation_config.eos_token_id = None
+    model.generation_config.pad_token_id = 0
+
+    batch_size, max_length = args.batch_size, args.prompt_length + args.new_tokens
+    input_ids = torch.randint(3, config.vocab_size, (batch_size, args.prompt_length), device=device)
+    inputs_embeds_cd = model.get_input_embeddings()(input_ids)
+    inputs_embeds_cd = inputs_embeds_cd + 0.5 * inputs_embeds_cd.std() * torch.randn_like(inputs_embeds_cd)
+    kwargs = dict(
+        stopping_criteria=StoppingCriteriaList([MaxLengthCriteria(max_length)]),
+        attention_mask=torch.ones_like(input_ids),
+        use_cache=True,
+    )
+    layers = config.num_hidden_layers
+    strategies = {
+        "greedy": (dict(), lambda step: greedy_decode(model, input_ids, decode_step=step, **kwargs)),
+        "dola": (
+            dict(early_exit_layers=list(range(0, layers, 2)) + [layers]),
+            lambda step: dola_greedy_decode(
+                model,
+                input_ids,
+                mature_layer=layers,
+                candidate_premature_layers=list(range(0, layers, 2)),
+                decode_step=step,
+                **kwargs,
+            ),
+        ),
+        "vcd": (
+            dict(contrast_alpha=1.0, contrast_beta=0.1),
+            lambda step: vcd_sampling(model, input_ids, decode_step=step, **kwargs),
+        ),
+    }
+
+    report = {"device": str(device), "capture": capture, "batch_size": batch_size, "runs": {}}
+    for name, (step_kwargs, decode) in strategies.items():
+        rows = 2 * batch_size if "contrast_alpha" in step_kwargs else batch_size
+        cache = model.allocate_static_cache(rows, max_length)
+        run = {}
+        results = {}
+        modes = ["eager", capture] + (["dynamic"] if name == "greedy" else [])
+        for mode in modes:
+            step = None if mode == "dynamic" else StaticDecodeStep(model, cache, capture=mode, **step_kwargs)
+
+            def generate():
+                if step is not None:
+                    step.reset()
+                    if step.contrast_alpha is not None:
+                        step.set_contrast_inputs(inputs_embeds_cd)
+                torch.manual_seed(0)
+                return decode(step)
+
+            generate()  # compile / capture / warm up
+            results[mode], elapsed = timed(generate, device)
+            run[mode + "_tokens_per_second"] = batch_size * args.new_tokens / elapsed
+        run["speedup"] = run[capture + "_tokens_per_second"] / run["eager_tokens_per_second"]
+        run["same_tokens"] = bool(torch.equal(results["eager"], results[capture]))
+        if "dynamic" in results:
+            run["same_tokens_as_dynamic"] = bool(torch.equal(results["dynamic"], results[capture]))
+        report["runs"][name] = run
+        print(name, json.dumps(run))
+
+    dump_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Agreement and speed of DoLa's approximate premature-layer selection (`jsd_top_k`, projecting the
+candidate layers only onto the mature layer's top-k tokens plus a tail bucket) against the exact
+full-vocabulary selection, at every position of a set of prompts.
+
+The exact path projects every candidate layer and the mature layer onto the full vocabulary, as the
+`early_exit_layers` forward does; the approximate path projects the mature layer, ranks the candidates
+on the reduced support, then projects the chosen layer.
+
+    python run_scripts/benchmark_jsd_selection.py                                       # random 7B-shaped model
+    python run_scripts/benchmark_jsd_selection.py --llama-path /path/to/vicuna-7b --prompts prompts.txt --device cuda
+"""
+import argparse
+import json
+import sys
+
+sys.path.append("./")
+
+import torch
+from transformers import AutoTokenizer, LlamaConfig, LlamaForCausalLM
+from transformers.generation.decode_engine import approximate_premature_layer, jsd_premature_layer
+
+from benchmark_utils import add_output_argument, dump_report, timed
+
+DEFAULT_PROMPTS = [
+    "Please describe this image in detail. The image shows a kitchen with a wooden table, two chairs and a",
+    "A man is riding a bicycle down a busy street next to a red bus, while people on the sidewalk",
+    "There is a dog lying on a couch in the living room. Next to it, on the floor, there is a",
+    "The photo shows a group of people playing frisbee in a park on a sunny day, with trees and",
+]
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser(description="Compare the approximate and exact DoLa premature layer selection.")
+    parser.add_argument("--llama-path", type=str, default=None, help="load weights (and tokenizer) instead of a random model.")
+    parser.add_argument("--prompts", type=str, default=None, help="text file, one prompt per line.")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--num-layers", type=int, default=32)
+    parser.add_argument("--hidden-size", type=int, default=4096)
+    parser.add_argument("--num-heads", type=int, default=32)
+    parser.add_argument("--random-prompt-length", type=int, default=32)
+    parser.add_argument("--top-k", type=int, nargs="+", default=[64, 256, 1024])
+    parser.add_argument("--repeats", type=int, default=3)
+    add_output_argument(parser)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    if args.llama_path is not None:
+        model = LlamaForCausalLM.from_pretrained(args.llama_path, torch_dtype=dtype)
+        tokenizer = AutoTokenizer.from_pretrained(args.llama_path, use_fast=False)
+        if args.prompts is not None:
+            with open(args.prompts, "r") as f:
+                prompts = [line.strip() for line in f if line.strip()]
+        else:
+            prompts = DEFAULT_PROMPTS
+        input_ids_list = [tokenizer(prompt, return_tensors="pt").input_ids for prompt in prompts]
+    else:
+        config = LlamaConfig(
+            hidden_size=args.hidden_size,
+            intermediate_size=args.hidden_size * 11 // 4,
+            num_hidden_layers=args.num_layers,
+            num_attention_heads=args.num_heads,
+        )
+        model = LlamaForCausalLM(config).to(dtype)
+        input_ids_list = [
+            torch.randint(3, config.vocab_size, (1, args.random_prompt_length)) for _ in range(len(DEFAULT_PROMPTS))
+        ]
+    model = model.to(device).eval()
+    lm_head = model.get_output_embeddings()
+    num_layers = model.config.num_hidden_layers
+    mature_layer = num_layers
+    candidate_premature_layers = list(range(0, num_layers, 2))
+
+    # one selection per position: the hidden states of every candidate layer at that position
+    samples = []
+    for input_ids in input_ids_list:
+        outputs = model.model(input_ids.to(device), output_hidden_states=True, return_dict=True)
+        for position in range(input_ids.shape[1]):
+            samples.append(
+                (
+                    outputs.hidden_states[mature_layer][:, position],
+                    torch.stack([outputs.hidden_states[l][:, position] for l in candidate_premature_layers]),
+                )
+            )
+
+    def exact(mature_hidden, premature_hidden):
+        mature_logits = lm_head(mature_hidden)
+        premature_logits = lm_head(premature_hidden)
+        index = jsd_premature_layer(mature_logits, premature_logits)
+        return index, premature_logits[index]
+
+    def approximate(mature_hidden, premature_hidden, top_k):
+        mature_logits = lm_head(mature_hidden)
+        index = approximate_premature_layer(lm_head, mature_logits, premature_hidden, top_k=top_k)
+        return index, lm_head(premature_hidden[index])
+
+    exact_indices, exact_time = timed(lambda: [exact(*sample)[0] for sample in samples], device, args.repeats, warmup=True)
+    exact_indices = torch.stack(exact_indices).cpu()
+    report = {
+        "device": str(device),
+        "num_selections": len(samples),
+        "num_candidate_layers": len(candidate_premature_layers),
+        "vocab_size": model.config.vocab_size,
+        "exact_ms_per_selection": exact_time / len(samples) * 1000,
+        "top_k": {},
+    }
+    for top_k in args.top_k:
+        indices, approx_time = timed(
+            lambda: [approximate(*sample, top_k)[0] for sample in samples], device, args.repeats, warmup=True
+        )
+        indices = torch.stack(indices).cpu()
+        report["top_k"][top_k] = {
+            "agreement": (indices == exact_indices).float().mean().item(),
+            "mean_layer_distance": (indices - exact_indices).abs().float().mean().item() * 2,
+            "ms_per_selection": approx_time / len(samples) * 1000,
+            "speedup": exact_time / approx_time,
+        }
+        print(top_k, json.dumps(report["top_k"][top_k]))
+
+    print(json.dumps(report, indent=4))
+    dump_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Greedy decode throughput of minigpt4/models/modeling_llama.py with the concatenating (dynamic) KV cache
+and with the pre-allocated `StaticKVCache`, at several generation lengths. Both caches must produce the
+same tokens.
+
+    python run_scripts/benchmark_kv_cache.py                        # randomly initialised 7B-shaped model
+    python run_scripts/benchmark_kv_cache.py --llama-path /path/to/vicuna-7b --new-tokens 64 256 512
+"""
+import argparse
+import sys
+
+sys.path.append("./")
+
+import torch
+from transformers.models.llama.configuration_llama import LlamaConfig
+
+from minigpt4.models.modeling_llama import LlamaForCausalLM
+
+from benchmark_utils import add_output_argument, dump_report, timed
+
+
+@torch.no_grad()
+def greedy_decode(model, inputs_embeds, max_new_tokens, static_cache=None):
+    outputs = model(inputs_embeds=inputs_embeds, past_key_values=static_cache, use_cache=True)
+    past_key_values = outputs.past_key_values
+    next_tokens = outputs.logits[:, -1].argmax(-1, keepdim=True)
+    tokens = [next_tokens]
+    for _ in range(max_new_tokens - 1):
+        outputs = model(input_ids=next_tokens, past_key_values=past_key_values, use_cache=True)
+        past_key_values = outputs.past_key_values
+        next_tokens = outputs.logits[:, -1].argmax(-1, keepdim=True)
+        tokens.append(next_tokens)
+    return torch.cat(tokens, dim=-1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the static KV cache against the dynamic one.")
+    parser.add_argument("--llama-path", type=str, default=None, help="load weights instead of a random model.")
+    parser.add_argument("--num-layers", type=int, default=32)
+    parser.add_argument("--hidden-size", type=int, default=4096)
+    parser.add_argument("--num-heads", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--prompt-length", type=int, default=300, help="e.g. 32 image queries + instruction.")
+    parser.add_argument("--new-tokens", type=int, nargs="+", default=[64, 256, 512])
+    add_output_argument(parser)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    if args.llama_path is not None:
+        model = LlamaForCausalLM.from_pretrained(args.llama_path, torch_dtype=dtype)
+    else:
+        config = LlamaConfig(
+            hidden_size=args.hidden_size,
+            intermediate_size=args.hidden_size * 11 // 4,
+            num_hidden_layers=args.num_layers,
+            num_attention_heads=args.num_heads,
+            max_position_embeddings=args.prompt_length + max(args.new_tokens),
+        )
+        model = LlamaForCausalLM(config).to(dtype)
+    model = model.to(device).eval()
+
+    torch.manual_seed(0)
+    inputs_embeds = torch.randn(
+        args.batch_size, args.prompt_length, model.config.hidden_size, dtype=dtype, device=device
+    ) * 0.02
+    # warm up kernels / allocator
+    greedy_decode(model, inputs_embeds, 4)
+
+    report = {"device": str(device), "batch_size": args.batch_size, "prompt_length": args.prompt_length, "runs": []}
+    for max_new_tokens in args.new_tokens:
+        dynamic_tokens, dynamic_time = timed(lambda: greedy_decode(model, inputs_embeds, max_new_tokens), device)
+        static_tokens, static_time = timed(
+            lambda: greedy_decode(
+                model,
+                inputs_embeds,
+                max_new_tokens,
+                static_cache=model.allocate_static_cache(args.batch_size, args.prompt_length + max_new_tokens),
+            ),
+            device,
+        )
+        run = {
+            "new_tokens": max_new_tokens,
+            "dynamic_tokens_per_second": args.batch_size * max_new_tokens / dynamic_time,
+            "static_tokens_per_second": args.batch_size * max_new_tokens / static_time,
+            "speedup": dynamic_time / static_time,
+            "same_tokens": bool(torch.equal(dynamic_tokens, static_tokens)),
+        }
+        report["runs"].append(run)
+        print(
+            "{new_tokens:>5} new tokens: dynamic {dynamic_tokens_per_second:8.1f} tok/s, "
+            "static {static_tokens_per_second:8.1f} tok/s, speedup {speedup:.2f}x, same tokens {same_tokens}".format(**run)
+        )
+
+    dump_report(report, args.output)
@@ -0,0 +1,88 @@
+"""
+Startup cost of the decoding / correction components, each measured in a fresh interpreter:
+the import time and peak RSS of a module, and the time to construct `halc_assistant` and the
+Woodpecker `Corrector` (optionally followed by the first use of their lazily loaded models).
+
+    python run_scripts/benchmark_startup.py
+    python run_scripts/benchmark_startup.py --touch --output startup.json
+"""
+import argparse
+import subprocess
+import sys
+
+from benchmark_utils import add_output_argument, dump_report
+
+IMPORTS = {
+    "minigpt4.models": "import minigpt4.models",
+    "halc": "from decoder_zoo.HALC.context_density.halc import halc_assistant",
+    "vcd": "from decoder_zoo.VCD.vcd_utils.vcd_add_noise import add_diffusion_noise",
+    "woodpecker": "from decoder_zoo.Woodpecker.vis_corrector import Corrector",
+    "mplug_owl2": "import mplug_owl2.mm_utils",
+    "pycocoevalcap": "from pycocoevalcap.eval import COCOEvalCap",
+    "hpsv2": "import hpsv2",
+    "spacy": "import spacy; spacy.load('en_core_web_sm')",
+}
+
+HALC = """
+from types import SimpleNamespace
+from decoder_zoo.HALC.context_density.halc import halc_assistant
+halc_params = {{
+    "context_domain": "upper", "contrast_weight": 0.05, "context_window": 4, "expand_ratio": 0.6,
+    "beam_size": 1, "k_candidate_num": 4, "LVLM_backbone": "minigpt4", "detector": "dino",
+    "score_type": "BLIP", "debugger": 0, "box_threshold": 0.4,
+}}
+model = SimpleNamespace(llama_tokenizer=None)
+helper = halc_assistant(model, vis_processor=None, device="{device}", halc_params=halc_params, max_new_tokens=64)
+if {touch}:
+    helper.detector, helper.tagging, helper.token_vocab, helper.scorer
+"""
+
+WOODPECKER = """
+sys.path.append("decoder_zoo/Woodpecker")
+from types import SimpleNamespace
+from decoder_zoo.Woodpecker.vis_corrector import Corrector
+from decoder_zoo.Woodpecker.config import woodpecker_args_dict
+corrector = Corrector(SimpleNamespace(**woodpecker_args_dict))
+if {touch}:
+    corrector.load_models()
+"""
+
+RUNNER = """
+import resource, sys, time
+sys.path.append("mPLUG-Owl/mPLUG-Owl2")
+sys.path.append("./")
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print("__startup__", elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+"""
+
+
+def measure(code):
+    proc = subprocess.run([sys.executable, "-c", RUNNER.format(code=code)], capture_output=True, text=True)
+    for line in proc.stdout.splitlines():
+        if line.startswith("__startup__"):
+            _, elapsed, rss = line.split()
+            return {"seconds": float(elapsed), "peak_rss_mb": float(rss)}
+    return {"error": (proc.stderr.strip().splitlines() or ["exit code {}".format(proc.returncode)])[-1]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure import and construction time of the decoder components.")
+    parser.add_argument("--touch", action="store_true", help="also load the lazily built models (needs the weights).")
+    parser.add_argument("--device", type=str, default="cpu")
+    add_output_argument(parser)
+    args = parser.parse_args()
+
+    report = {"baseline": measure("pass")}
+    for name, code in IMPORTS.items():
+        report["import " + name] = measure(code)
+    report["construct halc_assistant"] = measure(HALC.format(device=args.device, touch=args.touch))
+    report["construct Corrector"] = measure(WOODPECKER.format(touch=args.touch))
+
+    for name, result in report.items():
+        if "error" in result:
+            print("{:<30} failed: {}".format(name, result["error"]))
+        else:
+            print("{:<30} {:>8.2f} s {:>10.1f} MB".format(name, result["seconds"], result["peak_rss_mb"]))
+    dump_report(report, args.output)
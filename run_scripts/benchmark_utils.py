@@ -0,0 +1,40 @@
+"""
+Helpers shared by the benchmark_* / check_* scripts: wall-clock timing on a device and the optional
+--output json report.
+"""
+import json
+import time
+
+
+def synchronize(device):
+    # torch is only imported here: benchmark_startup and benchmark_async_grounding use the report helpers
+    # without loading it.
+    if device.type == "cuda":
+        import torch
+
+        torch.cuda.synchronize()
+
+
+def timed(fn, device, repeats=1, warmup=False):
+    """
+    (result of the last call, mean wall time per call in seconds) of `repeats` calls of `fn`, synchronised
+    with the device around them. `warmup` runs `fn` once untimed first.
+    """
+    if warmup:
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fn()
+    synchronize(device)
+    return result, (time.perf_counter() - start) / repeats
+
+
+def add_output_argument(parser):
+    parser.add_argument("--output", type=str, default=None, help="optional path to dump the report as json.")
+
+
+def dump_report(report, output):
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=4)
@@ -2,6 +2,7 @@ import argparse
 import os
 import random
 import sys
+import time
 sys.path.append("mPLUG-Owl/mPLUG-Owl2")
 sys.path.append("./")
 import numpy as np
@@ -27,23 +28,16 @@ from PIL import Image
 import json
 
 from types import SimpleNamespace
-from decoder_zoo.Woodpecker.vis_corrector import Corrector
-# from decoder_zoo.Woodpecker.config import woodpecker_args_dict
 from decoder_zoo.HALC.context_density.halc import halc_assistant
-from decoder_zoo.VCD.vcd_utils.vcd_add_noise import add_diffusion_noise
+from transformers.generation.decode_budget import DecodeBudget
+from transformers.generation.decode_profiler import decode_profiler
+from generation_loader import ImagePreprocess, CaptionDataSet, prefetch_loader
 
-from pycocotools.coco import COCO
-from pycocoevalcap.eval import COCOEvalCap
+from eval.coco_index import load_coco_index
 from collections import defaultdict
 
 import torch
 from PIL import Image
-from transformers import TextStreamer
-
-from mplug_owl2.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN
-from mplug_owl2.conversation import conv_templates, SeparatorStyle
-from mplug_owl2.model.builder import load_pretrained_model
-from mplug_owl2.mm_utils import process_images, tokenizer_image_token, get_model_name_from_path, KeywordsStoppingCriteria
 
 
 MODEL_EVAL_CONFIG_PATH = {
@@ -108,6 +102,7 @@ parser.add_argument(
 )
 parser.add_argument("--batch_size", type=int, default=1, help="batch size")
 parser.add_argument("--num_workers", type=int, default=2, help="num workers")
+parser.add_argument("--prefetch_factor", type=int, default=2, help="images queued ahead per loader worker")
 parser.add_argument("-b", "--beam", type=int, default=1)
 parser.add_argument("--sample", action="store_true")
 parser.add_argument("--scale_factor", type=float, default=50)
@@ -173,6 +168,74 @@ parser.add_argument(
     help="0 print no debugging output; 1 only print hallucination correction; 2 print all the debugging output.",
 )
 parser.add_argument("--box_threshold", type=float, default=0.45, help="Box threshold for DINO.")
+parser.add_argument(
+    "--async_grounding",
+    action="store_true",
+    help="run HALC's detector and crop embedding on a background worker, overlapped with decoding.",
+)
+parser.add_argument(
+    "--timing_output",
+    type=str,
+    default=None,
+    help="optional json file for per-image generation latency, new tokens and HALC grounding stats.",
+)
+parser.add_argument(
+    "--profile_output",
+    type=str,
+    default=None,
+    help="optional json file for per-stage timers and counters (model forwards, detector, crop encodes, scorer, rollbacks) per image and for the run.",
+)
+parser.add_argument(
+    "--profile_cuda_sync",
+    action="store_true",
+    help="synchronise the GPU around every profiled stage, so stages are timed by execution rather than launch.",
+)
+parser.add_argument(
+    "--pre_ground",
+    action="store_true",
+    help="ground the HALC vocabulary (COCO categories and synonyms) in batched prompts once per image, then look words up.",
+)
+parser.add_argument(
+    "--skip_rate",
+    type=float,
+    default=0.5,
+    help="probability of HALC skipping the verification of a noun, drawn per image from --skip_seed.",
+)
+parser.add_argument(
+    "--skip_seed",
+    type=int,
+    default=0,
+    help="seed of HALC's verification skip draws.",
+)
+parser.add_argument(
+    "--jsd_top_k",
+    type=int,
+    default=None,
+    help="rank DoLa/HALC's premature layers on the mature layer's top-k tokens (plus a tail bucket) instead of the full vocabulary.",
+)
+parser.add_argument(
+    "--decode_engine",
+    action="store_true",
+    help="run greedy, dola and vcd on the shared decode loop of transformers/generation/decode_engine.py.",
+)
+parser.add_argument(
+    "--budget_verifications",
+    type=int,
+    default=None,
+    help="per-caption limit on the distinct entities HALC grounds; past it, decoding goes on as plain DoLa / greedy.",
+)
+parser.add_argument(
+    "--budget_rollbacks",
+    type=int,
+    default=None,
+    help="per-caption limit on OPERA rollbacks; past it, decoding goes on as plain beam search.",
+)
+parser.add_argument(
+    "--budget_deadline",
+    type=float,
+    default=None,
+    help="per-caption decode deadline in seconds for HALC / OPERA, after which they fall back to their base decoder.",
+)
 parser.add_argument(
     "--gt_seg_path",
     type=str,
@@ -297,6 +360,10 @@ elif decoding_strategy == "vcd":
 
 
 if post_correction == "woodpecker":
+    # the corrector (and its detector / VQA / QA2C models) is only imported when requested.
+    from decoder_zoo.Woodpecker.vis_corrector import Corrector
+    from decoder_zoo.Woodpecker.config import woodpecker_args_dict
+
     model_args = SimpleNamespace(**woodpecker_args_dict)
     corrector = Corrector(model_args)
 
@@ -320,16 +387,10 @@ mean = (0.48145466, 0.4578275, 0.40821073)
 std = (0.26862954, 0.26130258, 0.27577711)
 norm = transforms.Normalize(mean, std)
 
-annotation_file_path = args.data_path + "annotations/instances_val2014.json"
-caption_file_path = args.data_path + "annotations/captions_val2014.json"
-# with open(args.data_path + '../annotations_trainval2014/annotations/instances_val2014.json', 'r') as f:
-with open(annotation_file_path, "r") as f:
-    lines = f.readlines()
-coco_anns = json.loads(lines[0])
-
-coco = COCO(caption_file_path)
+# instances_val2014.json / captions_val2014.json, parsed once and memory-mapped on later runs.
+coco_index = load_coco_index(args.data_path + "annotations", splits=("val",))
 
-img_ids = coco.getImgIds()
+img_ids = coco_index.image_ids.tolist()
 
 
 if generate_pope:
@@ -367,23 +428,7 @@ print("sampled_img_ids", len(sampled_img_ids))
 
 img_files = []
 for cur_img_id in sampled_img_ids:
-    cur_img = coco.loadImgs(cur_img_id)[0]
-    cur_img_path = cur_img["file_name"]
-    img_files.append(cur_img_path)
-
-img_dict = {}
-
-categories = coco_anns["categories"]
-category_names = [c["name"] for c in categories]
-category_dict = {int(c["id"]): c["name"] for c in categories}
-
-for img_info in coco_anns["images"]:
-    img_dict[img_info["id"]] = {"name": img_info["file_name"], "anns": []}
-
-for ann_info in coco_anns["annotations"]:
-    img_dict[ann_info["image_id"]]["anns"].append(
-        category_dict[ann_info["category_id"]]
-    )
+    img_files.append(coco_index.file_name(cur_img_id))
 
 base_dir = os.path.join(output_dir, "chair", args.model)
 if not os.path.exists(base_dir):
@@ -401,6 +446,10 @@ halc_params = {
     "score_type": "BLIP",
     "debugger": debugger,
     "box_threshold": box_threshold,
+    "pre_ground": args.pre_ground,
+    "skip_rate": args.skip_rate,
+    "skip_seed": args.skip_seed,
+    "async_grounding": args.async_grounding,
 }
 
 halc_assistant_helper = halc_assistant(
@@ -413,27 +462,47 @@ halc_assistant_helper = halc_assistant(
 
 offlight = True
 
-for idx, img_id in tqdm(enumerate(range(len(img_files))), total=len(img_files)):
-    img_file = img_files[img_id]
+# images are decoded, preprocessed (and noised for VCD) by the loader workers while the model decodes.
+preprocess = ImagePreprocess(
+    model_name,
+    trans=vis_processors["eval"],
+    image_processor=model.image_processor if model_name == "mplug-owl2" else None,
+    noise_step=args.noise_step if vcd_decoding else None,
+    keep_raw=halc_decoding,
+)
+caption_loader = prefetch_loader(
+    CaptionDataSet(args.data_path, img_files, preprocess),
+    num_workers=num_workers,
+    prefetch_factor=args.prefetch_factor,
+)
+
+if args.profile_output:
+    decode_profiler.enable(cuda_sync=args.profile_cuda_sync)
+
+decode_budget = None
+if args.budget_verifications is not None or args.budget_rollbacks is not None or args.budget_deadline is not None:
+    decode_budget = DecodeBudget(
+        max_verifications=args.budget_verifications,
+        max_rollbacks=args.budget_rollbacks,
+        deadline=args.budget_deadline,
+    )
+
+timings = []
+for idx, data in tqdm(enumerate(caption_loader), total=len(img_files)):
+    img_file = data["img_file"]
     img_id = int(img_file.split(".jpg")[0][-6:])
 
-    img_info = img_dict[img_id]
-    assert img_info["name"] == img_file
-    img_anns = set(img_info["anns"])
+    assert coco_index.file_name(img_id) == img_file
+    img_anns = coco_index.objects(img_id)
     img_save = {}
     img_save["image_id"] = img_id
 
-    image_path = args.data_path + img_file
-    raw_image = Image.open(image_path).convert('RGB')
+    image_path = data["image_path"]
 
     if model_name == "mplug-owl2":
-        max_edge = max(raw_image.size) # We recommand you to resize to squared image for BEST performance.
-        image = raw_image.resize((max_edge, max_edge))
-        image_tensor = process_images([image], model.image_processor)
-        image = image_tensor.to(device, dtype=torch.float16)
+        image = data["image"].unsqueeze(0).to(device, dtype=torch.float16, non_blocking=True)
     else:
-        image = vis_processors["eval"](raw_image).unsqueeze(0)
-        image = image.to(device)
+        image = data["image"].unsqueeze(0).to(device, non_blocking=True)
 
 
     qu = "Please describe this image in detail."
@@ -470,17 +539,14 @@ for idx, img_id in tqdm(enumerate(range(len(img_files))), total=len(img_files)):
     candidate_premature_layers = lm_early_exit_layers[:-1]
     premature_layer_dist = {l: 0 for l in candidate_premature_layers}
 
-    halc_assistant_helper.update_input(img_path=image_path, input_prompt=qu)
+    halc_assistant_helper.update_input(
+        img_path=image_path, input_prompt=qu, raw_image=data.get("raw_image")
+    )
 
     image_cd = None
 
     if vcd_decoding:
-        image_tensor_cd = add_diffusion_noise(image, args.noise_step)
-        image_cd = (
-            image_tensor_cd.unsqueeze(0).half().to(device)
-            if image_tensor_cd is not None
-            else None
-        )
+        image_cd = data["image_cd"][None, None].half().to(device, non_blocking=True)
         cd_alpha = cd_alpha
         cd_beta = cd_beta
         print("image_cd", image_cd.shape)
@@ -488,6 +554,9 @@ for idx, img_id in tqdm(enumerate(range(len(img_files))), total=len(img_files)):
         if model_name == "minigpt4":
             image_cd = image_cd.squeeze(0)
 
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
     with torch.inference_mode():
         with torch.no_grad():
             out = model.generate(
@@ -495,9 +564,12 @@ for idx, img_id in tqdm(enumerate(range(len(img_files))), total=len(img_files)):
                 use_nucleus_sampling=args.sample,
                 num_beams=num_beams,
                 max_new_tokens=max_new_tokens,
-                output_attentions=True,
+                output_attentions=opera_decoding,
                 premature_layer=premature_layer,
                 candidate_premature_layers=candidate_premature_layers,
+                jsd_top_k=args.jsd_top_k,
+                decode_budget=decode_budget,
+                decode_engine=args.decode_engine,
                 mature_layer=mature_layer,
                 beam_search=beam_search,
                 dola_decoding=dola_decoding,
@@ -518,8 +590,26 @@ for idx, img_id in tqdm(enumerate(range(len(img_files))), total=len(img_files)):
                 cd_beta=cd_beta,
             )
 
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    latency = time.perf_counter() - start
+
     output_text = out[0]
     print("original output text", output_text)
+    if args.profile_output:
+        decode_profiler.end_sample(image_id=img_id, latency=latency)
+    if args.timing_output:
+        timings.append(
+            {
+                "image_id": img_id,
+                "latency": latency,
+                "new_tokens": len(halc_assistant_helper.tokenizer(output_text, add_special_tokens=False)["input_ids"]),
+                **halc_assistant_helper.grounding_stats,
+            }
+        )
+        if decode_budget is not None:
+            timings[-1]["budget"] = decode_budget.usage()
+        halc_assistant_helper.reset_grounding_stats()
     sentence_list = output_text.split(".")
     sentence_filter_list = []
     for sentence in sentence_list:
@@ -555,6 +645,29 @@ for idx, img_id in tqdm(enumerate(range(len(img_files))), total=len(img_files)):
         json.dump(img_save, f)
         f.write("\n")
 
+if args.timing_output:
+    total_time = sum(t["latency"] for t in timings)
+    summary = {
+        "async_grounding": args.async_grounding,
+        "decode_engine": args.decode_engine,
+        "images": len(timings),
+        "mean_latency": total_time / max(len(timings), 1),
+        "tokens_per_second": sum(t["new_tokens"] for t in timings) / max(total_time, 1e-9),
+        "grounding_blocking_time": sum(t["blocking_time"] for t in timings),
+        "grounding_worker_time": sum(t["worker_time"] for t in timings),
+        "prefetch_wasted": sum(t["prefetch_wasted"] for t in timings),
+    }
+    if timings:
+        latencies = sorted(t["latency"] for t in timings)
+        for q in [50, 95, 99]:
+            summary[f"p{q}_latency"] = latencies[min(len(latencies) - 1, len(latencies) * q // 100)]
+    if decode_budget is not None:
+        summary["budget_exhausted"] = sum(t["budget"]["exhausted"] is not None for t in timings)
+    with open(args.timing_output, "w") as f:
+        json.dump({"summary": summary, "images": timings}, f, indent=4)
+
+if args.profile_output:
+    decode_profiler.dump(args.profile_output)
 
 # ##################  EVALUATION  #####################
 
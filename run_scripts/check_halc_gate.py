@@ -0,0 +1,141 @@
+"""
+HALC beam search (`halc_dola_beam_search`, the path of `-d halc`) with words skipped by the token-level gate
+and with an exhausted DecodeBudget, on a small randomly initialised LLaMA. There is no detector here: every
+word that reaches grounding comes back "invalid", so no word is ever replaced and the three runs must
+decode the same tokens. Exits non-zero if a run raises, takes the corrected-hallucination path, or does
+not gate / charge / exhaust as expected.
+
+    python run_scripts/check_halc_gate.py
+    python run_scripts/check_halc_gate.py --device cuda --beams 3 --new-tokens 32
+"""
+import argparse
+import json
+import sys
+from types import SimpleNamespace
+
+sys.path.append("./")
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+from transformers.generation.decode_budget import DecodeBudget
+from transformers.generation.decode_profiler import decode_profiler
+
+from decoder_zoo.HALC.context_density.halc import VERIFY_CANDIDATE, WORD_START, halc_assistant
+
+from benchmark_utils import add_output_argument, dump_report
+
+
+class WordTokenizer:
+    # every token id above the special ones is the one-token word "w<id>"
+    def decode(self, input_ids, skip_special_tokens=True):
+        if isinstance(input_ids, torch.Tensor):
+            input_ids = input_ids.tolist()
+        return " ".join("w{}".format(i) for i in input_ids if i > 2 or not skip_special_tokens)
+
+
+def build_assistant(config, device):
+    halc_params = {
+        "debugger": 0,
+        "detector": "dino",
+        "box_threshold": 0.4,
+        "k_candidate_num": 2,
+        "LVLM_backbone": "llava-1.5",
+        "score_type": "Random",
+        "context_window": 4,
+        "expand_ratio": 0.6,
+        "skip_rate": 0.0,
+    }
+    assistant = halc_assistant(
+        SimpleNamespace(llama_tokenizer=WordTokenizer()), device=device, halc_params=halc_params
+    )
+    # every token is a word; even ids are nouns the gate lets through, odd ids are gated out
+    token_classes = torch.full((config.vocab_size,), WORD_START, dtype=torch.uint8)
+    token_classes[::2] |= VERIFY_CANDIDATE
+    assistant.token_classes = token_classes
+    assistant.entity_pos_cache = {"w{}".format(i): "NOUN" for i in range(config.vocab_size)}
+    assistant.ground_entity = lambda entity, context_window, expand_ratio: (None, "invalid", None)
+    return assistant
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser(description="Check HALC beam search's verification gate and budget.")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--beams", type=int, default=2)
+    parser.add_argument("--prompt-length", type=int, default=16)
+    parser.add_argument("--new-tokens", type=int, default=24)
+    add_output_argument(parser)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=1000,
+        hidden_size=128,
+        intermediate_size=352,
+        num_hidden_layers=8,
+        num_attention_heads=4,
+        pad_token_id=0,
+        bos_token_id=1,
+        eos_token_id=2,
+    )
+    model = LlamaForCausalLM(config).to(device).eval()
+    input_ids = torch.randint(3, config.vocab_size, (1, args.prompt_length), device=device)
+
+    def run(name, decode_budget=None):
+        assistant = build_assistant(config, device)
+        decode_profiler.enable()
+        sequences = model.generate(
+            input_ids,
+            do_sample=False,
+            num_beams=args.beams,
+            max_new_tokens=args.new_tokens,
+            pad_token_id=config.pad_token_id,
+            eos_token_id=config.eos_token_id,
+            dola_decoding=True,
+            halc_decoding=True,
+            beam_search=True,
+            mature_layer=8,
+            candidate_premature_layers=[0, 2, 4, 6],
+            halc_assistant=assistant,
+            decode_budget=decode_budget,
+        )
+        counters = decode_profiler.end_sample()["counters"]
+        decode_profiler.disable()
+        result = {
+            "tokens": sequences[0].tolist(),
+            "corrections": counters.get("halc_corrections", 0),
+            **{key: assistant.grounding_stats[key] for key in ["gated", "verified", "grounded", "over_budget"]},
+        }
+        if decode_budget is not None:
+            result["budget"] = decode_budget.usage()
+        print(name, json.dumps({k: v for k, v in result.items() if k != "tokens"}))
+        return result
+
+    report = {
+        "gated": run("gated"),
+        "exhausted": run("exhausted", DecodeBudget(max_verifications=1)),
+        "exhausted_at_start": run("exhausted_at_start", DecodeBudget(max_verifications=0)),
+    }
+
+    failures = []
+    if report["gated"]["gated"] == 0 or report["gated"]["verified"] == 0:
+        failures.append("the gated run should both gate and verify words")
+    for name, result in report.items():
+        if result["corrections"] != 0:
+            failures.append("{}: took the corrected-hallucination path".format(name))
+        if result["tokens"] != report["gated"]["tokens"]:
+            failures.append("{}: decoded other tokens than the gated run".format(name))
+    for name, limit in [("exhausted", 1), ("exhausted_at_start", 0)]:
+        budget = report[name]["budget"]
+        if budget["exhausted"] != "verifications" or budget["verifications"] != limit:
+            failures.append("{}: budget {}".format(name, budget))
+
+    dump_report(report, args.output)
+    if failures:
+        sys.exit("\n".join(failures))
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
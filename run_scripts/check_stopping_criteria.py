@@ -0,0 +1,58 @@
+"""
+Per-row finished mask of minigpt4's StoppingCriteriaSub as the greedy / sample loops use it: each step
+reads `stopping_criteria.finished_rows(input_ids)` and then calls `stopping_criteria(input_ids, scores)`
+on the same input_ids. On a 2-row batch whose rows hit the stop sequence on different steps, the first
+row must stay finished until the second one stops, and a reused list must start afresh on the next
+prompt. Exits non-zero on any mismatch.
+
+    python run_scripts/check_stopping_criteria.py
+"""
+import sys
+
+sys.path.append("./")
+sys.path.append("decoder_zoo/HALC")
+
+import torch
+from transformers import StoppingCriteriaList
+
+from minigpt4.conversation.conversation import StoppingCriteriaSub
+
+
+def main():
+    stop = [835, 2277, 29937]  # "###"
+    criteria = StoppingCriteriaList([StoppingCriteriaSub(stops=[torch.tensor(stop)])])
+    # row 0 ends with the stop sequence on step 3 and then pads, row 1 ends with it on step 8.
+    rows = [stop + [0] * 5, [21, 22, 23, 24, 25] + stop]
+    first_done = {0: 3, 1: 8}
+    input_ids = torch.tensor([[1, 2]]).repeat(2, 1)
+
+    failures = []
+    for step in range(1, len(rows[0]) + 1):
+        input_ids = torch.cat([input_ids, torch.tensor([[row[step - 1]] for row in rows])], dim=-1)
+        finished = criteria.finished_rows(input_ids).tolist()
+        stop_all = criteria(input_ids, None)
+        # the second call must not have reset the mask the first one returned
+        again = criteria.finished_rows(input_ids).tolist()
+        expected = [step >= first_done[row] for row in range(2)]
+        print("step", step, "finished", finished, "after __call__", again, "stop", stop_all)
+        if finished != expected or again != expected or stop_all != all(expected):
+            failures.append(step)
+        if stop_all:
+            break
+
+    # reusing the list for a longer prompt (no reset, as generate_pope_input.py does) starts afresh
+    if criteria.finished_rows(torch.ones_like(input_ids).repeat(1, 2)).tolist() != [False, False]:
+        failures.append("longer prompt")
+
+    # a new generation of the same length only starts afresh after an explicit reset (generate() does it)
+    criteria[0].reset()
+    if criteria.finished_rows(torch.ones_like(input_ids)).tolist() != [False, False]:
+        failures.append("reset")
+
+    if failures:
+        sys.exit("mismatch at steps {}".format(failures))
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
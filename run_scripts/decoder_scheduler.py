@@ -0,0 +1,535 @@
+"""
+Iteration-level (continuous batching) scheduler for the contrastive decoders of decoder_zoo.
+
+All running requests share one batched forward per decode step; new requests are prefilled and
+merged into the running batch between two steps, and finished ones are evicted right away, so a
+long generation no longer holds back the requests queued behind it. Each row keeps its own decoder
+parameters:
+
+    greedy / sampling   plain next-token logits (temperature, top_p)
+    dola                contrast of the mature layer against the JSD-selected premature layer,
+                        same as `dola_greedy_decode` in the vendored generation utils
+    vcd                 one extra row per request, fed with the distorted visual input, combined
+                        as in `evolve_vcd_sampling`
+
+HALC and OPERA run a whole beam search per call (with the detector / attention state of one image),
+which cannot be interleaved step by step; they are handed to an exclusive executor that runs the
+backend's own `generate` next to the batched loop.
+"""
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+STEP_DECODERS = ["greedy", "dola", "vcd"]
+EXCLUSIVE_DECODERS = ["halc", "opera"]
+
+MAX_BATCH_ROWS = 16  # rows of the running batch (a VCD request takes two).
+MAX_PREFILL_PER_STEP = 2  # bounds the extra latency of one iteration for the running requests.
+THROUGHPUT_WINDOW = 10.0  # seconds.
+
+
+class DecodeRequest:
+    '''
+        One generation request. `inputs_embeds` (1, T, H) is the prefix built by the backend;
+        `inputs_embeds_cd` is the VCD contrast prefix, which may have a different length.
+        Results are streamed through `stream` as {"text", "error_code"} dicts, ended by None.
+    '''
+
+    _ids = itertools.count()
+
+    def __init__(self, params, inputs_embeds=None, inputs_embeds_cd=None):
+        self.request_id = next(DecodeRequest._ids)
+        self.params = params
+        self.decoder = params.get("decoder", "greedy")
+        self.inputs_embeds = inputs_embeds
+        self.inputs_embeds_cd = inputs_embeds_cd
+
+        self.temperature = float(params.get("temperature", 0.0))
+        self.top_p = float(params.get("top_p", 1.0))
+        self.max_new_tokens = int(params.get("max_new_tokens", 256))
+        self.stop = params.get("stop", None)
+        # DoLa
+        self.mature_layer = params.get("mature_layer", None)
+        self.candidate_premature_layers = params.get("candidate_premature_layers", None)
+        self.relative_top = float(params.get("relative_top", 0.1))
+        # VCD
+        self.cd_alpha = float(params.get("cd_alpha", 1.0))
+        self.cd_beta = float(params.get("cd_beta", 0.1))
+
+        self.generator = None
+        if params.get("seed", None) is not None:
+            self.generator = torch.Generator()
+            self.generator.manual_seed(int(params["seed"]))
+
+        self.tokens = []
+        self.text = ""
+        self.finish_reason = None
+        self.stream = queue.Queue()
+        self.arrival_time = time.perf_counter()
+        self.first_token_time = None
+        self.finish_time = None
+
+    @property
+    def num_rows(self):
+        return 2 if self.decoder == "vcd" else 1
+
+    @property
+    def do_sample(self):
+        return self.temperature > 0.001
+
+    def emit(self, text, error_code=0):
+        self.stream.put({"text": text, "error_code": error_code})
+
+    def close(self, reason):
+        self.finish_reason = reason
+        self.finish_time = time.perf_counter()
+        self.stream.put(None)
+
+    def iter_stream(self):
+        while True:
+            event = self.stream.get()
+            if event is None:
+                return
+            yield event
+
+
+def relative_top_filter(scores, relative_top=0.1, filter_value=-float("Inf"), min_tokens_to_keep=1):
+    scores_normalized = scores.log_softmax(dim=-1)
+    sorted_logits, _ = torch.sort(scores_normalized, descending=True)
+    min_thresh = sorted_logits[..., min_tokens_to_keep - 1]
+    probs_max = torch.max(scores_normalized, dim=-1).values
+    probs_thresh = probs_max + np.log(relative_top)
+    probs_thresh = torch.min(min_thresh, probs_thresh).unsqueeze(-1)
+    scores_normalized[scores_normalized < probs_thresh] = filter_value
+    return scores_normalized
+
+
+def dola_logits(layer_logits, mature_layer, candidate_premature_layers, relative_top=0.1):
+    # layer_logits: {layer: (vocab,)} of a single row.
+    mature = layer_logits[mature_layer]
+    stacked_premature_layers = torch.stack([layer_logits[i] for i in candidate_premature_layers], dim=0)
+
+    softmax_mature_layer = F.softmax(mature, dim=-1)
+    softmax_premature_layers = F.softmax(stacked_premature_layers, dim=-1)
+    M = 0.5 * (softmax_mature_layer[None, :] + softmax_premature_layers)
+    log_softmax_mature_layer = F.log_softmax(mature, dim=-1)
+    log_softmax_premature_layers = F.log_softmax(stacked_premature_layers, dim=-1)
+    kl1 = F.kl_div(log_softmax_mature_layer[None, :], M, reduction="none").mean(-1)
+    kl2 = F.kl_div(log_softmax_premature_layers, M, reduction="none").mean(-1)
+    js_divs = 0.5 * (kl1 + kl2)
+    premature_layer = candidate_premature_layers[int(js_divs.argmax().cpu().item())]
+
+    base_logits = layer_logits[premature_layer]
+    final_logits = mature
+    if relative_top > 0.0:
+        final_logits = relative_top_filter(final_logits, relative_top)
+        base_logits = base_logits.log_softmax(dim=-1)
+        base_logits[final_logits < -1e3] = -1e3
+    return final_logits - base_logits
+
+
+def vcd_logits(logits, logits_cd, cd_alpha=1.0, cd_beta=0.1):
+    cutoff = np.log(cd_beta) + logits.max(dim=-1, keepdim=True).values
+    diffs = (1 + cd_alpha) * logits - cd_alpha * logits_cd
+    return diffs.masked_fill(logits < cutoff, -float("inf"))
+
+
+def select_token(logits, request):
+    if not request.do_sample:
+        return int(logits.argmax(dim=-1).item())
+    logits = logits.float() / request.temperature
+    if request.top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        sorted_remove = cumulative_probs > request.top_p
+        sorted_remove[1:] = sorted_remove[:-1].clone()
+        sorted_remove[0] = False
+        remove = torch.zeros_like(sorted_remove).scatter(0, sorted_indices, sorted_remove)
+        logits = logits.masked_fill(remove, -float("inf"))
+    probs = logits.softmax(dim=-1).cpu()
+    return int(torch.multinomial(probs, num_samples=1, generator=request.generator).item())
+
+
+def to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple(tuple(layer) for layer in past_key_values)
+
+
+def left_pad(tensor, length, dim):
+    pad = length - tensor.shape[dim]
+    if pad == 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = pad
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class RunningBatch:
+    '''
+        The batched state of the running rows. Rows are left-padded to a common cache length:
+            past: per layer (key, value), each (R, heads, L, head_dim)
+            attention_mask: (R, L), 0 on the padding
+            positions: (R,) position id of the next token of each row
+            last_tokens: (R,) token fed at the next step
+            rows: (request, is_contrast_row) of each row
+    '''
+
+    def __init__(self):
+        self.past = None
+        self.attention_mask = None
+        self.positions = None
+        self.last_tokens = None
+        self.rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def merge(self, past, attention_mask, positions, last_tokens, rows):
+        if self.past is None:
+            self.past, self.attention_mask = past, attention_mask
+            self.positions, self.last_tokens, self.rows = positions, last_tokens, rows
+            return
+        length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+        self.past = tuple(
+            tuple(torch.cat([left_pad(a, length, 2), left_pad(b, length, 2)], dim=0) for a, b in zip(old, new))
+            for old, new in zip(self.past, past)
+        )
+        self.attention_mask = torch.cat(
+            [left_pad(self.attention_mask, length, 1), left_pad(attention_mask, length, 1)], dim=0
+        )
+        self.positions = torch.cat([self.positions, positions])
+        self.last_tokens = torch.cat([self.last_tokens, last_tokens])
+        self.rows = self.rows + rows
+
+    def keep(self, keep_rows):
+        if len(keep_rows) == len(self.rows):
+            return
+        if len(keep_rows) == 0:
+            self.__init__()
+            return
+        index = torch.tensor(keep_rows, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # drop the columns that are padding for every remaining row.
+        start = int((attention_mask.sum(0) > 0).nonzero()[0].item())
+        self.attention_mask = attention_mask[:, start:]
+        self.past = tuple(tuple(t.index_select(0, index)[:, :, start:] for t in layer) for layer in self.past)
+        self.positions = self.positions.index_select(0, index)
+        self.last_tokens = self.last_tokens.index_select(0, index)
+        self.rows = [self.rows[i] for i in keep_rows]
+
+
+class SchedulerMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.generated_tokens = 0
+        self.steps = 0
+        self.step_time = 0.0
+        self.step_rows = 0
+        self.ttft = []
+        self.latency = []
+        self.token_log = deque()  # (time, tokens) of the last THROUGHPUT_WINDOW seconds.
+
+    def record_step(self, duration, rows, tokens):
+        with self.lock:
+            self.steps += 1
+            self.step_time += duration
+            self.step_rows += rows
+        self.record_tokens(tokens)
+
+    def record_tokens(self, tokens):
+        now = time.perf_counter()
+        with self.lock:
+            self.generated_tokens += tokens
+            self.token_log.append((now, tokens))
+            while self.token_log and self.token_log[0][0] < now - THROUGHPUT_WINDOW:
+                self.token_log.popleft()
+
+    def record_finish(self, request, failed=False):
+        with self.lock:
+            if failed:
+                self.failed += 1
+                return
+            self.completed += 1
+            if request.first_token_time is not None:
+                self.ttft.append(request.first_token_time - request.arrival_time)
+            self.latency.append(request.finish_time - request.arrival_time)
+
+    def summary(self):
+        with self.lock:
+            now = time.perf_counter()
+            window = [n for t, n in self.token_log if t >= now - THROUGHPUT_WINDOW]
+            return {
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "generated_tokens": self.generated_tokens,
+                "steps": self.steps,
+                "tokens_per_second": sum(window) / THROUGHPUT_WINDOW,
+                "step_time_mean": self.step_time / self.steps if self.steps else 0.0,
+                "batch_rows_mean": self.step_rows / self.steps if self.steps else 0.0,
+                "ttft_mean": float(np.mean(self.ttft)) if self.ttft else 0.0,
+                "ttft_p95": float(np.percentile(self.ttft, 95)) if self.ttft else 0.0,
+                "latency_mean": float(np.mean(self.latency)) if self.latency else 0.0,
+                "latency_p95": float(np.percentile(self.latency, 95)) if self.latency else 0.0,
+            }
+
+
+class IterationScheduler:
+    '''
+        backend: provides
+            model                   the causal LM (HF interface: input_ids / inputs_embeds, past_key_values,
+                                    attention_mask, position_ids, output_hidden_states), or None if the
+                                    backend only supports `generate`
+            decode(token_ids)       detokenized text of the generated ids
+            eos_token_id
+            generate(params)        full-text generation for the exclusive decoders (HALC / OPERA)
+        Requests are submitted from any thread; the decode loop runs on its own thread.
+    '''
+
+    def __init__(self, backend, max_batch_rows=MAX_BATCH_ROWS, max_prefill_per_step=MAX_PREFILL_PER_STEP):
+        self.backend = backend
+        self.model = backend.model
+        self.max_batch_rows = max_batch_rows
+        self.max_prefill_per_step = max_prefill_per_step
+        if self.model is not None:
+            self.num_layers = self.model.config.num_hidden_layers
+            self.lm_head = self.model.get_output_embeddings()
+
+        self.waiting = deque()
+        self.batch = RunningBatch()
+        self.exclusive = ThreadPoolExecutor(max_workers=1)
+        self.exclusive_pending = 0
+        self.metrics = SchedulerMetrics()
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        with self.metrics.lock:
+            self.metrics.submitted += 1
+        if request.decoder not in STEP_DECODERS + EXCLUSIVE_DECODERS:
+            request.emit(f"Unknown decoder {request.decoder}, should be in {STEP_DECODERS + EXCLUSIVE_DECODERS}", 1)
+            request.close("error")
+            self.metrics.record_finish(request, failed=True)
+        elif request.decoder in EXCLUSIVE_DECODERS or request.inputs_embeds is None:
+            # requests without a prefix are left to the backend's `generate` as well.
+            with self.cond:
+                self.exclusive_pending += 1
+            self.exclusive.submit(self.run_exclusive, request)
+        else:
+            with self.cond:
+                self.waiting.append(request)
+                self.cond.notify()
+        return request
+
+    def queue_length(self):
+        with self.cond:
+            running = len({id(request) for request, _ in self.batch.rows})
+            return len(self.waiting) + running + self.exclusive_pending
+
+    def get_metrics(self):
+        metrics = self.metrics.summary()
+        with self.cond:
+            metrics["waiting"] = len(self.waiting)
+            metrics["running_requests"] = len({id(request) for request, _ in self.batch.rows})
+            metrics["running_rows"] = len(self.batch)
+            metrics["exclusive_pending"] = self.exclusive_pending
+        return metrics
+
+    def shutdown(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+        self.exclusive.shutdown()
+
+    def run_exclusive(self, request):
+        try:
+            request.first_token_time = time.perf_counter()
+            request.text = self.backend.generate(request.params)
+            request.emit(request.text)
+            request.close("stop")
+            self.metrics.record_finish(request)
+        except Exception as e:
+            request.emit(f"{type(e).__name__}: {e}", 1)
+            request.close("error")
+            self.metrics.record_finish(request, failed=True)
+        finally:
+            with self.cond:
+                self.exclusive_pending -= 1
+
+    # ---------------------------------------------------------------- decode loop
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while self.running and not self.waiting and len(self.batch) == 0:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                admitted = []
+                rows = len(self.batch)
+                while (self.waiting and len(admitted) < self.max_prefill_per_step
+                       and rows + self.waiting[0].num_rows <= self.max_batch_rows):
+                    request = self.waiting.popleft()
+                    rows += request.num_rows
+                    admitted.append(request)
+                if not admitted and len(self.batch) == 0 and self.waiting:
+                    # a request that can never fit.
+                    request = self.waiting.popleft()
+                    request.emit(f"Request needs {request.num_rows} rows, max_batch_rows is {self.max_batch_rows}", 1)
+                    request.close("error")
+                    self.metrics.record_finish(request, failed=True)
+                    continue
+
+            for request in admitted:
+                try:
+                    self.prefill(request)
+                except Exception as e:
+                    request.emit(f"{type(e).__name__}: {e}", 1)
+                    request.close("error")
+                    self.metrics.record_finish(request, failed=True)
+
+            if len(self.batch) > 0:
+                try:
+                    self.step()
+                except Exception as e:
+                    # a failed batched forward cannot be attributed to a row: fail every running request.
+                    with self.cond:
+                        requests = list({id(r): r for r, _ in self.batch.rows}.values())
+                        self.batch = RunningBatch()
+                    for request in requests:
+                        request.emit(f"{type(e).__name__}: {e}", 1)
+                        request.close("error")
+                        self.metrics.record_finish(request, failed=True)
+
+    def forward(self, **kwargs):
+        return self.model(use_cache=True, return_dict=True, **kwargs)
+
+    def row_logits(self, request, outputs, rows):
+        # next-token logits of `request`, given the indices of its row(s) in `outputs`.
+        if request.decoder == "dola":
+            mature_layer = request.mature_layer if request.mature_layer is not None else self.num_layers
+            candidates = request.candidate_premature_layers
+            if candidates is None:
+                candidates = list(range(0, mature_layer, 2))
+            layer_logits = {
+                layer: self.lm_head(outputs.hidden_states[layer][rows[0], -1]).float()
+                for layer in set(candidates + [mature_layer])
+            }
+            return dola_logits(layer_logits, mature_layer, candidates, request.relative_top)
+        logits = outputs.logits[rows[0], -1].float()
+        if request.decoder == "vcd":
+            return vcd_logits(logits, outputs.logits[rows[1], -1].float(), request.cd_alpha, request.cd_beta)
+        return logits
+
+    @torch.inference_mode()
+    def prefill(self, request):
+        device = request.inputs_embeds.device
+        prefixes = [request.inputs_embeds]
+        if request.decoder == "vcd":
+            prefixes.append(request.inputs_embeds_cd)
+        past, masks, positions = [], [], []
+        outputs = []
+        for embeds in prefixes:
+            length = embeds.shape[1]
+            out = self.forward(
+                inputs_embeds=embeds,
+                attention_mask=torch.ones(1, length, dtype=torch.long, device=device),
+                position_ids=torch.arange(length, device=device)[None],
+                output_hidden_states=request.decoder == "dola",
+            )
+            outputs.append(out)
+            past.append(to_legacy_cache(out.past_key_values))
+            masks.append(torch.ones(1, length, dtype=torch.long, device=device))
+            positions.append(torch.tensor([length], device=device))
+
+        # the contrast row of VCD only contributes its logits: stitch both outputs into one view.
+        joined = SimpleNamespace(
+            logits=torch.cat([out.logits[:, -1:] for out in outputs], dim=0),
+            hidden_states=outputs[0].hidden_states,
+        )
+        token = select_token(self.row_logits(request, joined, [0, 1]), request)
+        self.metrics.record_tokens(1)
+        if self.append_token(request, token):
+            return
+
+        length = max(m.shape[1] for m in masks)
+        past = tuple(
+            tuple(torch.cat([left_pad(p[layer][i], length, 2) for p in past], dim=0) for i in range(2))
+            for layer in range(len(past[0]))
+        )
+        attention_mask = torch.cat([left_pad(m, length, 1) for m in masks], dim=0)
+        last_tokens = torch.full((len(prefixes),), token, dtype=torch.long, device=device)
+        rows = [(request, i > 0) for i in range(len(prefixes))]
+        with self.cond:
+            self.batch.merge(past, attention_mask, torch.cat(positions), last_tokens, rows)
+
+    @torch.inference_mode()
+    def step(self):
+        start = time.perf_counter()
+        batch = self.batch
+        device = batch.attention_mask.device
+        attention_mask = torch.cat(
+            [batch.attention_mask, torch.ones(len(batch), 1, dtype=batch.attention_mask.dtype, device=device)], dim=1
+        )
+        outputs = self.forward(
+            input_ids=batch.last_tokens[:, None],
+            past_key_values=batch.past,
+            attention_mask=attention_mask,
+            position_ids=batch.positions[:, None],
+            output_hidden_states=any(request.decoder == "dola" for request, _ in batch.rows),
+        )
+        batch.past = to_legacy_cache(outputs.past_key_values)
+        batch.attention_mask = attention_mask
+        batch.positions = batch.positions + 1
+
+        request_rows = {}
+        for i, (request, _) in enumerate(batch.rows):
+            request_rows.setdefault(id(request), (request, []))[1].append(i)
+        next_tokens = batch.last_tokens.clone()
+        keep_rows = []
+        for request, rows in request_rows.values():
+            token = select_token(self.row_logits(request, outputs, rows), request)
+            next_tokens[rows] = token
+            if not self.append_token(request, token):
+                keep_rows.extend(rows)
+        batch.last_tokens = next_tokens
+        with self.cond:
+            batch.keep(sorted(keep_rows))
+        self.metrics.record_step(time.perf_counter() - start, len(attention_mask), len(request_rows))
+
+    def append_token(self, request, token):
+        # returns True once the request is finished.
+        if request.first_token_time is None:
+            request.first_token_time = time.perf_counter()
+        finished = None
+        if token == self.backend.eos_token_id:
+            finished = "stop"
+        else:
+            request.tokens.append(token)
+            request.text = self.backend.decode(request.tokens)
+            if request.stop and request.stop in request.text:
+                request.text = request.text.split(request.stop)[0]
+                finished = "stop"
+            elif len(request.tokens) >= request.max_new_tokens:
+                finished = "length"
+        request.emit(request.text)
+        if finished is not None:
+            request.close(finished)
+            self.metrics.record_finish(request)
+            return True
+        return False
@@ -0,0 +1,457 @@
+"""
+A model worker that serves the decoders of decoder_zoo (greedy / DoLa / VCD / HALC / OPERA) behind the
+mPLUG-Owl2 controller / worker protocol (mPLUG-Owl/mPLUG-Owl2/mplug_owl2/serve/controller.py).
+
+Unlike mplug_owl2/serve/model_worker.py, requests are not serialized behind a semaphore: greedy, DoLa
+and VCD requests join a continuously batched decode loop (see run_scripts/decoder_scheduler.py), and
+each request selects its own decoder and parameters:
+
+    {"prompt": "...", "images": [<base64>], "decoder": "dola", "max_new_tokens": 64, "temperature": 0,
+     "candidate_premature_layers": [0, 2, ..., 30], "mature_layer": 32, "cd_alpha": 1, "cd_beta": 0.1, ...}
+
+A CPU-only setup with a tiny random LLaMA and a local controller:
+
+    cd mPLUG-Owl/mPLUG-Owl2 && python -m mplug_owl2.serve.controller --port 21001 && cd ../..
+    python run_scripts/decoder_worker.py --tiny-random --device cpu --port 21002
+    python run_scripts/decoder_worker_client.py --model-name tiny-random --num-requests 16 --decoder dola
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from io import BytesIO
+
+sys.path.append("mPLUG-Owl/mPLUG-Owl2")
+sys.path.append("./")
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import requests
+import torch
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from PIL import Image
+
+from mplug_owl2.constants import WORKER_HEART_BEAT_INTERVAL
+from mplug_owl2.utils import build_logger, server_error_msg
+
+from decoder_scheduler import (
+    EXCLUSIVE_DECODERS,
+    MAX_BATCH_ROWS,
+    MAX_PREFILL_PER_STEP,
+    STEP_DECODERS,
+    DecodeRequest,
+    IterationScheduler,
+)
+
+worker_id = str(uuid.uuid4())[:6]
+logger = build_logger("decoder_worker", f"decoder_worker_{worker_id}.log")
+
+MODEL_EVAL_CONFIG_PATH = {
+    "minigpt4": "eval_configs/minigpt4_eval.yaml",
+    "instructblip": "eval_configs/instructblip_eval.yaml",
+    "lrv_instruct": "eval_configs/lrv_instruct_eval.yaml",
+    "shikra": "eval_configs/shikra_eval.yaml",
+    "llava-1.5": "eval_configs/llava-1.5_eval.yaml",
+    "mplug-owl2": "eval_configs/mplug-owl2_eval.yaml",
+}
+
+INSTRUCTION_TEMPLATE = {
+    "minigpt4": "###Human: <Img><ImageHere></Img> <question> ###Assistant:",
+    "instructblip": "<ImageHere><question>",
+    "lrv_instruct": "###Human: <Img><ImageHere></Img> <question> ###Assistant:",
+    "shikra": "USER: <im_start><ImageHere><im_end> <question> ASSISTANT:",
+    "llava-1.5": "USER: <ImageHere> <question> ASSISTANT:",
+    "mplug-owl2": "USER: <|image|><question> ASSISTANT:",
+}
+
+# the backbones whose prefix can be built outside of `generate`, i.e. that can join the batched loop.
+STEP_BACKBONES = ["minigpt4", "lrv_instruct"]
+
+
+def heart_beat_worker(controller):
+    while True:
+        time.sleep(WORKER_HEART_BEAT_INTERVAL)
+        controller.send_heart_beat()
+
+
+class ByteTokenizer:
+    # an offline tokenizer for the tiny random model: one token per utf-8 byte.
+    bos_token_id = 1
+    eos_token_id = 2
+    offset = 3
+    vocab_size = 256 + 3
+
+    def encode(self, text):
+        return [self.bos_token_id] + [b + self.offset for b in text.encode("utf-8")]
+
+    def decode(self, token_ids):
+        return bytes(i - self.offset for i in token_ids if i >= self.offset).decode("utf-8", errors="ignore")
+
+
+class TextBackend:
+    '''
+        A plain causal LM (the tiny random LLaMA used for CPU tests). There is no image, so the VCD
+        contrast row is fed the bare BOS prefix, and HALC / OPERA are not available.
+    '''
+
+    def __init__(self, model, tokenizer, device):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.eos_token_id = tokenizer.eos_token_id
+        self.context_len = model.config.max_position_embeddings
+
+    def embed(self, token_ids):
+        token_ids = torch.tensor([token_ids], dtype=torch.long, device=self.device)
+        return self.model.get_input_embeddings()(token_ids)
+
+    @torch.inference_mode()
+    def prepare(self, params):
+        token_ids = self.tokenizer.encode(params["prompt"])
+        inputs_embeds_cd = self.embed(token_ids[:1]) if params.get("decoder") == "vcd" else None
+        return DecodeRequest(params, self.embed(token_ids), inputs_embeds_cd)
+
+    def decode(self, token_ids):
+        return self.tokenizer.decode(token_ids)
+
+    def generate(self, params):
+        raise ValueError(f"Decoder {params.get('decoder')} needs an LVLM backbone.")
+
+
+class LVLMBackend:
+    '''
+        An LVLM of minigpt4/models, loaded from its eval config as in run_scripts/caption_generation.py.
+        For the backbones of STEP_BACKBONES, greedy / DoLa / VCD prefixes are built here and decoded by the
+        scheduler; every other (backbone, decoder) pair goes through the model's own `generate`.
+    '''
+
+    def __init__(self, args, device):
+        from torchvision import transforms
+
+        from minigpt4.common.config import Config
+        from minigpt4.common.registry import registry
+        from minigpt4.models import load_preprocess
+        # imports modules for registration
+        import minigpt4.datasets.builders  # noqa: F401
+        import minigpt4.processors  # noqa: F401
+
+        args.cfg_path = MODEL_EVAL_CONFIG_PATH[args.model]
+        cfg = Config(args)
+        self.args = args
+        self.model_name = args.model
+        self.device = device
+
+        model_config = cfg.model_cfg
+        model_config.device_8bit = args.gpu_id
+        model_cls = registry.get_model_class(model_config.arch)
+        self.lvlm = model_cls.from_config(model_config).to(device)
+        self.lvlm.eval()
+
+        processor_cfg = cfg.get_config().preprocess
+        processor_cfg.vis_processor.eval.do_normalize = False
+        self.vis_processors, _ = load_preprocess(processor_cfg)
+        vis_processor_cfg = cfg.datasets_cfg.cc_sbu_align.vis_processor.train
+        self.vis_processor = registry.get_processor_class(vis_processor_cfg.name).from_config(vis_processor_cfg)
+        self.norm = transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
+
+        self.step_decoding = self.model_name in STEP_BACKBONES
+        self.model = None
+        if self.step_decoding:
+            self.model = self.lvlm.llama_model
+            self.tokenizer = self.lvlm.llama_tokenizer
+            self.tokenizer.padding_side = "left"
+            self.eos_token_id = self.tokenizer.eos_token_id
+            self.context_len = self.model.config.max_position_embeddings
+        self.halc_assistant = None
+        self.lock = threading.Lock()  # `generate` keeps per-call state on the model.
+
+    def load_image(self, params):
+        images = params.get("images", None)
+        if not images:
+            raise ValueError("An image is required.")
+        raw_image = Image.open(BytesIO(base64.b64decode(images[0]))).convert("RGB")
+        image = self.vis_processors["eval"](raw_image).unsqueeze(0).to(self.device)
+        return raw_image, image
+
+    def distorted_image(self, image, params):
+        from decoder_zoo.VCD.vcd_utils.vcd_add_noise import add_diffusion_noise
+
+        image_cd = add_diffusion_noise(image, int(params.get("noise_step", 500)))
+        return image_cd.unsqueeze(0).half().to(self.device).squeeze(0)
+
+    def prefix_embeds(self, image, instruction):
+        # the prefix built by MiniGPT4.generate: bos + prompt-wrapped image embeddings.
+        img_embeds, atts_img = self.lvlm.encode_img(image)
+        inputs_embeds, _, _ = self.lvlm.prompt_wrap(img_embeds, atts_img, instruction)
+        bos = torch.ones([1, 1], dtype=torch.int64, device=inputs_embeds.device) * self.tokenizer.bos_token_id
+        with self.lvlm.maybe_autocast():
+            return torch.cat([self.lvlm.embed_tokens(bos), inputs_embeds], dim=1)
+
+    def instruction(self, params):
+        return INSTRUCTION_TEMPLATE[self.model_name].replace("<question>", params["prompt"])
+
+    @torch.inference_mode()
+    def prepare(self, params):
+        decoder = params.get("decoder", "greedy")
+        if not self.step_decoding or decoder in EXCLUSIVE_DECODERS:
+            # no prefix: the scheduler hands the request to `generate`.
+            return DecodeRequest(params)
+        params = dict(params)
+        params.setdefault("stop", "###")
+        _, image = self.load_image(params)
+        instruction = self.instruction(params)
+        inputs_embeds = self.prefix_embeds(self.norm(image), instruction)
+        inputs_embeds_cd = None
+        if decoder == "vcd":
+            inputs_embeds_cd = self.prefix_embeds(self.distorted_image(image, params), instruction)
+        return DecodeRequest(params, inputs_embeds, inputs_embeds_cd)
+
+    def decode(self, token_ids):
+        token_ids = [2 if i in (0, 1) else i for i in token_ids]  # same as MiniGPT4.generate
+        text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+        return text.split("Assistant:")[-1].strip()
+
+    def get_halc_assistant(self, params):
+        from decoder_zoo.HALC.context_density.halc import halc_assistant
+
+        if self.halc_assistant is None:
+            halc_params = {
+                "context_domain": "upper",
+                "contrast_weight": 0.05,
+                "context_window": 4,
+                "expand_ratio": float(params.get("expand_ratio", 0.6)),
+                "beam_size": int(params.get("num_beams", 1)),
+                "k_candidate_num": int(params.get("k_candidate_num", 2)),
+                "LVLM_backbone": self.model_name,
+                "detector": self.args.detector,
+                "score_type": "BLIP",
+                "debugger": 0,
+                "box_threshold": float(params.get("box_threshold", 0.45)),
+            }
+            self.halc_assistant = halc_assistant(
+                self.lvlm,
+                vis_processor=self.vis_processor,
+                device=self.device,
+                halc_params=halc_params,
+                max_new_tokens=int(params.get("max_new_tokens", 64)),
+            )
+        return self.halc_assistant
+
+    @torch.inference_mode()
+    def generate(self, params):
+        # one call of the model's own `generate`, with the same arguments as run_scripts/caption_generation.py.
+        decoder = params.get("decoder", "greedy")
+        raw_image, image = self.load_image(params)
+        instruction = self.instruction(params)
+        num_beams = int(params.get("num_beams", 1))
+        lm_early_exit_layers = params.get("lm_early_exit_layers", list(range(0, 33, 2)))
+        images_cd = self.distorted_image(image, params) if decoder == "vcd" else None
+
+        with self.lock, tempfile.NamedTemporaryFile(suffix=".png") as image_file:
+            halc_helper = None
+            if decoder == "halc":
+                # the detector grounds words on the image file.
+                raw_image.save(image_file.name)
+                halc_helper = self.get_halc_assistant(params)
+                halc_helper.update_input(img_path=image_file.name, input_prompt=instruction)
+            out = self.lvlm.generate(
+                {"image": self.norm(image), "prompt": instruction, "img_path": image_file.name},
+                use_nucleus_sampling=float(params.get("temperature", 0.0)) > 0.001,
+                num_beams=num_beams,
+                max_new_tokens=int(params.get("max_new_tokens", 64)),
+                output_attentions=decoder == "opera",
+                premature_layer=None,
+                candidate_premature_layers=lm_early_exit_layers[:-1],
+                mature_layer=lm_early_exit_layers[-1],
+                beam_search=decoder in ["halc", "opera"],
+                dola_decoding=decoder in ["dola", "halc"],
+                opera_decoding=decoder == "opera",
+                vcd_decoding=decoder == "vcd",
+                halc_decoding=decoder == "halc",
+                halc_assistant=halc_helper,
+                key_position=None,
+                scale_factor=float(params.get("scale_factor", 50)),
+                threshold=int(params.get("threshold", 15)),
+                num_attn_candidates=int(params.get("num_attn_candidates", 5)),
+                penalty_weights=float(params.get("penalty_weights", 1.0)),
+                images_cd=images_cd,
+                cd_alpha=float(params.get("cd_alpha", 1)),
+                cd_beta=float(params.get("cd_beta", 0.1)),
+            )
+        return out[0]
+
+
+def build_tiny_random_model(device, seed=0):
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(seed)
+    tokenizer = ByteTokenizer()
+    config = LlamaConfig(
+        vocab_size=tokenizer.vocab_size,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        max_position_embeddings=512,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    model = LlamaForCausalLM(config).to(device).eval()
+    return TextBackend(model, tokenizer, device)
+
+
+class DecoderWorker:
+    def __init__(self, controller_addr, worker_addr, worker_id, no_register, model_name, backend,
+                 max_batch_rows, max_prefill_per_step):
+        self.controller_addr = controller_addr
+        self.worker_addr = worker_addr
+        self.worker_id = worker_id
+        self.model_name = model_name
+        self.backend = backend
+        self.scheduler = IterationScheduler(backend, max_batch_rows, max_prefill_per_step)
+        logger.info(f"Serving {self.model_name} on worker {worker_id}, decoders: {STEP_DECODERS + EXCLUSIVE_DECODERS}")
+
+        if not no_register:
+            self.register_to_controller()
+            self.heart_beat_thread = threading.Thread(
+                target=heart_beat_worker, args=(self,), daemon=True)
+            self.heart_beat_thread.start()
+
+    def register_to_controller(self):
+        logger.info("Register to controller")
+
+        url = self.controller_addr + "/register_worker"
+        data = {
+            "worker_name": self.worker_addr,
+            "check_heart_beat": True,
+            "worker_status": self.get_status()
+        }
+        r = requests.post(url, json=data)
+        assert r.status_code == 200
+
+    def send_heart_beat(self):
+        logger.info(f"Send heart beat. Models: {[self.model_name]}. "
+                    f"Metrics: {self.scheduler.get_metrics()}")
+
+        url = self.controller_addr + "/receive_heart_beat"
+
+        while True:
+            try:
+                ret = requests.post(url, json={
+                    "worker_name": self.worker_addr,
+                    "queue_length": self.get_queue_length()}, timeout=5)
+                exist = ret.json()["exist"]
+                break
+            except requests.exceptions.RequestException as e:
+                logger.error(f"heart beat error: {e}")
+            time.sleep(5)
+
+        if not exist:
+            self.register_to_controller()
+
+    def get_queue_length(self):
+        return self.scheduler.queue_length()
+
+    def get_status(self):
+        return {
+            "model_names": [self.model_name],
+            "speed": 1,
+            "queue_length": self.get_queue_length(),
+        }
+
+    def generate_stream(self, params):
+        params = dict(params)
+        params["max_new_tokens"] = min(int(params.get("max_new_tokens", 256)), 1024)
+        request = self.backend.prepare(params)
+        if request.inputs_embeds is not None:
+            context_len = getattr(self.backend, "context_len", 4096)
+            request.max_new_tokens = min(request.max_new_tokens, context_len - request.inputs_embeds.shape[1])
+            if request.max_new_tokens < 1:
+                yield json.dumps({"text": params["prompt"] + "Exceeds max token length. Please start a new conversation, thanks.", "error_code": 0}).encode() + b"\0"
+                return
+        self.scheduler.submit(request)
+        for event in request.iter_stream():
+            yield json.dumps(event).encode() + b"\0"
+
+    def generate_stream_gate(self, params):
+        try:
+            for x in self.generate_stream(params):
+                yield x
+        except Exception as e:
+            logger.error(f"Caught {type(e).__name__}: {e}")
+            ret = {
+                "text": server_error_msg,
+                "error_code": 1,
+            }
+            yield json.dumps(ret).encode() + b"\0"
+
+
+app = FastAPI()
+
+
+@app.post("/worker_generate_stream")
+async def generate_stream(request: Request):
+    params = await request.json()
+    generator = worker.generate_stream_gate(params)
+    return StreamingResponse(generator)
+
+
+@app.post("/worker_get_status")
+async def get_status(request: Request):
+    return worker.get_status()
+
+
+@app.post("/worker_get_metrics")
+async def get_metrics(request: Request):
+    return worker.scheduler.get_metrics()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=21002)
+    parser.add_argument("--worker-address", type=str,
+        default="http://localhost:21002")
+    parser.add_argument("--controller-address", type=str,
+        default="http://localhost:21001")
+    parser.add_argument("--model", type=str, default="minigpt4", choices=list(MODEL_EVAL_CONFIG_PATH))
+    parser.add_argument("--model-name", type=str, default=None, help="name registered to the controller.")
+    parser.add_argument("--tiny-random", action="store_true", help="serve a tiny random LLaMA (text only, for CPU tests).")
+    parser.add_argument("-g", "--gpu-id", type=int, default=0)
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--detector", type=str, default="dino", help="HALC detector, 'dino' or 'owlv2'.")
+    parser.add_argument("--max-batch-rows", type=int, default=MAX_BATCH_ROWS)
+    parser.add_argument("--max-prefill-per-step", type=int, default=MAX_PREFILL_PER_STEP)
+    parser.add_argument("--no-register", action="store_true")
+    parser.add_argument(
+        "--options",
+        nargs="+",
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file.",
+    )
+    args = parser.parse_args()
+    logger.info(f"args: {args}")
+
+    device = args.device or (f"cuda:{args.gpu_id}" if torch.cuda.is_available() else "cpu")
+    if args.tiny_random:
+        backend = build_tiny_random_model(device)
+        model_name = args.model_name or "tiny-random"
+    else:
+        backend = LVLMBackend(args, device)
+        model_name = args.model_name or args.model
+
+    worker = DecoderWorker(args.controller_address,
+                           args.worker_address,
+                           worker_id,
+                           args.no_register,
+                           model_name,
+                           backend,
+                           args.max_batch_rows,
+                           args.max_prefill_per_step)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
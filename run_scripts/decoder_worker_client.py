@@ -0,0 +1,83 @@
+"""
+Fire concurrent streaming requests at a decoder worker (run_scripts/decoder_worker.py) through the
+controller, and report the client-side time to first token / latency and the worker metrics.
+
+    python run_scripts/decoder_worker_client.py --model-name tiny-random --num-requests 16 --decoder dola
+    python run_scripts/decoder_worker_client.py --model-name minigpt4 --image examples/case1.jpg --decoder vcd
+"""
+import argparse
+import base64
+import json
+import threading
+import time
+
+import numpy as np
+import requests
+
+
+def stream_request(worker_addr, params, result):
+    start = time.perf_counter()
+    first_token = None
+    text, error_code = "", 0
+    response = requests.post(worker_addr + "/worker_generate_stream", json=params, stream=True, timeout=600)
+    for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+        if chunk:
+            data = json.loads(chunk.decode())
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            text, error_code = data["text"], data["error_code"]
+    result.update(text=text, error_code=error_code, ttft=first_token, latency=time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--controller-address", type=str, default="http://localhost:21001")
+    parser.add_argument("--model-name", type=str, default="tiny-random")
+    parser.add_argument("--prompt", type=str, default="Please describe this image in detail.")
+    parser.add_argument("--image", type=str, default=None)
+    parser.add_argument("--decoder", type=str, default="greedy")
+    parser.add_argument("--num-requests", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds between two request arrivals.")
+    args = parser.parse_args()
+
+    ret = requests.post(args.controller_address + "/get_worker_address", json={"model": args.model_name})
+    worker_addr = ret.json()["address"]
+    assert worker_addr, f"no worker serves {args.model_name}"
+
+    params = {
+        "model": args.model_name,
+        "prompt": args.prompt,
+        "decoder": args.decoder,
+        "max_new_tokens": args.max_new_tokens,
+        "temperature": args.temperature,
+    }
+    if args.image is not None:
+        with open(args.image, "rb") as f:
+            params["images"] = [base64.b64encode(f.read()).decode()]
+
+    results = [{} for _ in range(args.num_requests)]
+    threads = []
+    start = time.perf_counter()
+    for i in range(args.num_requests):
+        thread = threading.Thread(target=stream_request, args=(worker_addr, dict(params, seed=i), results[i]))
+        thread.start()
+        threads.append(thread)
+        time.sleep(args.interval)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    for i, result in enumerate(results):
+        print(f"[{i}] error_code={result['error_code']} {result['text']!r}")
+    report = {
+        "num_requests": args.num_requests,
+        "elapsed": elapsed,
+        "requests_per_second": args.num_requests / elapsed,
+        "ttft_mean": float(np.mean([r["ttft"] for r in results if r["ttft"] is not None])),
+        "latency_mean": float(np.mean([r["latency"] for r in results])),
+        "errors": sum(r["error_code"] != 0 for r in results),
+        "worker": requests.post(worker_addr + "/worker_get_metrics").json(),
+    }
+    print(json.dumps(report, indent=4))
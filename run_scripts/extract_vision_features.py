@@ -0,0 +1,132 @@
+"""
+Offline extraction of frozen MiniGPT-4 vision features for stage-2 fine-tuning.
+
+Runs EVA-ViT-g + Q-Former once per image and augmentation view and writes the Q-Former outputs
+to a sharded memory-mapped store (minigpt4/datasets/feature_store.py). Training then uses the
+`cc_sbu_align_feature` / `laion_feature` datasets (see train_configs/minigpt4_stage2_finetune_feature.yaml), e.g.
+
+    python run_scripts/extract_vision_features.py --cfg-path train_configs/minigpt4_stage2_finetune.yaml \
+        --source cc_sbu_align --storage /path/to/cc_sbu_align/ --output /path/to/cc_sbu_align_features/ --num-views 8
+"""
+import argparse
+import json
+import os
+import sys
+sys.path.append("./")
+
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+import webdataset as wds
+
+from minigpt4.common.config import Config
+from minigpt4.common.registry import registry
+from minigpt4.datasets.feature_store import extract_features
+
+# imports modules for registration
+from minigpt4.datasets.builders import *
+from minigpt4.models import *
+from minigpt4.processors import *
+
+
+class AlignImageDataset(Dataset):
+    # the cc_sbu_align images with their raw captions, keyed by image id.
+    def __init__(self, storage, vis_processor):
+        with open(os.path.join(storage, "filter_cap.json"), "r") as f:
+            self.annotation = json.load(f)["annotations"]
+        self.vis_root = os.path.join(storage, "image")
+        self.vis_processor = vis_processor
+
+    def __len__(self):
+        return len(self.annotation)
+
+    def __getitem__(self, index):
+        ann = self.annotation[index]
+        image = Image.open(os.path.join(self.vis_root, "{}.jpg".format(ann["image_id"]))).convert("RGB")
+        return {"key": str(ann["image_id"]), "image": self.vis_processor(image), "answer": ann["caption"]}
+
+
+def webdataset_images(location, vis_processor, text_processor):
+    # a single, unshuffled pass over the shards, unlike the resampled training pipeline.
+    return wds.DataPipeline(
+        wds.SimpleShardList(location),
+        wds.split_by_worker,
+        wds.tarfile_to_samples(handler=wds.warn_and_continue),
+        wds.decode("pilrgb", handler=wds.warn_and_continue),
+        wds.to_tuple("__key__", "jpg", "json", handler=wds.warn_and_continue),
+        wds.map(
+            lambda sample: {
+                "key": sample[0],
+                "image": vis_processor(sample[1]),
+                "answer": text_processor(sample[2]["caption"]),
+            },
+            handler=wds.warn_and_continue,
+        ),
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Extract frozen vision features for MiniGPT-4 fine-tuning.")
+    parser.add_argument("--cfg-path", required=True, help="path to the training configuration file.")
+    parser.add_argument("--source", type=str, default="cc_sbu_align", choices=["cc_sbu_align", "laion", "cc_sbu"])
+    parser.add_argument("--storage", type=str, required=True, help="dataset root (cc_sbu_align) or tar shard pattern.")
+    parser.add_argument("--output", type=str, required=True, help="directory of the feature store.")
+    parser.add_argument("--num-views", type=int, default=1, help="number of augmentation views to store.")
+    parser.add_argument("--eval-transform", action="store_true", help="use the deterministic eval transform (single view).")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--gpu-id", type=int, default=0)
+    parser.add_argument(
+        "--options",
+        nargs="+",
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file (deprecate), "
+        "change to --cfg-options instead.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cfg = Config(args)
+    device = torch.device(f"cuda:{args.gpu_id}") if torch.cuda.is_available() else "cpu"
+
+    model_config = cfg.model_cfg
+    model_cls = registry.get_model_class(model_config.arch)
+    model = model_cls.from_config(model_config).to(device)
+
+    dataset_cfg = next(iter(cfg.datasets_cfg.values()))
+    if args.eval_transform:
+        vis_processor = registry.get_processor_class("blip2_image_eval").from_config(
+            {"image_size": dataset_cfg.vis_processor.train.image_size}
+        )
+        num_views = 1
+    else:
+        vis_processor = registry.get_processor_class(dataset_cfg.vis_processor.train.name).from_config(
+            dataset_cfg.vis_processor.train
+        )
+        num_views = args.num_views
+    text_processor = registry.get_processor_class(dataset_cfg.text_processor.train.name).from_config(
+        dataset_cfg.text_processor.train
+    )
+
+    if args.source == "cc_sbu_align":
+        dataset = AlignImageDataset(args.storage, vis_processor)
+    else:
+        dataset = webdataset_images(args.storage, vis_processor, text_processor)
+
+    store = extract_features(
+        model,
+        dataset,
+        args.output,
+        num_views=num_views,
+        seed=args.seed,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+    )
+    print("Wrote {} x {} views of {} features to {}".format(len(store), store.num_views, store.feature_shape, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import os
+import torch
+from torch.utils.data import Dataset, DataLoader
+from PIL import Image
+
+from decoder_zoo.VCD.vcd_utils.vcd_add_noise import add_diffusion_noise
+
+
+class ImagePreprocess:
+    """
+    Everything the generation loops used to do inline per image: decode, the backbone's eval transform
+    (or mPLUG-Owl2's `process_images`), the VCD noised copy and the raw image HALC grounds on.
+    Runs inside the dataloader workers, so it has to stay picklable.
+    """
+
+    def __init__(self, model_name, trans=None, image_processor=None, noise_step=None, keep_raw=False):
+        self.model_name = model_name
+        self.trans = trans
+        self.image_processor = image_processor
+        self.noise_step = noise_step
+        self.keep_raw = keep_raw
+
+    def __call__(self, image_path):
+        raw_image = Image.open(image_path).convert("RGB")
+
+        if self.model_name == "mplug-owl2":
+            from mplug_owl2.mm_utils import process_images
+
+            max_edge = max(raw_image.size) # We recommand you to resize to squared image for BEST performance.
+            image = process_images([raw_image.resize((max_edge, max_edge))], self.image_processor)[0]
+        else:
+            image = self.trans(raw_image)
+
+        item = {"image": image, "image_path": image_path}
+        if self.noise_step is not None:
+            item["image_cd"] = add_diffusion_noise(image, self.noise_step)
+        if self.keep_raw:
+            item["raw_image"] = raw_image
+        return item
+
+
+class CaptionDataSet(Dataset):
+    def __init__(self, data_path, img_files, preprocess):
+        self.data_path = data_path
+        self.img_files = img_files
+        self.preprocess = preprocess
+
+    def __len__(self):
+        return len(self.img_files)
+
+    def __getitem__(self, index):
+        img_file = self.img_files[index]
+        item = self.preprocess(self.data_path + img_file)
+        item["img_file"] = img_file
+        return item
+
+
+class MMEDataSet(Dataset):
+    """
+    One item per image, carrying both of its MME questions: the question file is read once here
+    instead of once per question, and the image is decoded once for both.
+    """
+
+    def __init__(self, data_path, preprocess):
+        self.data_path = data_path
+        self.preprocess = preprocess
+
+        self.img_files = [file for file in os.listdir(data_path) if file.endswith(".jpg")]
+        self.questions = []
+        for img_file in self.img_files:
+            with open(data_path + img_file.replace(".jpg", ".txt"), "r") as f:
+                lines = f.readlines()[:2]
+            questions = []
+            for qu in lines:
+                gt = "Yes" if "Yes" in qu else "No"
+                questions.append((qu.replace("Yes", "").replace("No", ""), gt))
+            self.questions.append(questions)
+
+    def __len__(self):
+        return len(self.img_files)
+
+    def __getitem__(self, index):
+        img_file = self.img_files[index]
+        item = self.preprocess(self.data_path + img_file)
+        item["img_file"] = img_file
+        item["questions"] = self.questions[index]
+        return item
+
+
+def first_item(batch):
+    # the generation loops decode one image at a time.
+    return batch[0]
+
+
+def prefetch_loader(dataset, num_workers=2, prefetch_factor=2):
+    """
+    Workers decode and preprocess ahead of the decoder, at most `num_workers * prefetch_factor`
+    items in flight; tensors are pinned so the host-to-device copy can be non-blocking.
+    """
+    kwargs = {}
+    if num_workers > 0:
+        kwargs["prefetch_factor"] = prefetch_factor
+    return DataLoader(
+        dataset,
+        batch_size=1,
+        shuffle=False,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+        collate_fn=first_item,
+        **kwargs,
+    )
@@ -28,22 +28,14 @@ from PIL import Image
 import json
 
 from types import SimpleNamespace
-from decoder_zoo.Woodpecker.vis_corrector import Corrector
-# from decoder_zoo.Woodpecker.config import woodpecker_args_dict
 from decoder_zoo.HALC.context_density.halc import halc_assistant
-from decoder_zoo.VCD.vcd_utils.vcd_add_noise import add_diffusion_noise
+from transformers.generation.decode_budget import DecodeBudget
+from generation_loader import ImagePreprocess, MMEDataSet, prefetch_loader
 
-from pycocotools.coco import COCO
-from pycocoevalcap.eval import COCOEvalCap
 from collections import defaultdict
 
 import torch
 from PIL import Image
-from transformers import TextStreamer
-from mplug_owl2.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN
-from mplug_owl2.conversation import conv_templates, SeparatorStyle
-from mplug_owl2.model.builder import load_pretrained_model
-from mplug_owl2.mm_utils import process_images, tokenizer_image_token, get_model_name_from_path, KeywordsStoppingCriteria
 
 
 MODEL_EVAL_CONFIG_PATH = {
@@ -108,6 +100,7 @@ parser.add_argument(
 )
 parser.add_argument("--batch_size", type=int, default=1, help="batch size")
 parser.add_argument("--num_workers", type=int, default=2, help="num workers")
+parser.add_argument("--prefetch_factor", type=int, default=2, help="images queued ahead per loader worker")
 parser.add_argument("-b", "--beam", type=int, default=3)
 parser.add_argument("--sample", action="store_true")
 parser.add_argument("--scale_factor", type=float, default=50)
@@ -160,6 +153,29 @@ parser.add_argument(
     help="Whether to use debugger output.",
 )
 parser.add_argument("--box_threshold", type=float, default=0.4, help="Box threshold for DINO.")
+parser.add_argument(
+    "--pre_ground",
+    action="store_true",
+    help="ground the HALC vocabulary (COCO categories and synonyms) in batched prompts once per image, then look words up.",
+)
+parser.add_argument(
+    "--skip_rate",
+    type=float,
+    default=0.5,
+    help="probability of HALC skipping the verification of a noun, drawn per image from --skip_seed.",
+)
+parser.add_argument(
+    "--skip_seed",
+    type=int,
+    default=0,
+    help="seed of HALC's verification skip draws.",
+)
+parser.add_argument(
+    "--budget_verifications",
+    type=int,
+    default=None,
+    help="per-caption limit on the distinct entities HALC grounds; past it, decoding goes on as plain DoLa / greedy.",
+)
 parser.add_argument(
     "--gt_seg_path",
     type=str,
@@ -298,6 +314,10 @@ elif decoding_strategy == "vcd":
 
 
 if post_correction == "woodpecker":
+    # the corrector (and its detector / VQA / QA2C models) is only imported when requested.
+    from decoder_zoo.Woodpecker.vis_corrector import Corrector
+    from decoder_zoo.Woodpecker.config import woodpecker_args_dict
+
     model_args = SimpleNamespace(**woodpecker_args_dict)
     corrector = Corrector(model_args)
 
@@ -323,12 +343,17 @@ norm = transforms.Normalize(mean, std)
 
 
 
-img_files = []
-
-# read in all the images in a folder
-for file in os.listdir(data_path):
-    if file.endswith(".jpg"):
-        img_files.append(file)
+# images are decoded, preprocessed (and noised for VCD) by the loader workers while the model decodes.
+preprocess = ImagePreprocess(
+    model_name,
+    trans=vis_processors["eval"],
+    image_processor=model.image_processor if model_name == "mplug-owl2" else None,
+    noise_step=args.noise_step if vcd_decoding else None,
+    keep_raw=halc_decoding,
+)
+# read in all the images in a folder, with their two questions
+mme_dataset = MMEDataSet(data_path, preprocess)
+img_files = mme_dataset.img_files
 
 print("img_files", len(img_files))
 
@@ -349,6 +374,9 @@ halc_params = {
     "score_type": "BLIP",
     "debugger": debugger,
     "box_threshold": box_threshold,
+    "pre_ground": args.pre_ground,
+    "skip_rate": args.skip_rate,
+    "skip_seed": args.skip_seed,
 }
 
 halc_assistant_helper = halc_assistant(
@@ -358,6 +386,9 @@ halc_assistant_helper = halc_assistant(
     halc_params=halc_params,
     max_new_tokens=max_new_tokens,
 )
+decode_budget = None
+if args.budget_verifications is not None:
+    decode_budget = DecodeBudget(max_verifications=args.budget_verifications)
 
 offlight = True
 
@@ -365,45 +396,22 @@ iterations = 2*len(img_files)
 
 result_txt = []
 
-for idx in tqdm(range(iterations)):
+
+def iterate_questions(loader):
+    # each prefetched image is asked both of its questions.
+    for data in loader:
+        for qu, gt in data["questions"]:
+            yield data, qu, gt
+
+
+mme_loader = prefetch_loader(mme_dataset, num_workers=num_workers, prefetch_factor=args.prefetch_factor)
+
+for idx, (data, qu, gt) in tqdm(enumerate(iterate_questions(mme_loader)), total=iterations):
     new_line = ""
-    img_file = img_files[int(idx/2)]
-    # if idx <= 23:
-    #     continue
-    # img_file = img_files[img_id]
+    img_file = data["img_file"]
     new_line += img_file + "\t"
     print("img_file", img_file)
-    txt_file = img_file.replace(".jpg", ".txt")
-    # get the first line of the txt file
-    if idx % 2 == 0:
-        with open(args.data_path + txt_file, "r") as f:
-            qu = f.readlines()[0]
-            # token_num = len(qu.split(" "))
-            # print("qu.split(" ")", qu.split(" "))
-            # input()
-            # qu = " ".join(qu.split(" ")[:-1])
-            if "Yes" in qu:
-                gt = "Yes"
-            else:
-                gt = "No"
-            qu = qu.replace("Yes", "")
-            qu = qu.replace("No", "")
-
-        print("idx % 2 == 0", qu)
-    else:
-        # get the second line of the txt file
-        with open(args.data_path + txt_file, "r") as f:
-            qu = f.readlines()[1]
-            # token_num = len(qu.split(" "))
-            # qu = " ".join(qu.split(" ")[:-1])
-            if "Yes" in qu:
-                gt = "Yes"
-            else:
-                gt = "No"
-            qu = qu.replace("Yes", "")
-            qu = qu.replace("No", "")
-            # gt = qu.split(" ")[-1]
-        print("idx % 2 == 1", qu)
+    print(f"idx % 2 == {idx % 2}", qu)
 
     # qu = str(qu)
 
@@ -414,17 +422,12 @@ for idx in tqdm(range(iterations)):
     img_save = {}
     img_save["image_id"] = img_id
 
-    image_path = args.data_path + img_file
-    raw_image = Image.open(image_path).convert('RGB')
+    image_path = data["image_path"]
 
     if model_name == "mplug-owl2":
-        max_edge = max(raw_image.size) # We recommand you to resize to squared image for BEST performance.
-        image = raw_image.resize((max_edge, max_edge))
-        image_tensor = process_images([image], model.image_processor)
-        image = image_tensor.to(device, dtype=torch.float16)
+        image = data["image"].unsqueeze(0).to(device, dtype=torch.float16, non_blocking=True)
     else:
-        image = vis_processors["eval"](raw_image).unsqueeze(0)
-        image = image.to(device)
+        image = data["image"].unsqueeze(0).to(device, non_blocking=True)
 
     # print("image device", norm(image).device)
 
@@ -462,13 +465,14 @@ for idx in tqdm(range(iterations)):
     candidate_premature_layers = lm_early_exit_layers[:-1]
     premature_layer_dist = {l: 0 for l in candidate_premature_layers}
 
-    halc_assistant_helper.update_input(img_path=image_path, input_prompt=qu)
+    halc_assistant_helper.update_input(
+        img_path=image_path, input_prompt=qu, raw_image=data.get("raw_image")
+    )
 
     image_cd = None
 
     if vcd_decoding:
-        image_tensor_cd = add_diffusion_noise(image, args.noise_step)
-        image_cd = image_tensor_cd.unsqueeze(0).half().to(device) if image_tensor_cd is not None else None
+        image_cd = data["image_cd"][None, None].half().to(device, non_blocking=True)
         cd_alpha = cd_alpha
         cd_beta = cd_beta
         print("image_cd", image_cd.shape)
@@ -483,7 +487,7 @@ for idx in tqdm(range(iterations)):
                 use_nucleus_sampling=args.sample,
                 num_beams=num_beams,
                 max_new_tokens=max_new_tokens,
-                output_attentions=True,
+                output_attentions=opera_decoding,
                 premature_layer=premature_layer,
                 candidate_premature_layers=candidate_premature_layers,
                 mature_layer=mature_layer,
@@ -494,6 +498,7 @@ for idx in tqdm(range(iterations)):
                 halc_decoding=halc_decoding,
                 # HALC
                 halc_assistant=halc_assistant_helper,
+                decode_budget=decode_budget,
                 # OPERA
                 key_position=None,
                 scale_factor=args.scale_factor,
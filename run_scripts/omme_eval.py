@@ -439,7 +439,7 @@ for idx, img_id in tqdm(enumerate(range(len(img_files))), total=len(img_files)):
                 use_nucleus_sampling=args.sample,
                 num_beams=num_beams,
                 max_new_tokens=max_new_tokens,
-                output_attentions=True,
+                output_attentions=opera_decoding,
                 premature_layer=premature_layer,
                 candidate_premature_layers=candidate_premature_layers,
                 mature_layer=mature_layer,
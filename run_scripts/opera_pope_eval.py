@@ -223,7 +223,7 @@ def main():
                     use_nucleus_sampling=args.sample, 
                     num_beams=args.beam,
                     max_new_tokens=10,
-                    output_attentions=True,
+                    output_attentions=False,
                     opera_decoding=False,
                     scale_factor=args.scale_factor,
                     threshold=args.threshold,
@@ -31,14 +31,12 @@ from minigpt4.runners import *
 from minigpt4.tasks import *
 
 from types import SimpleNamespace
-from decoder_zoo.Woodpecker.vis_corrector import Corrector
-from decoder_zoo.Woodpecker.config import woodpecker_args_dict
 from decoder_zoo.HALC.context_density.halc import halc_assistant
+from transformers.generation.decode_budget import DecodeBudget
 from decoder_zoo.VCD.vcd_utils.vcd_add_noise import add_diffusion_noise
 
-from pycocotools.coco import COCO
-from pycocoevalcap.eval import COCOEvalCap
 from collections import defaultdict
+from eval.coco_index import load_coco_index
 
 from eval.pope_metrics.utils import generate_ground_truth_objects, pope
 
@@ -170,12 +168,41 @@ def parse_args():
         help="0 print no debugging output; 1 only print hallucination correction; 2 print all the debugging output.",
     )
     parser.add_argument("--box_threshold", type=float, default=0.45, help="Box threshold for DINO.")
+    parser.add_argument(
+        "--pre_ground",
+        action="store_true",
+        help="ground the HALC vocabulary (COCO categories and synonyms) in batched prompts once per image, then look words up.",
+    )
+    parser.add_argument(
+        "--skip_rate",
+        type=float,
+        default=0.5,
+        help="probability of HALC skipping the verification of a noun, drawn per image from --skip_seed.",
+    )
+    parser.add_argument(
+        "--skip_seed",
+        type=int,
+        default=0,
+        help="seed of HALC's verification skip draws.",
+    )
+    parser.add_argument(
+        "--budget_verifications",
+        type=int,
+        default=None,
+        help="per-caption limit on the distinct entities HALC grounds; past it, decoding goes on as plain DoLa / greedy.",
+    )
     parser.add_argument(
         "--gt_seg_path",
         type=str,
         default="pope_coco/coco_ground_truth_segmentation.json",
         help="Input json file that contains ground truth objects in the image.",
     )
+    parser.add_argument(
+        "--coco_path",
+        type=str,
+        default=None,
+        help="COCO annotation folder; if set, the ground truth objects come from the cached COCO index instead of --gt_seg_path.",
+    )
     parser.add_argument(
         "-n",
         "--num_images",
@@ -396,7 +423,10 @@ def main():
     # load ground truth segmentation results.
     # Must include (other keys such as image_id can exist):
     # {"image": "COCO_val2014_000000131089.jpg", "objects": ["person", "baseball bat"]}
-    segment_results = [json.loads(q) for q in open(gt_seg_path, "r")]
+    if args.coco_path is not None:
+        segment_results = load_coco_index(args.coco_path, splits=("val",)).segment_results()
+    else:
+        segment_results = [json.loads(q) for q in open(gt_seg_path, "r")]
     if verbosity:
         print(
             f"\nGround truth segmentation results loaded successfully, contains {len(segment_results)} classes."
@@ -503,6 +533,9 @@ def main():
         "score_type": "BLIP",
         "debugger": debugger,
         "box_threshold": box_threshold,
+        "pre_ground": args.pre_ground,
+        "skip_rate": args.skip_rate,
+        "skip_seed": args.skip_seed,
     }
 
     halc_assistant_helper = halc_assistant(
@@ -512,6 +545,9 @@ def main():
         halc_params=halc_params,
         max_new_tokens=max_new_tokens,
     )
+    decode_budget = None
+    if args.budget_verifications is not None:
+        decode_budget = DecodeBudget(max_verifications=args.budget_verifications)
 
     lm_early_exit_layers = [
         0,
@@ -576,7 +612,7 @@ def main():
                     use_nucleus_sampling=args.sample,
                     num_beams=args.beam,
                     max_new_tokens=max_new_tokens,
-                    output_attentions=True,
+                    output_attentions=opera_decoding,
                     premature_layer=premature_layer,
                     candidate_premature_layers=candidate_premature_layers,
                     mature_layer=mature_layer,
@@ -587,6 +623,7 @@ def main():
                     halc_decoding=halc_decoding,
                     # HALC
                     halc_assistant=halc_assistant_helper,
+                    decode_budget=decode_budget,
                     # OPERA
                     key_position=None,
                     scale_factor=args.scale_factor,
@@ -365,7 +365,7 @@ for image_path in img_path_list:
                 use_nucleus_sampling=args.sample, 
                 num_beams=num_beams,
                 max_new_tokens=128,
-                output_attentions=True,
+                output_attentions=opera_decoding,
                 premature_layer=premature_layer,
                 candidate_premature_layers=candidate_premature_layers,
                 mature_layer=mature_layer,
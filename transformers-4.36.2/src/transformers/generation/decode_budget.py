@@ -0,0 +1,91 @@
+# coding=utf-8
+"""
+Per-request latency budget of the decoders whose cost depends on the content: HALC's grounding and
+verification passes (`halc_dola_decode`, `halc_dola_beam_search`, `halc_greedy_decode`) and OPERA's
+rollbacks (`opera_beam_search`).
+
+    budget = DecodeBudget(max_verifications=8, max_rollbacks=4, deadline=2.0)
+    model.generate(..., decode_budget=budget)
+    budget.usage()  # {"verifications": 8, "rollbacks": 1, "elapsed": 1.73, "exhausted": "verifications", ...}
+
+The decoders check `exhausted()` before starting a verification pass or a rollback and `charge()` the
+ones they run; for HALC both are done by the halc_assistant. A HALC verification is one distinct entity
+grounded in the caption (a grounding cache miss), whatever the detection finds: beams and later steps
+checking the same entity are not charged again, so `max_verifications` does not depend on the number of
+beams. Once a limit is hit, the budget stays exhausted for the rest of the request and the decoder carries
+on as its base decoder: HALC keeps the DoLa / greedy tokens without grounding them or re-ranking its beams,
+OPERA continues as plain beam search. The deadline is checked between steps, so a pass already started is
+finished. HALC also adds `usage()` to its returned info dict as "decode_budget".
+"""
+import time
+from typing import Optional
+
+
+class DecodeBudget:
+    """
+    Limits of one request. `None` disables a limit; `deadline` is in seconds from the first `start()`.
+    The same object can be reused: `start()` (called by the decoders) resets the usage.
+    """
+
+    def __init__(
+        self,
+        max_verifications: Optional[int] = None,
+        max_rollbacks: Optional[int] = None,
+        deadline: Optional[float] = None,
+    ):
+        self.max_verifications = max_verifications
+        self.max_rollbacks = max_rollbacks
+        self.deadline = deadline
+        self.start()
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self.verifications = 0
+        self.rollbacks = 0
+        self.steps = 0
+        # first limit hit and the decode step it was hit at, None while the budget lasts
+        self.exhausted_by = None
+        self.exhausted_at_step = None
+
+    def finish(self):
+        # called by the decoders on return, so `elapsed` is the decode time of the request
+        self.end_time = time.perf_counter()
+
+    def step(self):
+        self.steps += 1
+
+    def charge(self, kind):
+        # kind: "verifications" or "rollbacks"
+        setattr(self, kind, getattr(self, kind) + 1)
+
+    def exhausted(self):
+        if self.exhausted_by is not None:
+            return True
+        if self.max_verifications is not None and self.verifications >= self.max_verifications:
+            self.exhausted_by = "verifications"
+        elif self.max_rollbacks is not None and self.rollbacks >= self.max_rollbacks:
+            self.exhausted_by = "rollbacks"
+        elif self.deadline is not None and self.elapsed() >= self.deadline:
+            self.exhausted_by = "deadline"
+        else:
+            return False
+        self.exhausted_at_step = self.steps
+        return True
+
+    def elapsed(self):
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        return end_time - self.start_time
+
+    def usage(self):
+        return {
+            "verifications": self.verifications,
+            "max_verifications": self.max_verifications,
+            "rollbacks": self.rollbacks,
+            "max_rollbacks": self.max_rollbacks,
+            "elapsed": self.elapsed(),
+            "deadline": self.deadline,
+            "steps": self.steps,
+            "exhausted": self.exhausted_by,
+            "exhausted_at_step": self.exhausted_at_step,
+        }
@@ -0,0 +1,537 @@
+# coding=utf-8
+"""
+A single decode loop for the single-sequence decoding strategies of this fork: greedy, DoLa-greedy and VCD.
+
+`DecodeEngine` owns the step loop: prepare inputs, forward, pick the next token, append it, update the
+cache and the stopping state. The strategies plug into it as `DecodeHook`s, called at fixed points of
+every step:
+
+    branch(engine, state)                  extra forward passes (e.g. VCD's distorted image)
+    combine(engine, state, logits)         turn the step's logits into the logits to decode from
+    update(engine, state)                  after the token is appended
+
+so an optimisation of the loop (static cache, batching, fewer host syncs) applies to every strategy
+at once. The loop itself does no host sync apart from the end-of-sequence check.
+
+`greedy_decode`, `dola_greedy_decode` and `vcd_sampling` reproduce `GenerationMixin.greedy_search`,
+`dola_greedy_decode` and `evolve_vcd_sampling` (same tokens, same output types); generate() routes
+to them with `decode_engine=True` (run_scripts/caption_generation.py --decode_engine).
+run_scripts/check_decode_engine.py checks the parity. HALC, OPERA and the beam decoders are not
+ported: their per-beam state and rollbacks stay in their GenerationMixin loops.
+
+A `decode_step` (e.g. minigpt4's `StaticDecodeStep`) replaces the model forward of the loop: it is
+called with the step's model inputs and returns `(dict_outputs, outputs)` like `DecodeEngine.forward`,
+so a compiled / CUDA-graph single-token step needs no change to the loop or the hooks.
+"""
+import math
+from typing import Dict, List, Optional
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from .decode_profiler import decode_profiler
+from .logits_process import LogitsProcessorList
+from .stopping_criteria import StoppingCriteriaList
+
+
+class DecodeState:
+    """What a hook sees of the current step."""
+
+    def __init__(self, input_ids, model_kwargs):
+        self.input_ids = input_ids
+        self.model_kwargs = model_kwargs
+        self.unfinished_sequences = torch.ones(input_ids.shape[0], dtype=torch.long, device=input_ids.device)
+        self.step = 0
+        # set by the engine every step
+        self.outputs = None
+        self.dict_outputs = None
+        # logits of extra branches, by name, see DecodeHook.branch
+        self.branch_logits = {}
+
+
+class DecodeHook:
+    # layers the main forward has to project to logits (DoLa), None for the plain forward
+    early_exit_layers = None
+
+    def branch(self, engine, state):
+        pass
+
+    def combine(self, engine, state, logits):
+        return logits
+
+    def update(self, engine, state):
+        pass
+
+
+class DecodeEngine:
+    def __init__(
+        self,
+        model,
+        hooks: Optional[List[DecodeHook]] = None,
+        logits_processor: Optional[LogitsProcessorList] = None,
+        logits_warper: Optional[LogitsProcessorList] = None,
+        stopping_criteria: Optional[StoppingCriteriaList] = None,
+        do_sample: bool = False,
+        pad_token_id: Optional[int] = None,
+        eos_token_id=None,
+        output_attentions: bool = False,
+        output_hidden_states: bool = False,
+        output_scores: bool = False,
+        streamer=None,
+        decode_step=None,
+    ):
+        self.model = model
+        self.hooks = hooks if hooks is not None else []
+        self.logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
+        self.logits_warper = logits_warper if logits_warper is not None else LogitsProcessorList()
+        self.stopping_criteria = stopping_criteria if stopping_criteria is not None else StoppingCriteriaList()
+        self.do_sample = do_sample
+        self.pad_token_id = pad_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_id = eos_token_id
+        if eos_token_id is not None and pad_token_id is None:
+            raise ValueError("If `eos_token_id` is defined, make sure that `pad_token_id` is defined.")
+        self.output_attentions = output_attentions
+        self.output_hidden_states = output_hidden_states
+        self.output_scores = output_scores
+        self.streamer = streamer
+
+        early_exit_layers = [hook.early_exit_layers for hook in self.hooks if hook.early_exit_layers is not None]
+        if len(early_exit_layers) > 1:
+            raise ValueError("Only one hook can request early exit layers.")
+        self.early_exit_layers = early_exit_layers[0] if early_exit_layers else None
+
+        if decode_step is not None:
+            if decode_step.early_exit_layers != self.early_exit_layers:
+                raise ValueError(
+                    f"The decode step exits at {decode_step.early_exit_layers}, the hooks need {self.early_exit_layers}."
+                )
+            if output_attentions or output_hidden_states:
+                raise ValueError("A decode step returns neither attentions nor hidden states.")
+        self.decode_step = decode_step
+
+    def forward(self, model_inputs, output_attentions=None, output_hidden_states=None, early_exit_layers=None):
+        # (dict_outputs, outputs); dict_outputs is None without early exit layers.
+        kwargs = dict(
+            return_dict=True,
+            output_attentions=self.output_attentions if output_attentions is None else output_attentions,
+            output_hidden_states=self.output_hidden_states if output_hidden_states is None else output_hidden_states,
+        )
+        if early_exit_layers is not None:
+            return self.model(**model_inputs, early_exit_layers=early_exit_layers, **kwargs)
+        return None, self.model(**model_inputs, **kwargs)
+
+    def run(self, input_ids, **model_kwargs):
+        """Returns (input_ids, scores, attentions, hidden_states); the tuples are None unless requested."""
+        state = DecodeState(input_ids, model_kwargs)
+        eos_token_id_tensor = (
+            torch.tensor(self.eos_token_id, device=input_ids.device) if self.eos_token_id is not None else None
+        )
+        scores = () if self.output_scores else None
+        attentions = () if self.output_attentions else None
+        hidden_states = () if self.output_hidden_states else None
+
+        while True:
+            decode_profiler.count("decode_steps")
+            model_inputs = self.model.prepare_inputs_for_generation(state.input_ids, **state.model_kwargs)
+            if self.decode_step is not None:
+                # the captured step bypasses the model's forward hooks, see decode_profiler
+                with decode_profiler.timer("decode_step"):
+                    state.dict_outputs, state.outputs = self.decode_step(model_inputs)
+            else:
+                state.dict_outputs, state.outputs = self.forward(model_inputs, early_exit_layers=self.early_exit_layers)
+            state.branch_logits = {}
+            for hook in self.hooks:
+                hook.branch(self, state)
+
+            next_token_logits = state.outputs.logits[:, -1, :]
+            for hook in self.hooks:
+                next_token_logits = hook.combine(self, state, next_token_logits)
+
+            next_token_scores = self.logits_processor(state.input_ids, next_token_logits)
+            if self.do_sample:
+                next_token_scores = self.logits_warper(state.input_ids, next_token_scores)
+                probs = nn.functional.softmax(next_token_scores, dim=-1)
+                next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+            else:
+                next_tokens = torch.argmax(next_token_scores, dim=-1)
+
+            if scores is not None:
+                scores += (next_token_scores,)
+            if attentions is not None:
+                attentions += (state.outputs.attentions,)
+            if hidden_states is not None:
+                hidden_states += (state.outputs.hidden_states,)
+
+            # finished sentences should have their next token be a padding token
+            if self.eos_token_id is not None:
+                next_tokens = next_tokens * state.unfinished_sequences + self.pad_token_id * (
+                    1 - state.unfinished_sequences
+                )
+
+            state.input_ids = torch.cat([state.input_ids, next_tokens[:, None]], dim=-1)
+            if self.streamer is not None:
+                self.streamer.put(next_tokens.cpu())
+            state.model_kwargs = self.model._update_model_kwargs_for_generation(
+                state.outputs, state.model_kwargs, is_encoder_decoder=self.model.config.is_encoder_decoder
+            )
+            for hook in self.hooks:
+                hook.update(self, state)
+            state.step += 1
+
+            if eos_token_id_tensor is not None:
+                state.unfinished_sequences = state.unfinished_sequences.mul(
+                    next_tokens.tile(eos_token_id_tensor.shape[0], 1).ne(eos_token_id_tensor.unsqueeze(1)).prod(dim=0)
+                )
+            # retire the rows that hit a stop sequence, so they are padded like finished sentences
+            finished_rows = self.stopping_criteria.finished_rows(state.input_ids)
+            if finished_rows is not None:
+                state.unfinished_sequences = state.unfinished_sequences.mul((~finished_rows).long())
+            # the stopping criteria are host-side; the eos check is the step's only sync.
+            if self.stopping_criteria(state.input_ids, scores) or state.unfinished_sequences.max() == 0:
+                break
+
+        if self.streamer is not None:
+            self.streamer.end()
+        return state.input_ids, scores, attentions, hidden_states
+
+
+def relative_top_filter(scores, relative_top=0.1, filter_value=-float("Inf"), min_tokens_to_keep=1):
+    # GenerationMixin.relative_top_filter without the full-vocabulary sort and the boolean indexing.
+    scores_normalized = scores.log_softmax(dim=-1)
+    min_thresh = scores_normalized.topk(min_tokens_to_keep, dim=-1).values[..., -1]
+    probs_max = torch.max(scores_normalized, dim=-1).values
+    probs_thresh = torch.min(min_thresh, probs_max + math.log(relative_top)).unsqueeze(-1)
+    return scores_normalized.masked_fill(scores_normalized < probs_thresh, filter_value)
+
+
+def jsd_premature_layer(mature_logits, premature_logits):
+    """
+    Index (0-dim tensor) of the candidate layer of largest Jensen-Shannon divergence with the mature
+    layer, averaged over the batch. mature_logits: (batch, vocab); premature_logits: (num_layers, batch,
+    vocab).
+    """
+    softmax_mature_layer = F.softmax(mature_logits, dim=-1)
+    softmax_premature_layers = F.softmax(premature_logits, dim=-1)
+    M = 0.5 * (softmax_mature_layer[None, :, :] + softmax_premature_layers)
+    log_softmax_mature_layer = F.log_softmax(mature_logits, dim=-1)
+    log_softmax_premature_layers = F.log_softmax(premature_logits, dim=-1)
+    kl1 = F.kl_div(log_softmax_mature_layer[None, :, :], M, reduction="none").mean(-1)
+    kl2 = F.kl_div(log_softmax_premature_layers, M, reduction="none").mean(-1)
+    js_divs = 0.5 * (kl1 + kl2)  # (num_premature_layers, batch_size)
+    return js_divs.mean(-1).argmax()
+
+
+def approximate_premature_layer(lm_head, mature_logits, premature_hidden_states, top_k=256, tail_samples=256):
+    """
+    `jsd_premature_layer` on a reduced support: the mature layer's `top_k` tokens plus one tail bucket
+    for the rest of the vocabulary. The premature hidden states (num_layers, batch, hidden) are only
+    projected onto the `top_k` rows of `lm_head` and `tail_samples` evenly spaced other rows, whose
+    logsumexp, rescaled to the size of the tail, estimates the premature tail mass. The mature layer's
+    masses are exact.
+    """
+    vocab_size = mature_logits.shape[-1]
+    top_k = min(top_k, vocab_size - 1)
+    weight, bias = lm_head.weight, lm_head.bias
+    device = mature_logits.device
+
+    mature_log_probs = mature_logits.float().log_softmax(dim=-1)
+    mature_top, top_indices = mature_log_probs.topk(top_k, dim=-1)  # (batch, top_k)
+    mature_tail = (1 - mature_top.exp().sum(dim=-1, keepdim=True)).clamp_min(1e-12).log()
+    mature_support = torch.cat([mature_top, mature_tail], dim=-1)
+
+    premature_top = torch.einsum("lbh,bkh->lbk", premature_hidden_states, weight[top_indices])
+    stride = max(vocab_size // tail_samples, 1)
+    sample_indices = torch.arange(0, vocab_size, stride, device=device)
+    premature_sample = premature_hidden_states @ weight[sample_indices].T  # (layers, batch, samples)
+    if bias is not None:
+        premature_top = premature_top + bias[top_indices]
+        premature_sample = premature_sample + bias[sample_indices]
+    # samples that fall in the top-k belong to the support, not the tail
+    in_top = (sample_indices[None, :, None] == top_indices[:, None, :]).any(dim=-1)  # (batch, samples)
+    num_tail_samples = (~in_top).sum(dim=-1).clamp_min(1)
+    premature_tail = premature_sample.float().masked_fill(in_top, -float("inf")).logsumexp(dim=-1)
+    premature_tail = premature_tail + math.log(vocab_size - top_k) - num_tail_samples.float().log()
+    premature_support = torch.cat([premature_top.float(), premature_tail[..., None]], dim=-1).log_softmax(dim=-1)
+
+    M = 0.5 * (mature_support.exp()[None] + premature_support.exp())
+    kl1 = F.kl_div(mature_support[None].expand_as(premature_support), M, reduction="none").sum(-1)
+    kl2 = F.kl_div(premature_support, M, reduction="none").sum(-1)
+    js_divs = 0.5 * (kl1 + kl2)  # (num_premature_layers, batch_size)
+    return js_divs.mean(-1).argmax()
+
+
+def select_premature_layer(model, dict_outputs, outputs, mature_layer, candidate_premature_layers, jsd_top_k=None):
+    """
+    Index (0-dim tensor) into `candidate_premature_layers` and the chosen layer's last-position logits
+    (batch, vocab). With `jsd_top_k`, the forward only projected the mature layer (`early_exit_layers=
+    [mature_layer]`), the candidates come from `outputs.hidden_states` and only the chosen one is
+    projected onto the full vocabulary.
+    """
+    mature_logits = dict_outputs[mature_layer][:, -1, :]
+    if jsd_top_k is None:
+        stacked_premature_layers = torch.stack(
+            [dict_outputs[i][:, -1, :] for i in candidate_premature_layers], dim=0
+        )  # (num_premature_layers, batch_size, vocab)
+        index = jsd_premature_layer(mature_logits, stacked_premature_layers)
+        return index, stacked_premature_layers[index]
+    if outputs.hidden_states is None:
+        raise ValueError("The approximate premature layer selection needs the hidden states of the forward.")
+    lm_head = model.get_output_embeddings()
+    stacked_hidden_states = torch.stack(
+        [outputs.hidden_states[i][:, -1, :] for i in candidate_premature_layers], dim=0
+    )  # (num_premature_layers, batch_size, hidden)
+    index = approximate_premature_layer(lm_head, mature_logits, stacked_hidden_states, top_k=jsd_top_k)
+    return index, lm_head(stacked_hidden_states[index])
+
+
+class DolaHook(DecodeHook):
+    """
+    DoLa: contrast the mature layer with a fixed base layer, or with the candidate premature layer of
+    largest Jensen-Shannon divergence, picked on the device (on the mature layer's top `jsd_top_k`
+    tokens only when set, see `approximate_premature_layer`).
+    """
+
+    def __init__(
+        self, mature_layer, base_layer=None, candidate_premature_layers=None, relative_top=0.1, jsd_top_k=None
+    ):
+        if base_layer is None and candidate_premature_layers is None:
+            raise ValueError("You must specify either `base_layer` or `candidate_premature_layers`")
+        self.mature_layer = mature_layer
+        self.base_layer = base_layer if candidate_premature_layers is None else None
+        self.candidate_premature_layers = candidate_premature_layers
+        self.relative_top = relative_top
+        self.jsd_top_k = jsd_top_k if candidate_premature_layers is not None else None
+        if self.base_layer is not None:
+            self.early_exit_layers = [base_layer, mature_layer]
+        elif self.jsd_top_k is not None:
+            self.early_exit_layers = [mature_layer]
+        else:
+            self.early_exit_layers = candidate_premature_layers + [mature_layer]
+        self.premature_layer_counts = None
+
+    def select_premature_layer(self, engine, state):
+        index, base_logits = select_premature_layer(
+            engine.model,
+            state.dict_outputs,
+            state.outputs,
+            self.mature_layer,
+            self.candidate_premature_layers,
+            jsd_top_k=self.jsd_top_k,
+        )
+        if self.premature_layer_counts is None:
+            self.premature_layer_counts = torch.zeros(
+                len(self.candidate_premature_layers), dtype=torch.long, device=index.device
+            )
+        self.premature_layer_counts += F.one_hot(index, len(self.candidate_premature_layers))
+        return base_logits
+
+    def combine(self, engine, state, logits):
+        dict_outputs = state.dict_outputs
+        final_logits = dict_outputs[self.mature_layer][:, -1, :]
+        if self.base_layer is not None:
+            base_logits = dict_outputs[self.base_layer][:, -1, :]
+        else:
+            base_logits = self.select_premature_layer(engine, state)
+        if self.relative_top > 0.0:
+            final_logits = relative_top_filter(final_logits, self.relative_top)
+            base_logits = base_logits.log_softmax(dim=-1)
+            base_logits = base_logits.masked_fill(final_logits < -1e3, -1e3)
+        return final_logits - base_logits
+
+    @property
+    def premature_layer_dist(self) -> Dict[int, int]:
+        if self.candidate_premature_layers is None:
+            return {}
+        if self.premature_layer_counts is None:
+            return {l: 0 for l in self.candidate_premature_layers}
+        return dict(zip(self.candidate_premature_layers, self.premature_layer_counts.tolist()))
+
+
+class VisualContrastHook(DecodeHook):
+    """
+    VCD: a second forward on the distorted image, contrasted with the main one under the adaptive
+    plausibility constraint. As in evolve_vcd_sampling, cd_alpha / cd_beta are read from the model
+    kwargs (0.5 / 0.1 when absent) and the branch starts every step from the main branch's kwargs.
+    """
+
+    def __init__(self, images_cd=None, LVLM_backbone=None, cd_alpha=None, cd_beta=None):
+        self.images_cd = images_cd
+        self.LVLM_backbone = LVLM_backbone
+        self.cd_alpha = cd_alpha if cd_alpha is not None else 0.5
+        self.cd_beta = cd_beta if cd_beta is not None else 0.1
+        self.log_cd_beta = torch.log(torch.tensor(self.cd_beta))
+
+    def branch(self, engine, state):
+        if self.images_cd is None:
+            return
+        model = engine.model
+        model_kwargs_cd = state.model_kwargs.copy()
+        backbone = self.LVLM_backbone
+        if backbone is not None and backbone.model_name == "minigpt4":
+            with decode_profiler.timer("vcd_encode"):
+                img_embeds, atts_img = backbone.encode_img(self.images_cd)
+            inputs_embeds, attention_mask, img_start_pos = backbone.prompt_wrap(
+                img_embeds, atts_img, backbone.instructions
+            )
+            bos = torch.ones(
+                [img_embeds.shape[0], 1], dtype=torch.int64, device=inputs_embeds.device
+            ) * backbone.llama_tokenizer.bos_token_id
+            model_kwargs_cd["inputs_embeds"] = torch.cat([backbone.embed_tokens(bos), inputs_embeds], dim=1)
+            model_inputs_cd = model.prepare_inputs_for_generation_cd(state.input_ids, **model_kwargs_cd)
+        else:
+            model_inputs_cd = model.prepare_inputs_for_generation_cd(
+                state.input_ids, images_cd=self.images_cd, **model_kwargs_cd
+            )
+        with decode_profiler.timer("vcd_contrast"):
+            _, outputs_cd = engine.forward(model_inputs_cd)
+        state.branch_logits["cd"] = outputs_cd.logits[:, -1, :]
+
+    def combine(self, engine, state, logits):
+        if self.images_cd is None:
+            return logits
+        cutoff = self.log_cd_beta + logits.max(dim=-1, keepdim=True).values
+        diffs = (1 + self.cd_alpha) * logits - self.cd_alpha * state.branch_logits["cd"]
+        return diffs.masked_fill(logits < cutoff, -float("inf"))
+
+
+def _engine_kwargs(model, kwargs):
+    config = model.generation_config
+    output = {}
+    for name in ["output_attentions", "output_hidden_states", "output_scores"]:
+        value = kwargs.pop(name, None)
+        output[name] = value if value is not None else getattr(config, name)
+    return output
+
+
+def greedy_decode(
+    model,
+    input_ids,
+    logits_processor=None,
+    stopping_criteria=None,
+    pad_token_id=None,
+    eos_token_id=None,
+    return_dict_in_generate=None,
+    streamer=None,
+    decode_step=None,
+    **model_kwargs,
+):
+    from .utils import GreedySearchDecoderOnlyOutput
+
+    return_dict_in_generate = (
+        return_dict_in_generate if return_dict_in_generate is not None else model.generation_config.return_dict_in_generate
+    )
+    engine = DecodeEngine(
+        model,
+        logits_processor=logits_processor,
+        stopping_criteria=stopping_criteria,
+        pad_token_id=pad_token_id if pad_token_id is not None else model.generation_config.pad_token_id,
+        eos_token_id=eos_token_id if eos_token_id is not None else model.generation_config.eos_token_id,
+        streamer=streamer,
+        decode_step=decode_step,
+        **_engine_kwargs(model, model_kwargs),
+    )
+    sequences, scores, attentions, hidden_states = engine.run(input_ids, **model_kwargs)
+    if return_dict_in_generate:
+        return GreedySearchDecoderOnlyOutput(
+            sequences=sequences, scores=scores, attentions=attentions, hidden_states=hidden_states
+        )
+    return sequences
+
+
+def dola_greedy_decode(
+    model,
+    input_ids,
+    mature_layer,
+    base_layer=None,
+    candidate_premature_layers=None,
+    relative_top=0.1,
+    jsd_top_k=None,
+    logits_processor=None,
+    stopping_criteria=None,
+    pad_token_id=None,
+    eos_token_id=None,
+    return_dict_in_generate=None,
+    streamer=None,
+    decode_step=None,
+    **model_kwargs,
+):
+    from .utils import GreedySearchDecoderOnlyOutput
+
+    return_dict_in_generate = (
+        return_dict_in_generate if return_dict_in_generate is not None else model.generation_config.return_dict_in_generate
+    )
+    dola = DolaHook(mature_layer, base_layer, candidate_premature_layers, relative_top, jsd_top_k=jsd_top_k)
+    engine = DecodeEngine(
+        model,
+        hooks=[dola],
+        logits_processor=logits_processor,
+        stopping_criteria=stopping_criteria,
+        pad_token_id=pad_token_id if pad_token_id is not None else model.generation_config.pad_token_id,
+        eos_token_id=eos_token_id if eos_token_id is not None else model.generation_config.eos_token_id,
+        streamer=streamer,
+        decode_step=decode_step,
+        **_engine_kwargs(model, model_kwargs),
+    )
+    sequences, scores, attentions, hidden_states = engine.run(input_ids, **model_kwargs)
+    if return_dict_in_generate:
+        # same (1-tuple) shape as GenerationMixin.dola_greedy_decode
+        return (
+            GreedySearchDecoderOnlyOutput(
+                sequences=sequences,
+                scores=scores,
+                attentions=attentions,
+                hidden_states=hidden_states,
+                premature_layer_dist=dola.premature_layer_dist,
+            ),
+        )
+    return sequences
+
+
+def vcd_sampling(
+    model,
+    input_ids,
+    logits_processor=None,
+    logits_warper=None,
+    stopping_criteria=None,
+    pad_token_id=None,
+    eos_token_id=None,
+    return_dict_in_generate=None,
+    streamer=None,
+    images_cd=None,
+    LVLM_backbone=None,
+    decode_step=None,
+    **model_kwargs,
+):
+    from .utils import SampleDecoderOnlyOutput
+
+    return_dict_in_generate = (
+        return_dict_in_generate if return_dict_in_generate is not None else model.generation_config.return_dict_in_generate
+    )
+    vcd = VisualContrastHook(
+        images_cd, LVLM_backbone, cd_alpha=model_kwargs.get("cd_alpha"), cd_beta=model_kwargs.get("cd_beta")
+    )
+    if decode_step is not None and decode_step.contrast_alpha is not None:
+        # the step contrasts both branches itself
+        vcd = VisualContrastHook()
+    engine = DecodeEngine(
+        model,
+        hooks=[vcd],
+        logits_processor=logits_processor,
+        logits_warper=logits_warper,
+        stopping_criteria=stopping_criteria,
+        do_sample=True,
+        pad_token_id=pad_token_id if pad_token_id is not None else model.generation_config.pad_token_id,
+        eos_token_id=eos_token_id if eos_token_id is not None else model.generation_config.eos_token_id,
+        streamer=streamer,
+        decode_step=decode_step,
+        **_engine_kwargs(model, model_kwargs),
+    )
+    sequences, scores, attentions, hidden_states = engine.run(input_ids, **model_kwargs)
+    if return_dict_in_generate:
+        return SampleDecoderOnlyOutput(
+            sequences=sequences, scores=scores, attentions=attentions, hidden_states=hidden_states
+        )
+    return sequences
@@ -0,0 +1,187 @@
+# coding=utf-8
+"""
+Per-stage timers and counters of the decoders (greedy / DoLa / VCD / OPERA / HALC) and of HALC's
+grounding (detector, crop encodes, scorer), shared through the module-level `decode_profiler`.
+
+    from transformers.generation.decode_profiler import decode_profiler
+
+    decode_profiler.enable(cuda_sync=True)
+    for image in images:
+        model.generate(...)
+        record = decode_profiler.end_sample(image_id=...)  # {"image_id": ..., "timers": {...}, "counters": {...}}
+    decode_profiler.summary()                              # aggregate of the run
+    decode_profiler.dump("profile.json")                   # samples + summary
+
+A timer records total seconds and calls of a stage, `with decode_profiler.timer("detector"): ...`; a
+counter counts events, `decode_profiler.count("rollbacks")`. Once generate() has run with the profiler
+enabled, every forward of the language model is timed as "model_forward", and also as
+"model_forward/<stage>" inside an open timer (e.g. "model_forward/halc_context" for HALC's context
+forwards, "model_forward/vcd_contrast" for VCD's distorted-image branch).
+
+Disabled (the default), `timer()` returns a shared no-op context manager and `count()` returns at once,
+so the instrumented loops pay one attribute check per call site. With `cuda_sync`, timers synchronise the
+device at both ends, so GPU stages are timed by their execution rather than their launch.
+"""
+import json
+import threading
+import time
+import weakref
+from collections import defaultdict
+
+import torch
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._stages().append(self.name)
+        self.profiler._sync()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._sync()
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        self.profiler._stages().pop()
+        return False
+
+
+class DecodeProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.cuda_sync = False
+        self.samples = []
+        # HALC's async grounding times its stages from the worker thread
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.hooked_models = weakref.WeakSet()
+        self.reset()
+
+    def enable(self, cuda_sync=False):
+        self.enabled = True
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        # timers and counters of the current sample
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def timer(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += n
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.times[name] += seconds
+            self.calls[name] += 1
+
+    def attach(self, model):
+        """Time every forward of `model` (once per model), see the module docstring."""
+        if model in self.hooked_models:
+            return
+        self.hooked_models.add(model)
+        model.register_forward_pre_hook(self._forward_start)
+        model.register_forward_hook(self._forward_end)
+
+    def _forward_start(self, module, args):
+        if self.enabled:
+            self._sync()
+            self._forward_starts().append(time.perf_counter())
+
+    def _forward_end(self, module, args, output):
+        starts = self._forward_starts()
+        if self.enabled and starts:
+            self._sync()
+            elapsed = time.perf_counter() - starts.pop()
+            self.add("model_forward", elapsed)
+            stages = self._stages()
+            if stages:
+                self.add("model_forward/" + stages[-1], elapsed)
+
+    def _stages(self):
+        if not hasattr(self.local, "stages"):
+            self.local.stages = []
+        return self.local.stages
+
+    def _forward_starts(self):
+        if not hasattr(self.local, "forward_starts"):
+            self.local.forward_starts = []
+        return self.local.forward_starts
+
+    def _sync(self):
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+
+    def sample(self):
+        with self.lock:
+            return {
+                "timers": {name: {"total": self.times[name], "calls": self.calls[name]} for name in self.times},
+                "counters": dict(self.counters),
+            }
+
+    def end_sample(self, **meta):
+        """Close the current sample: record it (with `meta`, e.g. the image id) and start the next one."""
+        record = {**meta, **self.sample()}
+        self.samples.append(record)
+        self.reset()
+        return record
+
+    def summary(self):
+        def stats(values):
+            values = sorted(values)
+            return {
+                "total": sum(values),
+                "mean": sum(values) / len(values),
+                "p50": values[len(values) // 2],
+                "p95": values[min(len(values) - 1, len(values) * 95 // 100)],
+                "max": values[-1],
+            }
+
+        # samples without a stage count it as 0
+        timer_names = sorted({name for s in self.samples for name in s["timers"]})
+        counter_names = sorted({name for s in self.samples for name in s["counters"]})
+        return {
+            "samples": len(self.samples),
+            "timers": {
+                name: {
+                    **stats([s["timers"].get(name, {"total": 0.0})["total"] for s in self.samples]),
+                    "calls": sum(s["timers"].get(name, {"calls": 0})["calls"] for s in self.samples),
+                }
+                for name in timer_names
+            },
+            "counters": {
+                name: stats([s["counters"].get(name, 0) for s in self.samples]) for name in counter_names
+            },
+        }
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "samples": self.samples}, f, indent=4)
+
+
+decode_profiler = DecodeProfiler()
@@ -131,6 +131,18 @@ class StoppingCriteriaList(list):
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
         return any(criteria(input_ids, scores) for criteria in self)
 
+    def finished_rows(self, input_ids: torch.LongTensor) -> Optional[torch.BoolTensor]:
+        """
+        Per-row finished mask of the criteria that provide one (a `finished(input_ids)` method, e.g. the
+        keyword / stop-sequence criteria), or None if none of them does. Stays on device.
+        """
+        finished = None
+        for criteria in self:
+            if hasattr(criteria, "finished"):
+                rows = criteria.finished(input_ids)
+                finished = rows if finished is None else finished | rows
+        return finished
+
     @property
     def max_length(self) -> Optional[int]:
         for stopping_criterium in self:
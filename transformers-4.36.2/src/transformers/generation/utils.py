@@ -43,6 +43,9 @@ from ..utils import ExplicitEnum, ModelOutput, is_accelerate_available, logging
 from .beam_constraints import DisjunctiveConstraint, PhrasalConstraint
 from .beam_search import BeamScorer, BeamSearchScorer, ConstrainedBeamSearchScorer
 from .configuration_utils import GenerationConfig
+from . import decode_engine as engine_decoders
+from .decode_budget import DecodeBudget
+from .decode_profiler import decode_profiler
 from .logits_process import (
     EncoderNoRepeatNGramLogitsProcessor,
     EncoderRepetitionPenaltyLogitsProcessor,
@@ -1420,6 +1423,8 @@ class GenerationMixin:
         base_layer: Optional[int] = None,
         candidate_premature_layers: Optional[List[int]] = None,
         relative_top: Optional[float] = 0.1,
+        # rank DoLa's candidate premature layers on the mature layer's top-k tokens only
+        jsd_top_k: Optional[int] = None,
         contrastive_decoding: Optional[bool] = None,
         student_model=None,
         halc_assistant=None,
@@ -1434,6 +1439,12 @@ class GenerationMixin:
         cd_alpha=1,
         cd_beta=0.1,
         LVLM_backbone=None,
+        # run greedy / DoLa-greedy / VCD on the shared loop of generation/decode_engine.py
+        decode_engine: Optional[bool] = None,
+        # fixed-shape (compiled / CUDA graph) forward of that loop, e.g. minigpt4's StaticDecodeStep
+        decode_step=None,
+        # per-request limits on HALC's verification passes / OPERA's rollbacks / wall-clock time
+        decode_budget: Optional[DecodeBudget] = None,
         **kwargs,
     ) -> Union[GenerateOutput, torch.LongTensor]:
         r"""
@@ -1689,6 +1700,14 @@ class GenerationMixin:
         stopping_criteria = self._get_stopping_criteria(
             generation_config=generation_config, stopping_criteria=stopping_criteria
         )
+        # criteria with per-row state (the finished mask of a stop-sequence criterion) start every call afresh:
+        # the caller's list is usually reused across generations.
+        for criteria in stopping_criteria:
+            if hasattr(criteria, "reset"):
+                criteria.reset()
+
+        if decode_profiler.enabled:
+            decode_profiler.attach(self)
 
         if False:
         # if halc_decoding and dola_decoding and generation_mode == GenerationMode.GREEDY_SEARCH:
@@ -1712,6 +1731,7 @@ class GenerationMixin:
                 candidate_premature_layers=candidate_premature_layers,
                 relative_top=relative_top,
                 streamer=streamer,
+                decode_budget=decode_budget,
                 **model_kwargs,
             )
         
@@ -1737,9 +1757,11 @@ class GenerationMixin:
                 base_layer=base_layer,
                 candidate_premature_layers=candidate_premature_layers,
                 relative_top=relative_top,
+                jsd_top_k=jsd_top_k,
                 streamer=streamer,
                 beam_size=generation_config.num_beams,
                 max_new_tokens=generation_config.max_new_tokens,
+                decode_budget=decode_budget,
                 **model_kwargs,
             )
         
@@ -1765,6 +1787,7 @@ class GenerationMixin:
                 candidate_premature_layers=candidate_premature_layers,
                 relative_top=relative_top,
                 streamer=streamer,
+                decode_budget=decode_budget,
                 **model_kwargs,
             )
 
@@ -1782,6 +1805,23 @@ class GenerationMixin:
             )
 
             # 13. run sample
+            if (decode_engine or decode_step is not None) and not synced_gpus:
+                return engine_decoders.vcd_sampling(
+                    self,
+                    input_ids,
+                    logits_processor=logits_processor,
+                    logits_warper=logits_warper,
+                    stopping_criteria=stopping_criteria,
+                    pad_token_id=generation_config.pad_token_id,
+                    eos_token_id=generation_config.eos_token_id,
+                    output_scores=generation_config.output_scores,
+                    return_dict_in_generate=generation_config.return_dict_in_generate,
+                    streamer=streamer,
+                    images_cd=images_cd,
+                    LVLM_backbone=LVLM_backbone,
+                    decode_step=decode_step,
+                    **model_kwargs,
+                )
             return self.evolve_vcd_sampling(
                 input_ids,
                 logits_processor=logits_processor,
@@ -1877,6 +1917,7 @@ class GenerationMixin:
                 threshold=threshold,
                 num_attn_candidates=num_attn_candidates, 
                 penalty_weights=penalty_weights,
+                decode_budget=decode_budget,
                 **model_kwargs,
             )
 
@@ -1890,6 +1931,25 @@ class GenerationMixin:
                 )
             # 11. run greedy search
             # print("\033[41m!!!!! DoLA-Greedy Decoding !!!!!!\033[0m")
+            if (decode_engine or decode_step is not None) and not synced_gpus:
+                return engine_decoders.dola_greedy_decode(
+                    self,
+                    input_ids,
+                    mature_layer=mature_layer,
+                    base_layer=base_layer,
+                    candidate_premature_layers=candidate_premature_layers,
+                    relative_top=relative_top,
+                    jsd_top_k=jsd_top_k,
+                    logits_processor=logits_processor,
+                    stopping_criteria=stopping_criteria,
+                    pad_token_id=generation_config.pad_token_id,
+                    eos_token_id=generation_config.eos_token_id,
+                    output_scores=generation_config.output_scores,
+                    return_dict_in_generate=generation_config.return_dict_in_generate,
+                    streamer=streamer,
+                    decode_step=decode_step,
+                    **model_kwargs,
+                )
             return self.dola_greedy_decode(
                 input_ids,
                 logits_processor=logits_processor,
@@ -1903,6 +1963,7 @@ class GenerationMixin:
                 base_layer=base_layer,
                 candidate_premature_layers=candidate_premature_layers,
                 relative_top=relative_top,
+                jsd_top_k=jsd_top_k,
                 streamer=streamer,
                 **model_kwargs,
             )
@@ -2052,6 +2113,20 @@ class GenerationMixin:
             )
         if generation_mode == GenerationMode.GREEDY_SEARCH:
             # 11. run greedy search
+            if (decode_engine or decode_step is not None) and not synced_gpus:
+                return engine_decoders.greedy_decode(
+                    self,
+                    input_ids,
+                    logits_processor=logits_processor,
+                    stopping_criteria=stopping_criteria,
+                    pad_token_id=generation_config.pad_token_id,
+                    eos_token_id=generation_config.eos_token_id,
+                    output_scores=generation_config.output_scores,
+                    return_dict_in_generate=generation_config.return_dict_in_generate,
+                    streamer=streamer,
+                    decode_step=decode_step,
+                    **model_kwargs,
+                )
             return self.greedy_search(
                 input_ids,
                 logits_processor=logits_processor,
@@ -2899,6 +2974,7 @@ class GenerationMixin:
 
         this_peer_finished = False  # used by synced_gpus only
         while True:
+            decode_profiler.count("decode_steps")
             if synced_gpus:
                 # Under synced_gpus the `forward` call must continue until all gpus complete their sequence.
                 # The following logic allows an early break if all peers finished generating their sequence
@@ -2973,6 +3049,11 @@ class GenerationMixin:
                 if unfinished_sequences.max() == 0:
                     this_peer_finished = True
 
+            # retire the rows that hit a stop sequence, so they are padded like finished sentences
+            finished_rows = stopping_criteria.finished_rows(input_ids)
+            if finished_rows is not None:
+                unfinished_sequences = unfinished_sequences.mul((~finished_rows).long())
+
             # stop if we exceed the maximum length
             if stopping_criteria(input_ids, scores):
                 this_peer_finished = True
@@ -3181,6 +3262,7 @@ class GenerationMixin:
         this_peer_finished = False  # used by synced_gpus only
         # auto-regressive generation
         while True:
+            decode_profiler.count("decode_steps")
             if synced_gpus:
                 # Under synced_gpus the `forward` call must continue until all gpus complete their sequence.
                 # The following logic allows an early break if all peers finished generating their sequence
@@ -3257,6 +3339,11 @@ class GenerationMixin:
                 if unfinished_sequences.max() == 0:
                     this_peer_finished = True
 
+            # retire the rows that hit a stop sequence, so they are padded like finished sentences
+            finished_rows = stopping_criteria.finished_rows(input_ids)
+            if finished_rows is not None:
+                unfinished_sequences = unfinished_sequences.mul((~finished_rows).long())
+
             # stop if we exceed the maximum length
             if stopping_criteria(input_ids, scores):
                 this_peer_finished = True
@@ -3344,6 +3431,7 @@ class GenerationMixin:
         base_layer: Optional[int] = None,
         candidate_premature_layers: Optional[List[int]] = None,
         relative_top: float = 0.1,
+        jsd_top_k: Optional[int] = None,
         logits_processor: Optional[LogitsProcessorList] = None,
         stopping_criteria: Optional[StoppingCriteriaList] = None,
         max_length: Optional[int] = None,
@@ -3502,7 +3590,8 @@ class GenerationMixin:
             num_base_layers = 1
             premature_layer_dist = {}
         elif candidate_premature_layers is not None:
-            early_exit_layers = candidate_premature_layers + [mature_layer]
+            # with `jsd_top_k` the candidates are projected from the hidden states, see select_premature_layer
+            early_exit_layers = [mature_layer] if jsd_top_k is not None else candidate_premature_layers + [mature_layer]
             num_base_layers = len(candidate_premature_layers)
             premature_layer_dist = {l: 0 for l in candidate_premature_layers}
         else:
@@ -3518,6 +3607,7 @@ class GenerationMixin:
         # all_layer_matrix = []
 
         while True:
+            decode_profiler.count("decode_steps")
             if synced_gpus:
                 # Under synced_gpus the `forward` call must continue until all gpus complete their sequence.
                 # The following logic allows an early break if all peers finished generating their sequence
@@ -3573,60 +3663,68 @@ class GenerationMixin:
                 logits = final_logits - base_logits
                 next_token_logits = logits
             else:
-                # 1. Stacking all premature_layers into a new dimension
-                stacked_premature_layers = torch.stack(
-                    [dict_outputs[i][:, -1, :] for i in candidate_premature_layers], dim=0
-                )
+                if jsd_top_k is not None:
+                    # premature layers ranked on the mature layer's top tokens; only the chosen one is projected
+                    premature_index, premature_logits = engine_decoders.select_premature_layer(
+                        self, dict_outputs, outputs, mature_layer, candidate_premature_layers, jsd_top_k=jsd_top_k
+                    )
+                    premature_layer = candidate_premature_layers[int(premature_index.cpu().item())]
+                    dict_outputs[premature_layer] = premature_logits[:, None, :]
+                else:
+                    # 1. Stacking all premature_layers into a new dimension
+                    stacked_premature_layers = torch.stack(
+                        [dict_outputs[i][:, -1, :] for i in candidate_premature_layers], dim=0
+                    )
 
-                # 2. Calculate the softmax values for mature_layer and all premature_layers
-                softmax_mature_layer = F.softmax(
-                    dict_outputs[mature_layer][:, -1, :], dim=-1
-                )  # shape: (batch_size, num_features)
-                softmax_premature_layers = F.softmax(
-                    stacked_premature_layers, dim=-1
-                )  # shape: (num_premature_layers, batch_size, num_features)
+                    # 2. Calculate the softmax values for mature_layer and all premature_layers
+                    softmax_mature_layer = F.softmax(
+                        dict_outputs[mature_layer][:, -1, :], dim=-1
+                    )  # shape: (batch_size, num_features)
+                    softmax_premature_layers = F.softmax(
+                        stacked_premature_layers, dim=-1
+                    )  # shape: (num_premature_layers, batch_size, num_features)
 
-                # 3. Calculate M, the average distribution
-                M = 0.5 * (
-                    softmax_mature_layer[None, :, :] + softmax_premature_layers
-                )  # shape: (num_premature_layers, batch_size, num_features)
+                    # 3. Calculate M, the average distribution
+                    M = 0.5 * (
+                        softmax_mature_layer[None, :, :] + softmax_premature_layers
+                    )  # shape: (num_premature_layers, batch_size, num_features)
 
-                # 4. Calculate log-softmax for the KL divergence
-                log_softmax_mature_layer = F.log_softmax(
-                    dict_outputs[mature_layer][:, -1, :], dim=-1
-                )  # shape: (batch_size, num_features)
-                log_softmax_premature_layers = F.log_softmax(
-                    stacked_premature_layers, dim=-1
-                )  # shape: (num_premature_layers, batch_size, num_features)
+                    # 4. Calculate log-softmax for the KL divergence
+                    log_softmax_mature_layer = F.log_softmax(
+                        dict_outputs[mature_layer][:, -1, :], dim=-1
+                    )  # shape: (batch_size, num_features)
+                    log_softmax_premature_layers = F.log_softmax(
+                        stacked_premature_layers, dim=-1
+                    )  # shape: (num_premature_layers, batch_size, num_features)
 
-                # 5. Calculate the KL divergences and then the JS divergences
-                kl1 = F.kl_div(log_softmax_mature_layer[None, :, :], M, reduction="none").mean(
-                    -1
-                )  # shape: (num_premature_layers, batch_size)
-                kl2 = F.kl_div(log_softmax_premature_layers, M, reduction="none").mean(
-                    -1
-                )  # shape: (num_premature_layers, batch_size)
-                js_divs = 0.5 * (kl1 + kl2)  # shape: (num_premature_layers, batch_size)
-                # print("here")
-                # print("kl1: ", kl1)
-                # print("kl2: ", kl2)
-                # print("js_divs ", js_divs)
+                    # 5. Calculate the KL divergences and then the JS divergences
+                    kl1 = F.kl_div(log_softmax_mature_layer[None, :, :], M, reduction="none").mean(
+                        -1
+                    )  # shape: (num_premature_layers, batch_size)
+                    kl2 = F.kl_div(log_softmax_premature_layers, M, reduction="none").mean(
+                        -1
+                    )  # shape: (num_premature_layers, batch_size)
+                    js_divs = 0.5 * (kl1 + kl2)  # shape: (num_premature_layers, batch_size)
+                    # print("here")
+                    # print("kl1: ", kl1)
+                    # print("kl2: ", kl2)
+                    # print("js_divs ", js_divs)
 
-                # input()
+                    # input()
 
-                # 6. Reduce the batchmean
-                js_divs = js_divs.mean(-1)  # shape: (num_premature_layers,)
+                    # 6. Reduce the batchmean
+                    js_divs = js_divs.mean(-1)  # shape: (num_premature_layers,)
 
-                # print("js_divs ", js_divs*10000)
-                # JSD_matrix.append(js_divs)
+                    # print("js_divs ", js_divs*10000)
+                    # JSD_matrix.append(js_divs)
 
-                premature_layer = candidate_premature_layers[int(js_divs.argmax().cpu().item())]
+                    premature_layer = candidate_premature_layers[int(js_divs.argmax().cpu().item())]
                 # premature_layer_list.append(premature_layer)
                 # print("premature_layer", premature_layer)
                 premature_layer_dist[premature_layer] += 1
                 # record_data = candidate_premature_layers + mature_layer
                 all_layer_logits = []
-                for layer in candidate_premature_layers + [mature_layer]:
+                for layer in candidate_premature_layers + [mature_layer] if jsd_top_k is None else []:
                     selected_logits = dict_outputs[layer][:, -1, :].log_softmax(dim=-1)
                     all_layer_logits.append(selected_logits.cpu().numpy().tolist())
 
@@ -3704,6 +3802,11 @@ class GenerationMixin:
                     next_tokens.tile(eos_token_id_tensor.shape[0], 1).ne(eos_token_id_tensor.unsqueeze(1)).prod(dim=0)
                 )
 
+            # retire the rows that hit a stop sequence, so they are padded like finished sentences
+            finished_rows = stopping_criteria.finished_rows(input_ids)
+            if finished_rows is not None:
+                unfinished_sequences = unfinished_sequences.mul((~finished_rows).long())
+
             # stop when each sentence is finished, or if we exceed the maximum length
             if unfinished_sequences.max() == 0 or stopping_criteria(input_ids, scores):
                 if not synced_gpus:
@@ -3768,6 +3871,7 @@ class GenerationMixin:
         return_dict_in_generate: Optional[bool] = None,
         synced_gpus: Optional[bool] = False,
         streamer: Optional["BaseStreamer"] = None,
+        decode_budget: Optional[DecodeBudget] = None,
         **model_kwargs,
     ) -> Union[GreedySearchOutput, torch.LongTensor]:
         r"""
@@ -3927,7 +4031,15 @@ class GenerationMixin:
         intermediate_token_lists = input_ids
         last_tokens = []
 
+        if decode_budget is not None:
+            decode_budget.start()
+        # the assistant checks and charges it when it verifies a word, see halc_assistant.budget_spent
+        self.halc_assistant.decode_budget = decode_budget
+
         while True:
+            decode_profiler.count("decode_steps")
+            if decode_budget is not None:
+                decode_budget.step()
             
             if synced_gpus:
                 # Under synced_gpus the `forward` call must continue until all gpus complete their sequence.
@@ -4067,6 +4179,10 @@ class GenerationMixin:
                 if len(last_tokens) == 0:
                     contrast_logits = next_token_logits
                     token_to_append = None
+                elif decode_budget is not None and decode_budget.exhausted():
+                    # budget spent: keep the word as decoded, as for "invalid"
+                    current_word = None
+                    token_to_append = torch.tensor([last_tokens]).to(input_ids.device)
                 else:
                     current_word = self.halc_assistant.get_last_word(last_tokens) 
                     
@@ -4166,11 +4282,13 @@ class GenerationMixin:
                 # print("input_ids", input_ids)
                 # input()
                 # last_word = self.halc_assistant.get_last_word([nominate_tokens])
-                last_word = self.halc_assistant.get_last_word(token_to_append[0])
+                # a word kept without verification (current_word None) needs no resample
+                last_word = None if current_word is None else self.halc_assistant.get_last_word(token_to_append[0])
 
                 # print("CONTRAST WORD: ", last_word)
 
                 if last_word != current_word:
+                    decode_profiler.count("halc_corrections")
                     # print("\033[41m!!!!! Hallucination Detected !!!!!!\033[0m")
 
                     # which means hallucination has been corrected, then resample a last token
@@ -4246,6 +4364,9 @@ class GenerationMixin:
                 )
 
             last_tokens.append(next_tokens[:, None].cpu().numpy().tolist()[0][0])
+            if self.halc_assistant.async_grounding:
+                # ground the word as it stands while the next token is decoded, see prefetch_grounding
+                self.halc_assistant.prefetch_grounding(self.halc_assistant.get_last_word(last_tokens))
 
             # update generated ids, model inputs, and length for next step
             input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
@@ -4271,6 +4392,10 @@ class GenerationMixin:
                 else:
                     this_peer_finished = True
 
+        if decode_budget is not None:
+            decode_budget.finish()
+            info_dict["decode_budget"] = decode_budget.usage()
+
         if streamer is not None:
             streamer.end()
 
@@ -4311,6 +4436,7 @@ class GenerationMixin:
         base_layer: Optional[int] = None,
         candidate_premature_layers: Optional[List[int]] = None,
         relative_top: float = 0.1,
+        jsd_top_k: Optional[int] = None,
         logits_processor: Optional[LogitsProcessorList] = None,
         stopping_criteria: Optional[StoppingCriteriaList] = None,
         max_length: Optional[int] = None,
@@ -4324,6 +4450,7 @@ class GenerationMixin:
         streamer: Optional["BaseStreamer"] = None,
         beam_size: Optional[Union[int, List[int]]] = None,
         max_new_tokens: Optional[int] = None,
+        decode_budget: Optional[DecodeBudget] = None,
         **model_kwargs,
     ) -> Union[GreedySearchOutput, torch.LongTensor]:
         r"""
@@ -4470,7 +4597,8 @@ class GenerationMixin:
             num_base_layers = 1
             premature_layer_dist = {}
         elif candidate_premature_layers is not None:
-            early_exit_layers = candidate_premature_layers + [mature_layer]
+            # with `jsd_top_k` the candidates are projected from the hidden states, see select_premature_layer
+            early_exit_layers = [mature_layer] if jsd_top_k is not None else candidate_premature_layers + [mature_layer]
             num_base_layers = len(candidate_premature_layers)
             premature_layer_dist = {l: 0 for l in candidate_premature_layers}
         else:
@@ -4554,7 +4682,15 @@ class GenerationMixin:
         # print("max_new_tokens", max_new_tokens)
         # print("valid_length_max", valid_length_max)
  
+        if decode_budget is not None:
+            decode_budget.start()
+        # the assistant checks and charges it when it verifies a word, see halc_assistant.budget_spent
+        self.halc_assistant.decode_budget = decode_budget
+
         while True:
+            decode_profiler.count("decode_steps")
+            if decode_budget is not None:
+                decode_budget.step()
 
             if synced_gpus:
                 # Under synced_gpus the `forward` call must continue until all gpus complete their sequence.
@@ -4618,45 +4754,58 @@ class GenerationMixin:
                     logits = final_logits - base_logits
                     next_token_logits = logits
                 else:
-                    # 1. Stacking all premature_layers into a new dimension
-                    stacked_premature_layers = torch.stack(
-                        [beam_dict_outputs[bs][i][:, -1, :] for i in candidate_premature_layers], dim=0
-                    )
-
-                    # 2. Calculate the softmax values for mature_layer and all premature_layers
-                    softmax_mature_layer = F.softmax(
-                        beam_dict_outputs[bs][mature_layer][:, -1, :], dim=-1
-                    )  # shape: (batch_size, num_features)
-                    softmax_premature_layers = F.softmax(
-                        stacked_premature_layers, dim=-1
-                    )  # shape: (num_premature_layers, batch_size, num_features)
-
-                    # 3. Calculate M, the average distribution
-                    M = 0.5 * (
-                        softmax_mature_layer[None, :, :] + softmax_premature_layers
-                    )  # shape: (num_premature_layers, batch_size, num_features)
-
-                    # 4. Calculate log-softmax for the KL divergence
-                    log_softmax_mature_layer = F.log_softmax(
-                        beam_dict_outputs[bs][mature_layer][:, -1, :], dim=-1
-                    )  # shape: (batch_size, num_features)
-                    log_softmax_premature_layers = F.log_softmax(
-                        stacked_premature_layers, dim=-1
-                    )  # shape: (num_premature_layers, batch_size, num_features)
-
-                    # 5. Calculate the KL divergences and then the JS divergences
-                    kl1 = F.kl_div(log_softmax_mature_layer[None, :, :], M, reduction="none").mean(
-                        -1
-                    )  # shape: (num_premature_layers, batch_size)
-                    kl2 = F.kl_div(log_softmax_premature_layers, M, reduction="none").mean(
-                        -1
-                    )  # shape: (num_premature_layers, batch_size)
-                    js_divs = 0.5 * (kl1 + kl2)  # shape: (num_premature_layers, batch_size)
-
-                    # 6. Reduce the batchmean
-                    js_divs = js_divs.mean(-1)  # shape: (num_premature_layers,)
+                    if jsd_top_k is not None:
+                        # premature layers ranked on the mature layer's top tokens; only the chosen one is projected
+                        premature_index, premature_logits = engine_decoders.select_premature_layer(
+                            self,
+                            beam_dict_outputs[bs],
+                            beam_outputs[bs],
+                            mature_layer,
+                            candidate_premature_layers,
+                            jsd_top_k=jsd_top_k,
+                        )
+                        premature_layer = candidate_premature_layers[int(premature_index.cpu().item())]
+                        beam_dict_outputs[bs][premature_layer] = premature_logits[:, None, :]
+                    else:
+                        # 1. Stacking all premature_layers into a new dimension
+                        stacked_premature_layers = torch.stack(
+                            [beam_dict_outputs[bs][i][:, -1, :] for i in candidate_premature_layers], dim=0
+                        )
 
-                    premature_layer = candidate_premature_layers[int(js_divs.argmax().cpu().item())]
+                        # 2. Calculate the softmax values for mature_layer and all premature_layers
+                        softmax_mature_layer = F.softmax(
+                            beam_dict_outputs[bs][mature_layer][:, -1, :], dim=-1
+                        )  # shape: (batch_size, num_features)
+                        softmax_premature_layers = F.softmax(
+                            stacked_premature_layers, dim=-1
+                        )  # shape: (num_premature_layers, batch_size, num_features)
+
+                        # 3. Calculate M, the average distribution
+                        M = 0.5 * (
+                            softmax_mature_layer[None, :, :] + softmax_premature_layers
+                        )  # shape: (num_premature_layers, batch_size, num_features)
+
+                        # 4. Calculate log-softmax for the KL divergence
+                        log_softmax_mature_layer = F.log_softmax(
+                            beam_dict_outputs[bs][mature_layer][:, -1, :], dim=-1
+                        )  # shape: (batch_size, num_features)
+                        log_softmax_premature_layers = F.log_softmax(
+                            stacked_premature_layers, dim=-1
+                        )  # shape: (num_premature_layers, batch_size, num_features)
+
+                        # 5. Calculate the KL divergences and then the JS divergences
+                        kl1 = F.kl_div(log_softmax_mature_layer[None, :, :], M, reduction="none").mean(
+                            -1
+                        )  # shape: (num_premature_layers, batch_size)
+                        kl2 = F.kl_div(log_softmax_premature_layers, M, reduction="none").mean(
+                            -1
+                        )  # shape: (num_premature_layers, batch_size)
+                        js_divs = 0.5 * (kl1 + kl2)  # shape: (num_premature_layers, batch_size)
+
+                        # 6. Reduce the batchmean
+                        js_divs = js_divs.mean(-1)  # shape: (num_premature_layers,)
+
+                        premature_layer = candidate_premature_layers[int(js_divs.argmax().cpu().item())]
                     premature_layer_dist[premature_layer] += 1
 
                     base_logits = beam_dict_outputs[bs][premature_layer][:, -1, :]
@@ -4701,6 +4850,16 @@ class GenerationMixin:
                             candidate_token_to_append.append(None)
                         beam_candidate_token_to_append[bs] = candidate_token_to_append
                         
+                    elif not self.halc_assistant.is_verify_candidate(beam_last_tokens[bs]):
+                        # not verified (token-level gate or spent budget): keep the word, as for "invalid".
+                        # beam_current_word is what the appended word is checked against, so it must be this word.
+                        beam_current_word[bs] = self.halc_assistant.get_last_word(beam_last_tokens[bs])
+                        beam_not_detected[bs] = False
+                        beam_candidate_token_to_append[bs] = [
+                            torch.tensor([beam_last_tokens[bs]]).to(beam_input_ids[bs].device)
+                            for _ in range(self.halc_assistant.k_candidate_num)
+                        ]
+
                     else:
                         
                         # print("beam_last_tokens[bs]", beam_last_tokens[bs])
@@ -4866,7 +5025,11 @@ class GenerationMixin:
                 ############ Beam Search Score ############
                 # candidate_index = self.halc_assistant.random_selection(candidate_intermediate_token_lists_array, beam_size)
 
-                candidate_index = self.halc_assistant.clip_score_selection(candidate_intermediate_token_lists_array, beam_size, skip_token_length=len(initial_input_ids[0]))
+                if decode_budget is not None and decode_budget.exhausted():
+                    # budget spent: no re-ranking, every beam keeps its first candidate (its own unverified word)
+                    candidate_index = [bs * self.halc_assistant.k_candidate_num for bs in range(beam_size)]
+                else:
+                    candidate_index = self.halc_assistant.clip_score_selection(candidate_intermediate_token_lists_array, beam_size, skip_token_length=len(initial_input_ids[0]))
                 ############ Beam Search Score ############
 
                 # print("random_index", random_index)
@@ -4962,6 +5125,7 @@ class GenerationMixin:
                         last_word = "EOS"
 
                     if last_word != beam_current_word[bs]:
+                        decode_profiler.count("halc_corrections")
                         if self.halc_assistant.debugger == 1:
                             print(f"\033[41mCorrected Hallucination from {beam_current_word[bs]} to {last_word}\033[0m")
                         # input("hold")
@@ -4977,6 +5141,10 @@ class GenerationMixin:
                             early_exit_layers=early_exit_layers,
                         )
 
+                        if jsd_top_k is not None and premature_layer not in intermediate_dict_outputs:
+                            intermediate_dict_outputs[premature_layer] = self.get_output_embeddings()(
+                                intermediate_outputs.hidden_states[premature_layer][:, -1:, :]
+                            )
                         intermediate_base_logits = intermediate_dict_outputs[premature_layer][:, -1, :]
                         intermediate_final_logits = intermediate_dict_outputs[mature_layer][:, -1, :]
 
@@ -5022,6 +5190,12 @@ class GenerationMixin:
                 # print("beam_input_ids[bs]", beam_input_ids[bs])
                 
                 beam_last_tokens[bs].append(beam_next_tokens[bs][:, None].cpu().numpy().tolist()[0][0])
+                if self.halc_assistant.async_grounding and beam_finished[bs] == False:
+                    # ground the beam's word as it stands while the next token is decoded, see
+                    # prefetch_grounding; beams decoding the same word share the cached result.
+                    self.halc_assistant.prefetch_grounding(
+                        self.halc_assistant.get_last_word(beam_last_tokens[bs]), beam=bs
+                    )
 
                 if beam_finished[bs] == False:
                     # update generated ids, model inputs, and length for next step
@@ -5130,6 +5304,10 @@ class GenerationMixin:
         gc.collect()
 
 
+        if decode_budget is not None:
+            decode_budget.finish()
+            info_dict["decode_budget"] = decode_budget.usage()
+
         if streamer is not None:
             streamer.end()
 
@@ -5182,6 +5360,7 @@ class GenerationMixin:
         return_dict_in_generate: Optional[bool] = None,
         synced_gpus: Optional[bool] = False,
         streamer: Optional["BaseStreamer"] = None,
+        decode_budget: Optional[DecodeBudget] = None,
         **model_kwargs,
     ) -> Union[GreedySearchOutput, torch.LongTensor]:
         r"""
@@ -5347,7 +5526,15 @@ class GenerationMixin:
         intermediate_token_lists = input_ids
         last_tokens = []
 
+        if decode_budget is not None:
+            decode_budget.start()
+        # the assistant checks and charges it when it verifies a word, see halc_assistant.budget_spent
+        self.halc_assistant.decode_budget = decode_budget
+
         while True:
+            decode_profiler.count("decode_steps")
+            if decode_budget is not None:
+                decode_budget.step()
             if synced_gpus:
                 # Under synced_gpus the `forward` call must continue until all gpus complete their sequence.
                 # The following logic allows an early break if all peers finished generating their sequence
@@ -5420,17 +5607,23 @@ class GenerationMixin:
                 if len(last_tokens) == 0:
                     contrast_logits = next_token_logits
                     token_to_append = None
+                elif not self.halc_assistant.is_verify_candidate(last_tokens):
+                    # not verified (token-level gate or spent budget): keep the word, as for "invalid"
+                    current_word = None
+                    token_to_append = torch.tensor([last_tokens]).to(input_ids.device)
                 else:
                     current_word = self.halc_assistant.get_last_word(last_tokens)
 
-                    print("CURRENT WORD: ", current_word)
+                    if self.halc_assistant.debugger == 2:
+                        print("CURRENT WORD: ", current_word)
                     entity = current_word
                     embeds_list, detect_info = self.halc_assistant.context_density_embedding(entity, context_window=3)
 
                     if detect_info["status"] == "invalid":
                         token_to_append = torch.tensor([last_tokens]).to(input_ids.device)
                     else:
-                        print("DINO acctivated")
+                        if self.halc_assistant.debugger == 2:
+                            print("DINO activated")
                         context_logits_list = []
                         
                         for context_embed in embeds_list:
@@ -5502,12 +5695,16 @@ class GenerationMixin:
 
                 intermediate_token_lists = torch.cat([intermediate_token_lists, token_to_append], dim=-1)
                 # last_word = self.halc_assistant.get_last_word([nominate_tokens])
-                last_word = self.halc_assistant.get_last_word(token_to_append[0])
+                # a gated word (current_word None) is kept as generated
+                last_word = None if current_word is None else self.halc_assistant.get_last_word(token_to_append[0])
 
-                print("CORRECTED WORD: ", last_word)
+                if self.halc_assistant.debugger == 2:
+                    print("CORRECTED WORD: ", last_word)
 
                 if last_word != current_word:
-                    print("\033[41m!!!!! Hallucination Detected !!!!!!\033[0m")
+                    decode_profiler.count("halc_corrections")
+                    if self.halc_assistant.debugger == 1:
+                        print("\033[41m!!!!! Hallucination Detected !!!!!!\033[0m")
 
                     # which means hallucination has been corrected, then resample a last token
 
@@ -5565,13 +5762,17 @@ class GenerationMixin:
                     outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
                 )
 
-            print("intermediate_token_lists", intermediate_token_lists)
+            if self.halc_assistant.debugger == 2:
+                print("intermediate_token_lists", intermediate_token_lists)
             # intermediate_token_lists = input_ids
 
             last_tokens.append(next_tokens[:, None].cpu().numpy().tolist()[0][0])
+            if self.halc_assistant.async_grounding:
+                self.halc_assistant.prefetch_grounding(
+                    self.halc_assistant.get_last_word(last_tokens), context_window=3
+                )
             # print("post last_tokens", last_tokens)
             # last_token = next_tokens[:, None]
-            print("\n")
 
             # update generated ids, model inputs, and length for next step
             input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
@@ -5591,6 +5792,11 @@ class GenerationMixin:
                     next_tokens.tile(eos_token_id_tensor.shape[0], 1).ne(eos_token_id_tensor.unsqueeze(1)).prod(dim=0)
                 )
 
+            # retire the rows that hit a stop sequence, so they are padded like finished sentences
+            finished_rows = stopping_criteria.finished_rows(input_ids)
+            if finished_rows is not None:
+                unfinished_sequences = unfinished_sequences.mul((~finished_rows).long())
+
             # stop when each sentence is finished, or if we exceed the maximum length
             if unfinished_sequences.max() == 0 or stopping_criteria(input_ids, scores):
                 if not synced_gpus:
@@ -5600,6 +5806,10 @@ class GenerationMixin:
 
         input_ids = intermediate_token_lists
 
+        if decode_budget is not None:
+            decode_budget.finish()
+            info_dict["decode_budget"] = decode_budget.usage()
+
         if streamer is not None:
             streamer.end()
 
@@ -5717,12 +5927,13 @@ class GenerationMixin:
             model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
 
             # forward pass to get next token
-            outputs = self(
-                **model_inputs,
-                return_dict=True,
-                output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-            )
+            with decode_profiler.timer("halc_context"):
+                outputs = self(
+                    **model_inputs,
+                    return_dict=True,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                )
 
             if synced_gpus and this_peer_finished:
                 continue  # don't waste resources running the code we don't need
@@ -5860,6 +6071,7 @@ class GenerationMixin:
 
         # auto-regressive generation
         while True:
+            decode_profiler.count("decode_steps")
             if synced_gpus:
                 # Under synced_gpus the `forward` call must continue until all gpus complete their sequence.
                 # The following logic allows an early break if all peers finished generating their sequence
@@ -5903,7 +6115,8 @@ class GenerationMixin:
                 # print("use_cd!!!")
                 ## cd_comments: forward pass of the model with distorted image input
                 if LVLM_backbone.model_name == 'minigpt4':
-                    img_embeds, atts_img = LVLM_backbone.encode_img(images_cd)
+                    with decode_profiler.timer("vcd_encode"):
+                        img_embeds, atts_img = LVLM_backbone.encode_img(images_cd)
 
                     inputs_embeds, attention_mask, img_start_pos = LVLM_backbone.prompt_wrap(img_embeds, atts_img, LVLM_backbone.instructions)
                     
@@ -5926,12 +6139,13 @@ class GenerationMixin:
 
                 # print("model_inputs_cd", model_inputs_cd)
                 # print("self", self)
-                outputs_cd = self(
-                    **model_inputs_cd,
-                    return_dict=True,
-                    output_attentions=output_attentions_wo_img,
-                    output_hidden_states=output_hidden_states_wo_img,
-                )
+                with decode_profiler.timer("vcd_contrast"):
+                    outputs_cd = self(
+                        **model_inputs_cd,
+                        return_dict=True,
+                        output_attentions=output_attentions_wo_img,
+                        output_hidden_states=output_hidden_states_wo_img,
+                    )
                 next_token_logits_cd = outputs_cd.logits[:, -1, :]
                 
                 ## cd_comments: pre-process logits from contrastive inputs
@@ -6011,6 +6225,11 @@ class GenerationMixin:
                 if unfinished_sequences.max() == 0:
                     this_peer_finished = True
 
+            # retire the rows that hit a stop sequence, so they are padded like finished sentences
+            finished_rows = stopping_criteria.finished_rows(input_ids)
+            if finished_rows is not None:
+                unfinished_sequences = unfinished_sequences.mul((~finished_rows).long())
+
             # stop if we exceed the maximum length
             if stopping_criteria(input_ids, scores):
                 this_peer_finished = True
@@ -6066,6 +6285,7 @@ class GenerationMixin:
         num_attn_candidates: Optional[int] = 5, 
         window_size: Optional[int] = 512, 
         penalty_weights: Optional[float] = 1.0,
+        decode_budget: Optional[DecodeBudget] = None,
         **model_kwargs,
     ) -> Union[BeamSearchOutput, torch.LongTensor]:
         r"""
@@ -6249,7 +6469,13 @@ class GenerationMixin:
         reject_token_pos_gather = [[] for _ in range(window_size)]
         model_kwargs_ori = model_kwargs.copy()
 
+        if decode_budget is not None:
+            decode_budget.start()
+
         while True:
+            decode_profiler.count("decode_steps")
+            if decode_budget is not None:
+                decode_budget.step()
             if synced_gpus:
                 # Under synced_gpus the `forward` call must continue until all gpus complete their sequence.
                 # The following logic allows an early break if all peers finished generating their sequence
@@ -6260,234 +6486,258 @@ class GenerationMixin:
                 if this_peer_finished_flag.item() == 0.0:
                     break
 
-            # Define current states
-            current_state = {}
-            current_state["input_ids"] = input_ids.clone()
-            current_state["beam_scorer"] = copy.deepcopy(beam_scorer)
-            current_state["beam_indices"] = beam_indices.copy() if beam_indices is not None else None
-            current_state["cur_len"] = cur_len
-
-            # prepare model inputs 
-            model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
+            if decode_budget is not None and decode_budget.exhausted():
+                # budget spent: plain beam search from here on, no candidate attention passes or rollbacks
+                model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
+                outputs = self(
+                    **model_inputs,
+                    return_dict=True,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                )
+                if synced_gpus and this_peer_finished:
+                    cur_len = cur_len + 1
+                    continue  # don't waste resources running the code we don't need
+                next_token_logits = outputs.logits[:, -1, :]
+            else:
+                # Define current states
+                current_state = {}
+                current_state["input_ids"] = input_ids.clone()
+                current_state["beam_scorer"] = copy.deepcopy(beam_scorer)
+                current_state["beam_indices"] = beam_indices.copy() if beam_indices is not None else None
+                current_state["cur_len"] = cur_len
+
+                # prepare model inputs 
+                model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
 
-            # forward pass to get next token
-            outputs = self(
-                **model_inputs,
-                return_dict=True,
-                output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-            )
+                # forward pass to get next token
+                outputs = self(
+                    **model_inputs,
+                    return_dict=True,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                )
 
-            # print("outputs.attentions[-1]", outputs.attentions[-1].shape)
-            # input()
+                # print("outputs.attentions[-1]", outputs.attentions[-1].shape)
+                # input()
 
-            # Load the previous self-attention weights
-            if not "past_key_values" in model_kwargs.keys():
-                attn_previous = outputs.attentions[-1].clone() # [batch_size * num_beams, num_head, q, kv]
-            else:
-                assert beam_idx is not None and attn_previous is not None
-                attn_previous = torch.cat([attn_previous, torch.zeros_like(attn_previous).sum(-1, keepdim=True)], -1)
-                attn_previous = torch.cat([attn_previous[beam_idx], outputs.attentions[-1].clone()], -2) # [batch_size * num_beams, num_head, q, kv]
-            current_state["attn_previous"] = attn_previous.data.cpu()
+                # Load the previous self-attention weights
+                if not "past_key_values" in model_kwargs.keys():
+                    attn_previous = outputs.attentions[-1].clone() # [batch_size * num_beams, num_head, q, kv]
+                else:
+                    assert beam_idx is not None and attn_previous is not None
+                    attn_previous = torch.cat([attn_previous, torch.zeros_like(attn_previous).sum(-1, keepdim=True)], -1)
+                    attn_previous = torch.cat([attn_previous[beam_idx], outputs.attentions[-1].clone()], -2) # [batch_size * num_beams, num_head, q, kv]
+                current_state["attn_previous"] = attn_previous.data.cpu()
 
-            # print("attn_previous", attn_previous.shape)
-            # input()
+                # print("attn_previous", attn_previous.shape)
+                # input()
 
-            if synced_gpus and this_peer_finished:
-                cur_len = cur_len + 1
-                continue  # don't waste resources running the code we don't need
+                if synced_gpus and this_peer_finished:
+                    cur_len = cur_len + 1
+                    continue  # don't waste resources running the code we don't need
 
-            next_token_logits = outputs.logits[:, -1, :]
+                next_token_logits = outputs.logits[:, -1, :]
 
-            # Select candidates
-            if num_attn_candidates < 2:
-                raise ValueError(
-                    f"Num of candidates must be larger than 1, but it is currently {num_attn_candidates}."
-                )
-            candidate_token_scores, candidate_tokens = torch.topk(
-                next_token_logits, num_attn_candidates, dim=-1, largest=True, sorted=True
-            ) # [batch_size * num_beams, num_attn_candidates]
-            current_state["candidate_tokens"] = candidate_tokens.clone()
-
-            current_state["beam_scores"] = beam_scores.clone()
-            current_state["beam_next_tokens"] = beam_next_tokens.clone() if beam_next_tokens is not None else None
-            current_state["beam_idx"] = beam_idx.clone() if beam_idx is not None else None
-
-            # Walk through all candidates to get their self-attention weights
-            attn_last = []
-            for candidate_id in range(num_attn_candidates):
-                # update temporary generated ids, model inputs, and length for next step
-                input_ids_tmp = torch.cat([input_ids, candidate_tokens[:, candidate_id].unsqueeze(-1)], dim=-1)
-
-                model_kwargs_tmp = model_kwargs.copy()
-                model_kwargs_tmp = self._update_model_kwargs_for_generation(
-                    outputs, model_kwargs_tmp, is_encoder_decoder=self.config.is_encoder_decoder
-                )
+                # Select candidates
+                if num_attn_candidates < 2:
+                    raise ValueError(
+                        f"Num of candidates must be larger than 1, but it is currently {num_attn_candidates}."
+                    )
+                candidate_token_scores, candidate_tokens = torch.topk(
+                    next_token_logits, num_attn_candidates, dim=-1, largest=True, sorted=True
+                ) # [batch_size * num_beams, num_attn_candidates]
+                current_state["candidate_tokens"] = candidate_tokens.clone()
+
+                current_state["beam_scores"] = beam_scores.clone()
+                current_state["beam_next_tokens"] = beam_next_tokens.clone() if beam_next_tokens is not None else None
+                current_state["beam_idx"] = beam_idx.clone() if beam_idx is not None else None
+
+                # Walk through all candidates to get their self-attention weights
+                attn_last = []
+                for candidate_id in range(num_attn_candidates):
+                    # update temporary generated ids, model inputs, and length for next step
+                    input_ids_tmp = torch.cat([input_ids, candidate_tokens[:, candidate_id].unsqueeze(-1)], dim=-1)
+
+                    model_kwargs_tmp = model_kwargs.copy()
+                    model_kwargs_tmp = self._update_model_kwargs_for_generation(
+                        outputs, model_kwargs_tmp, is_encoder_decoder=self.config.is_encoder_decoder
+                    )
 
-                # prepare model inputs
-                model_inputs_tmp = self.prepare_inputs_for_generation(input_ids_tmp, **model_kwargs_tmp)
+                    # prepare model inputs
+                    model_inputs_tmp = self.prepare_inputs_for_generation(input_ids_tmp, **model_kwargs_tmp)
 
-                # forward pass to get the self-attention maps of next token prediction
-                outputs_tmp = self(
-                    **model_inputs_tmp,
-                    return_dict=True,
-                    output_attentions=output_attentions,
-                    output_hidden_states=output_hidden_states,
-                )
+                    # forward pass to get the self-attention maps of next token prediction
+                    with decode_profiler.timer("opera_candidates"):
+                        outputs_tmp = self(
+                            **model_inputs_tmp,
+                            return_dict=True,
+                            output_attentions=output_attentions,
+                            output_hidden_states=output_hidden_states,
+                        )
                 
-                attn_square = torch.cat([attn_previous, torch.zeros_like(attn_previous).sum(-1, keepdim=True)], -1)
-                attn_square = torch.cat([attn_square, outputs_tmp.attentions[-1].clone()], -2) # [batch_size * num_beams, num_head, q+1, kv+1]
-                attn_last.append(attn_square.max(1, keepdim=True).values.data) # [batch_size * num_beams, 1, q+1, kv+1]
-
-            del input_ids_tmp, model_kwargs_tmp, model_inputs_tmp, outputs_tmp
-
-            # Gather the attentions of all candidates
-            attn_last = torch.cat(attn_last, 1) # [batch_size * num_beams, num_attn_candidates, q+1, kv+1]
-            attn_last = attn_last / attn_last.sum(-1, keepdim=True)
-
-            # Catch the self-attention weights with the size of local window
-            # [batch_size * num_beams, num_attn_candidates, window_size, window_size]
-            attn_pos = key_position
-            attn_local = attn_last[:, :, attn_pos["response_start"]:, attn_pos["response_start"]:]
-
-            # Scale up the self-attention weights and calculate the scores
-            attn_local = scale_factor * attn_local
-            attn_local_scores = torch.zeros((
-                attn_local.shape[0], attn_local.shape[1], attn_local.shape[-1]), dtype=torch.float16).to(candidate_token_scores.device)
-            for j in range(attn_local.shape[-1]):
-                local_score = 1e-7 * attn_local[..., j:, j].prod(-1).data
-                attn_local_scores[..., j] = local_score.to(torch.float32) # [batch_size * num_beams, num_attn_candidates, window_size]
-
-            # We use the attention scores to penalize the first 10 tokens
-            cur_response_lens = attn_local.shape[-1]
-            attn_i = attn_last[:, :, -1, attn_pos["image_start"]:attn_pos["image_end"]+1].sum(-1)
-            attn_scores = attn_i # [batch_size * num_beams, num_attn_candidates]
-
-            # We use the rollback scores to penalize the subsequent tokens
-            rollback_scores, rollback_locs = attn_local_scores.max(-1) # [batch_size * num_beams, num_attn_candidates]
-            rollback_loc = rollback_locs.mode().values.data # [batch_size * num_beams]
-            rollback_loc = rollback_loc.mode().values.data # [1]
-
-            penalty_scores = - attn_scores if cur_response_lens <= 10 else rollback_scores # [batch_size * num_beams, num_attn_candidates]
-
-            # incorporate with the history locations of the maximum of penalty scores
-            if history_rollback_locs is None:
-                history_rollback_locs = [rollback_locs.mode().values.data[:, None]]
-            else:
-                history_rollback_locs.append(rollback_locs.mode().values.data[:, None])
-            rollback_loc_gathers = torch.cat(history_rollback_locs, -1)# [batch_size * num_beams, window_size]
+                    attn_square = torch.cat([attn_previous, torch.zeros_like(attn_previous).sum(-1, keepdim=True)], -1)
+                    attn_square = torch.cat([attn_square, outputs_tmp.attentions[-1].clone()], -2) # [batch_size * num_beams, num_head, q+1, kv+1]
+                    attn_last.append(attn_square.max(1, keepdim=True).values.data) # [batch_size * num_beams, 1, q+1, kv+1]
+
+                del input_ids_tmp, model_kwargs_tmp, model_inputs_tmp, outputs_tmp
+
+                # Gather the attentions of all candidates
+                attn_last = torch.cat(attn_last, 1) # [batch_size * num_beams, num_attn_candidates, q+1, kv+1]
+                attn_last = attn_last / attn_last.sum(-1, keepdim=True)
+
+                # Catch the self-attention weights with the size of local window
+                # [batch_size * num_beams, num_attn_candidates, window_size, window_size]
+                attn_pos = key_position
+                attn_local = attn_last[:, :, attn_pos["response_start"]:, attn_pos["response_start"]:]
+
+                # Scale up the self-attention weights and calculate the scores
+                attn_local = scale_factor * attn_local
+                attn_local_scores = torch.zeros((
+                    attn_local.shape[0], attn_local.shape[1], attn_local.shape[-1]), dtype=torch.float16).to(candidate_token_scores.device)
+                for j in range(attn_local.shape[-1]):
+                    local_score = 1e-7 * attn_local[..., j:, j].prod(-1).data
+                    attn_local_scores[..., j] = local_score.to(torch.float32) # [batch_size * num_beams, num_attn_candidates, window_size]
+
+                # We use the attention scores to penalize the first 10 tokens
+                cur_response_lens = attn_local.shape[-1]
+                attn_i = attn_last[:, :, -1, attn_pos["image_start"]:attn_pos["image_end"]+1].sum(-1)
+                attn_scores = attn_i # [batch_size * num_beams, num_attn_candidates]
+
+                # We use the rollback scores to penalize the subsequent tokens
+                rollback_scores, rollback_locs = attn_local_scores.max(-1) # [batch_size * num_beams, num_attn_candidates]
+                rollback_loc = rollback_locs.mode().values.data # [batch_size * num_beams]
+                rollback_loc = rollback_loc.mode().values.data # [1]
+
+                penalty_scores = - attn_scores if cur_response_lens <= 10 else rollback_scores # [batch_size * num_beams, num_attn_candidates]
+
+                # incorporate with the history locations of the maximum of penalty scores
+                if history_rollback_locs is None:
+                    history_rollback_locs = [rollback_locs.mode().values.data[:, None]]
+                else:
+                    history_rollback_locs.append(rollback_locs.mode().values.data[:, None])
+                rollback_loc_gathers = torch.cat(history_rollback_locs, -1)# [batch_size * num_beams, window_size]
 
-            candidate_token_scores -= penalty_weights * penalty_scores
-            current_state["candidate_token_scores"] = candidate_token_scores.clone()
+                candidate_token_scores -= penalty_weights * penalty_scores
+                current_state["candidate_token_scores"] = candidate_token_scores.clone()
 
-            # history check
-            if len(history_states) >= history_length:
-                history_states.pop(0)
-            history_states.append(current_state)
+                # history check
+                if len(history_states) >= history_length:
+                    history_states.pop(0)
+                history_states.append(current_state)
 
-            # check if we need rollback
-            try:
-                if all((rollback_loc_gather == rollback_loc).long().sum() > int(threshold) for _, rollback_loc_gather in enumerate(rollback_loc_gathers)):
-                    if rollback_loc < 10: # or rollback_loc + 1 < rollback_pos:
-                        assert False
-                    # locate the rollback position
-                    rollback_pos = rollback_loc + 1
-                    if max_rollback_time[rollback_pos] >= num_attn_candidates:
-                        # print(f"Already reach the maximum rollback times at position {rollback_pos}, so shift the rollback position to {rollback_pos-1}")
-                        rollback_pos = rollback_pos - 1
-                        if max_rollback_time[rollback_pos] >= num_attn_candidates:
+                # check if we need rollback
+                try:
+                    if all((rollback_loc_gather == rollback_loc).long().sum() > int(threshold) for _, rollback_loc_gather in enumerate(rollback_loc_gathers)):
+                        if rollback_loc < 10: # or rollback_loc + 1 < rollback_pos:
+                            assert False
+                        if decode_budget is not None and decode_budget.exhausted():
+                            # spent while this step's candidates were scored: keep the penalised candidates
                             assert False
+                        # locate the rollback position
+                        rollback_pos = rollback_loc + 1
+                        if max_rollback_time[rollback_pos] >= num_attn_candidates:
+                            # print(f"Already reach the maximum rollback times at position {rollback_pos}, so shift the rollback position to {rollback_pos-1}")
+                            rollback_pos = rollback_pos - 1
+                            if max_rollback_time[rollback_pos] >= num_attn_candidates:
+                                assert False
+                            else:
+                                max_rollback_time[rollback_pos] += 1
                         else:
                             max_rollback_time[rollback_pos] += 1
-                    else:
-                        max_rollback_time[rollback_pos] += 1
-                    if cur_response_lens - rollback_pos > history_length + 1:
-                        rollback_pos = max(1, cur_response_lens - history_length - 1)
-                    # print(f"rollback from pos {cur_response_lens-1} to pos {rollback_pos} for the time {int(max_rollback_time[rollback_pos])}")
+                        if cur_response_lens - rollback_pos > history_length + 1:
+                            rollback_pos = max(1, cur_response_lens - history_length - 1)
+                        # print(f"rollback from pos {cur_response_lens-1} to pos {rollback_pos} for the time {int(max_rollback_time[rollback_pos])}")
+
+                        if decode_budget is not None:
+                            decode_budget.charge("rollbacks")
+                        decode_profiler.count("rollbacks")
+
+                        # discard the rollbacked states in history
+                        for j in range(cur_response_lens-rollback_pos-2):
+                            history_states.pop(-1)
+                            history_rollback_locs.pop(-1)
+                            reject_token_pos_gather[-(j+1)] = []
+
+                        # Revive all of variables in the state of the rollback position
+                        input_ids = history_states[-2]["input_ids"]
+                        beam_scorer = history_states[-2]["beam_scorer"]
+                        beam_indices = history_states[-2]["beam_indices"]
+                        cur_len = history_states[-2]["cur_len"]
+
+                        attn_previous = history_states[-2]["attn_previous"].to(input_ids.device)
+                        candidate_token_scores = history_states[-2]["candidate_token_scores"]
+                        candidate_tokens = history_states[-2]["candidate_tokens"]
+
+                        beam_scores = history_states[-2]["beam_scores"]
+                        beam_next_tokens = history_states[-1]["beam_next_tokens"]
+                        beam_idx = history_states[-1]["beam_idx"]
+
+                        # first inference to get model kwargs
+                        if "images" in model_kwargs_ori.keys():
+                            model_kwargs = model_kwargs_ori.copy()
+                            model_kwargs["attention_mask"] = torch.cat([
+                                model_kwargs["attention_mask"], torch.ones((
+                                    input_ids.shape[0], input_ids[:,:-1].shape[1] - model_kwargs["attention_mask"].shape[1]
+                                )).to(input_ids.device)], 1)
+
+                            model_inputs_tmp = self.prepare_inputs_for_generation(input_ids[:,:-1], **model_kwargs)
+                        else:
+                            answer_embeds = self.model.embed_tokens(input_ids[:,1:-1])
+                            model_kwargs = model_kwargs_ori.copy()
+                            model_kwargs["inputs_embeds"] = torch.cat([model_kwargs["inputs_embeds"], answer_embeds], 1)
+                            model_kwargs["attention_mask"] = torch.cat(
+                                [model_kwargs["attention_mask"], torch.ones_like(input_ids[:,1:-1]).to(input_ids.device)], 1)
+
+                            model_inputs_tmp = self.prepare_inputs_for_generation(input_ids[:,1:-1], **model_kwargs)
+
+                        with decode_profiler.timer("opera_rollback"):
+                            outputs_tmp = self(
+                                **model_inputs_tmp,
+                                return_dict=True,
+                                output_attentions=output_attentions,
+                                output_hidden_states=output_hidden_states,
+                            )
+                        model_kwargs = self._update_model_kwargs_for_generation(
+                            outputs_tmp, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
+                        )
 
-                    # discard the rollbacked states in history
-                    for j in range(cur_response_lens-rollback_pos-2):
+                        # another inference to get outputs and logits
+                        model_inputs_tmp = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
+
+                        with decode_profiler.timer("opera_rollback"):
+                            outputs = self(
+                                **model_inputs_tmp,
+                                return_dict=True,
+                                output_attentions=output_attentions,
+                                output_hidden_states=output_hidden_states,
+                            )
+                        next_token_logits = outputs.logits[:, -1, :]
+                        del outputs_tmp, model_inputs_tmp
+
+                        # discard the last rollbacked state in history
                         history_states.pop(-1)
                         history_rollback_locs.pop(-1)
-                        reject_token_pos_gather[-(j+1)] = []
-
-                    # Revive all of variables in the state of the rollback position
-                    input_ids = history_states[-2]["input_ids"]
-                    beam_scorer = history_states[-2]["beam_scorer"]
-                    beam_indices = history_states[-2]["beam_indices"]
-                    cur_len = history_states[-2]["cur_len"]
-
-                    attn_previous = history_states[-2]["attn_previous"].to(input_ids.device)
-                    candidate_token_scores = history_states[-2]["candidate_token_scores"]
-                    candidate_tokens = history_states[-2]["candidate_tokens"]
-
-                    beam_scores = history_states[-2]["beam_scores"]
-                    beam_next_tokens = history_states[-1]["beam_next_tokens"]
-                    beam_idx = history_states[-1]["beam_idx"]
-
-                    # first inference to get model kwargs
-                    if "images" in model_kwargs_ori.keys():
-                        model_kwargs = model_kwargs_ori.copy()
-                        model_kwargs["attention_mask"] = torch.cat([
-                            model_kwargs["attention_mask"], torch.ones((
-                                input_ids.shape[0], input_ids[:,:-1].shape[1] - model_kwargs["attention_mask"].shape[1]
-                            )).to(input_ids.device)], 1)
-
-                        model_inputs_tmp = self.prepare_inputs_for_generation(input_ids[:,:-1], **model_kwargs)
+                        reject_token_pos_gather[rollback_pos+1] = []
+
+                        # set penalty on the corresponding candidates
+                        next_token_logits -= 999. + next_token_logits.min(-1, keepdim=True).values.data
+                        next_token_logits = next_token_logits.view(batch_size, num_beams * vocab_size)
+                        beam_idx = beam_idx.view(batch_size, num_beams)
+                        beam_next_tokens = beam_next_tokens.view(batch_size, num_beams)
+                        reject_token_pos = beam_idx * vocab_size + beam_next_tokens
+                        if len(reject_token_pos_gather[rollback_pos]) > 0:
+                            reject_token_pos = torch.cat([reject_token_pos_gather[rollback_pos], reject_token_pos], -1)
+                        reject_token_pos_gather[rollback_pos] = reject_token_pos
+                        next_token_logits = next_token_logits.scatter_(-1, reject_token_pos, -999.)
+                        next_token_logits = next_token_logits.view(batch_size * num_beams, vocab_size)
                     else:
-                        answer_embeds = self.model.embed_tokens(input_ids[:,1:-1])
-                        model_kwargs = model_kwargs_ori.copy()
-                        model_kwargs["inputs_embeds"] = torch.cat([model_kwargs["inputs_embeds"], answer_embeds], 1)
-                        model_kwargs["attention_mask"] = torch.cat(
-                            [model_kwargs["attention_mask"], torch.ones_like(input_ids[:,1:-1]).to(input_ids.device)], 1)
-
-                        model_inputs_tmp = self.prepare_inputs_for_generation(input_ids[:,1:-1], **model_kwargs)
-
-                    outputs_tmp = self(
-                        **model_inputs_tmp,
-                        return_dict=True,
-                        output_attentions=output_attentions,
-                        output_hidden_states=output_hidden_states,
-                    )
-                    model_kwargs = self._update_model_kwargs_for_generation(
-                        outputs_tmp, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
-                    )
-
-                    # another inference to get outputs and logits
-                    model_inputs_tmp = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
-
-                    outputs = self(
-                        **model_inputs_tmp,
-                        return_dict=True,
-                        output_attentions=output_attentions,
-                        output_hidden_states=output_hidden_states,
-                    )
-                    next_token_logits = outputs.logits[:, -1, :]
-                    del outputs_tmp, model_inputs_tmp
-
-                    # discard the last rollbacked state in history
-                    history_states.pop(-1)
-                    history_rollback_locs.pop(-1)
-                    reject_token_pos_gather[rollback_pos+1] = []
-
-                    # set penalty on the corresponding candidates
-                    next_token_logits -= 999. + next_token_logits.min(-1, keepdim=True).values.data
-                    next_token_logits = next_token_logits.view(batch_size, num_beams * vocab_size)
-                    beam_idx = beam_idx.view(batch_size, num_beams)
-                    beam_next_tokens = beam_next_tokens.view(batch_size, num_beams)
-                    reject_token_pos = beam_idx * vocab_size + beam_next_tokens
-                    if len(reject_token_pos_gather[rollback_pos]) > 0:
-                        reject_token_pos = torch.cat([reject_token_pos_gather[rollback_pos], reject_token_pos], -1)
-                    reject_token_pos_gather[rollback_pos] = reject_token_pos
-                    next_token_logits = next_token_logits.scatter_(-1, reject_token_pos, -999.)
-                    next_token_logits = next_token_logits.view(batch_size * num_beams, vocab_size)
-                else:
-                    assert False
-            except:
-                next_token_logits.fill_(-999.)
-                next_token_logits = next_token_logits.scatter_(-1, candidate_tokens, candidate_token_scores)
+                        assert False
+                except:
+                    next_token_logits.fill_(-999.)
+                    next_token_logits = next_token_logits.scatter_(-1, candidate_tokens, candidate_token_scores)
 
-            del attn_last, attn_local, attn_local_scores
+                del attn_last, attn_local, attn_local_scores
             # hack: adjust tokens for Marian. For Marian we have to make sure that the `pad_token_id`
             # cannot be generated both before and after the `nn.functional.log_softmax` operation.
             next_token_logits = self.adjust_logits_during_generation(next_token_logits, cur_len=cur_len)
@@ -6565,6 +6815,9 @@ class GenerationMixin:
                 else:
                     this_peer_finished = True
 
+        if decode_budget is not None:
+            decode_budget.finish()
+
         sequence_outputs = beam_scorer.finalize(
             input_ids,
             beam_scores,
@@ -6815,6 +7068,7 @@ class GenerationMixin:
         info_dict = {}
 
         while True:
+            decode_profiler.count("decode_steps")
             if synced_gpus:
                 # Under synced_gpus the `forward` call must continue until all gpus complete their sequence.
                 # The following logic allows an early break if all peers finished generating their sequence